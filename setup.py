@@ -32,9 +32,11 @@ setup(
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     download-xml = presence_analyzer.script:download_xml
+    load-test = presence_analyzer.loadtest:main
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
     debug = presence_analyzer.script:make_debug
+    router = presence_analyzer.script:make_router
     """,
 )
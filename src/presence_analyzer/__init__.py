@@ -1,6 +1,16 @@
 # -*- coding: utf-8 -*-
 """
 Presence analyzer.
+
+Flask, Mako, lxml and views are imported on first use only, so command line
+tools importing presence_analyzer.script start without them.
 """
-from .main import app
-from . import views
+
+
+def get_app():
+    """
+    Returns Flask app with all views registered.
+    """
+    from presence_analyzer import views  # pylint: disable=unused-variable
+    from presence_analyzer.main import app
+    return app
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of user avatars.
+
+Every avatar is fetched from intranet, resized to a thumbnail when Pillow
+is available and stored in AVATAR_CACHE directory as
+<user_id>-<source hash>-<content hash>.<extension>. Intranet URLs of avatars
+don't change with images, so stored avatar older than max_age is revalidated
+with conditional GET and replaced when intranet sends a different image.
+Names change whenever image changes, so they can be served with far future
+caching headers.
+"""
+
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib2
+from contextlib import closing
+from cStringIO import StringIO
+from email.utils import formatdate
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+IMAGE_EXTENSIONS = {
+    'image/gif': '.gif',
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+}
+
+
+def short_hash(data):
+    """
+    Returns short hex digest of data used in file names.
+    """
+    return hashlib.sha1(data).hexdigest()[:12]
+
+
+def make_thumbnail(data, size):
+    """
+    Returns (data, extension) of PNG thumbnail fitting size x size pixels.
+
+    Without Pillow, or for images it can't read, (data, None) is returned
+    and image is stored as fetched.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return data, None
+
+    try:
+        image = Image.open(StringIO(data))
+        image.thumbnail((size, size))
+        output = StringIO()
+        image.save(output, 'PNG')
+    except (IOError, ValueError):
+        log.debug('Unable to resize avatar', exc_info=True)
+        return data, None
+
+    return output.getvalue(), '.png'
+
+
+class AvatarCache(object):
+    """
+    Avatars of users stored on disk, fetched on first request.
+
+    Modification time of stored file is the time it was last validated.
+    """
+
+    def __init__(self, directory, size=128, timeout=10, max_age=24 * 3600):
+        self.directory = directory
+        self.size = size
+        self.timeout = timeout
+        self.max_age = max_age
+        self._names = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _user_lock(self, user_id):
+        """
+        Returns lock guarding fetch of given user's avatar.
+        """
+        with self._lock:
+            return self._locks.setdefault(user_id, threading.Lock())
+
+    def _stored(self, prefix):
+        """
+        Returns name of stored file starting with prefix, or None.
+        """
+        paths = glob.glob(os.path.join(self.directory, prefix + '-*'))
+        if not paths:
+            return None
+        return os.path.basename(sorted(paths)[0])
+
+    def _validated(self, name):
+        """
+        Returns time stored file was last validated, None if it's gone.
+        """
+        try:
+            return os.path.getmtime(os.path.join(self.directory, name))
+        except OSError:
+            return None
+
+    def name(self, user_id, url):
+        """
+        Returns file name of user's avatar, fetching it when needed.
+
+        Returns None when avatar can't be fetched. Stale avatar is served
+        when revalidation fails.
+        """
+        prefix = '{}-{}'.format(user_id, short_hash(url))
+        name, validated = self._names.get(user_id, (None, 0))
+        if (
+                name is not None and name.startswith(prefix + '-') and
+                time.time() - validated < self.max_age
+        ):
+            return name
+
+        with self._user_lock(user_id):
+            name = self._stored(prefix)
+            validated = self._validated(name) if name is not None else None
+            if validated is None or time.time() - validated >= self.max_age:
+                name = self._fetch(user_id, prefix, url, name, validated)
+                validated = time.time()
+            if name is not None:
+                self._names[user_id] = (name, validated)
+            return name
+
+    def _fetch(self, user_id, prefix, url, stored=None, validated=None):
+        """
+        Downloads image at url and stores its thumbnail.
+
+        Given stored avatar is revalidated, it's kept when image didn't
+        change or can't be fetched.
+        """
+        request = urllib2.Request(url)
+        if stored is not None and validated is not None:
+            request.add_header(
+                'If-Modified-Since', formatdate(validated, usegmt=True)
+            )
+        try:
+            with closing(
+                    urllib2.urlopen(request, timeout=self.timeout)
+            ) as resp:
+                data = resp.read()
+                content_type = resp.info().gettype()
+        except urllib2.HTTPError as e:
+            if e.code != 304:
+                log.warning('Unable to fetch avatar %s', url, exc_info=True)
+            return self._touch(stored)
+        except (urllib2.URLError, IOError):
+            log.warning('Unable to fetch avatar %s', url, exc_info=True)
+            return self._touch(stored)
+
+        data, extension = make_thumbnail(data, self.size)
+        extension = extension or IMAGE_EXTENSIONS.get(content_type, '.jpg')
+        name = '{}-{}{}'.format(prefix, short_hash(data), extension)
+        if name == stored:
+            return self._touch(stored)
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.rename(tmp_path, os.path.join(self.directory, name))
+
+        # Drop thumbnails of user's previous avatar.
+        pattern = os.path.join(self.directory, '{}-*'.format(user_id))
+        for path in glob.glob(pattern):
+            if os.path.basename(path) != name:
+                os.unlink(path)
+
+        return name
+
+    def _touch(self, name):
+        """
+        Marks stored file as just validated, returns its name.
+        """
+        if name is not None:
+            try:
+                os.utime(os.path.join(self.directory, name), None)
+            except OSError:
+                log.debug('Avatar %s is gone', name, exc_info=True)
+        return name
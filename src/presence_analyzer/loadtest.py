@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent load generator for comparing serving modes.
+
+Usage:
+    bin/load-test http://localhost:8080 http://localhost:8081 -c 500 -n 20000
+    bin/load-test --serve prefork --workers 8 --log access.log -c 200
+    bin/load-test --serve async --synthetic -c 500 -n 20000
+
+With --serve the app is started on localhost through bin/flask-ctl and
+stopped when the run is over. Requests are either replayed from access log,
+drawn from synthetic dashboard mix over all users and months, or cycled
+through given paths.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import signal
+import subprocess
+import threading
+import time
+import urllib2
+from contextlib import closing, contextmanager
+from itertools import cycle
+
+from presence_analyzer import script
+
+DEFAULT_PATHS = [
+    '/api/v1/users',
+    '/api/v1/years_and_months/',
+    '/api/v1/presence_weekday/10',
+    '/api/v1/mean_time_weekday/10',
+    '/api/v1/presence_start_end/10',
+    '/api/v1/top_five/2013/9',
+]
+
+# Arguments of bin/flask-ctl for every serving mode.
+SERVE_MODES = {
+    'paster': ['serve', 'run'],
+    'async': ['async'],
+    'prefork': ['prefork'],
+}
+WORKERS_OPTIONS = {
+    'async': '--processes={}',
+    'prefork': '--workers={}',
+}
+
+# Requests of dashboard pages with their relative frequency.
+SYNTHETIC_MIX = (
+    ('/api/v1/bootstrap/presence_weekday?user_id={user_id}', 2),
+    ('/api/v1/bootstrap/mean_time_weekday?user_id={user_id}', 2),
+    ('/api/v1/bootstrap/presence_start_end?user_id={user_id}', 2),
+    ('/api/v1/bootstrap/top_five_by_month?year={year}&month={month}', 1),
+    ('/api/v1/presence_weekday/{user_id}', 4),
+    ('/api/v1/mean_time_weekday/{user_id}', 4),
+    ('/api/v1/presence_start_end/{user_id}', 4),
+    ('/api/v1/top_five/{year}/{month}', 2),
+    ('/api/v1/users', 1),
+    ('/api/v1/years_and_months/', 1),
+)
+
+LOGGED_REQUEST = re.compile(r'"GET (/api/v1/\S+) HTTP/[\d.]+"')
+# Long-lived or administrative requests which don't belong to a replay.
+NOT_REPLAYED = ('/api/v1/events', '/api/v1/admin/')
+
+
+def read_access_log(lines):
+    """
+    Returns API paths of GET requests found in access log lines, in order.
+
+    Lines may be in common or combined log format, or hold bare paths.
+    """
+    paths = []
+    for line in lines:
+        match = LOGGED_REQUEST.search(line)
+        if match is not None:
+            path = match.group(1)
+        elif line.startswith('/api/v1/'):
+            path = line.strip()
+        else:
+            continue
+        if not path.startswith(NOT_REPLAYED):
+            paths.append(path)
+    return paths
+
+
+def get_json(url, timeout=30):
+    """
+    Returns decoded JSON response of GET request to url.
+    """
+    with closing(urllib2.urlopen(url, timeout=timeout)) as resp:
+        return json.load(resp)
+
+
+def synthetic_paths(base_url, count, seed=0):
+    """
+    Returns count paths drawn from SYNTHETIC_MIX over users and months
+    with presence data served at base_url.
+
+    The same seed gives the same paths, so servers are loaded equally.
+    """
+    # Users and months which have presence data.
+    matrix = get_json(
+        base_url.rstrip('/') + '/api/v1/worktime_matrix?encoding=sparse'
+    )
+    user_ids = matrix['users']
+    months = [
+        tuple(int(part) for part in month.split('-'))
+        for month in matrix['months']
+    ]
+    templates = [
+        template for template, weight in SYNTHETIC_MIX for _ in range(weight)
+    ]
+    generator = random.Random(seed)
+
+    paths = []
+    for _ in range(count):
+        year, month = generator.choice(months)
+        paths.append(generator.choice(templates).format(
+            user_id=generator.choice(user_ids),
+            year=year,
+            month=month,
+        ))
+    return paths
+
+
+def wait_until_up(base_url, process=None, timeout=60):
+    """
+    Waits until server at base_url answers requests.
+
+    Raises RuntimeError when process exits or timeout passes first.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(
+                'Server exited with status {}'.format(process.returncode)
+            )
+        try:
+            urllib2.urlopen(base_url.rstrip('/') + '/api/v1/users', timeout=1)
+            return
+        except urllib2.HTTPError:
+            return
+        except (urllib2.URLError, IOError):
+            time.sleep(0.2)
+    raise RuntimeError('Server at {} is not up'.format(base_url))
+
+
+@contextmanager
+def local_server(command, base_url, timeout=60):
+    """
+    Runs server command until block ends, entering it once base_url is up.
+
+    Command runs in its own process group, so workers and reloaders it
+    spawns are stopped together with it.
+    """
+    process = subprocess.Popen(command, preexec_fn=os.setsid)
+    try:
+        wait_until_up(base_url, process, timeout)
+        yield process
+    finally:
+        if process.poll() is None:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+
+
+def serve_command(mode, workers=None, ctl=None):
+    """
+    Returns bin/flask-ctl command serving the app in given mode.
+    """
+    command = [ctl or script.abspath('bin', 'flask-ctl')] + SERVE_MODES[mode]
+    if workers is not None and mode in WORKERS_OPTIONS:
+        command.append(WORKERS_OPTIONS[mode].format(workers))
+    return command
+
+
+def percentile(values, percent):
+    """
+    Returns percentile of sorted values using nearest rank method.
+    """
+    if not values:
+        return 0
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def run_load(base_url, paths, concurrency=50, requests=1000, timeout=30):
+    """
+    Issues requests to paths of base_url from concurrent threads.
+
+    Returns dict with throughput (requests per second) and latencies (s).
+    """
+    urls = cycle(base_url.rstrip('/') + path for path in paths)
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    remaining = [requests]
+
+    def worker():
+        """
+        Takes next URL while there are requests left and times it.
+        """
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+                url = next(urls)
+            start = time.time()
+            try:
+                urllib2.urlopen(url, timeout=timeout).read()
+            except (urllib2.URLError, IOError):
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors[0],
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0,
+        'mean': sum(latencies) / len(latencies) if latencies else 0,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else 0,
+    }
+
+
+def format_report(base_url, stats):
+    """
+    Formats stats returned by run_load() as one report line.
+    """
+    return (
+        '{url}: {throughput:.1f} req/s, errors {errors}/{requests}, '
+        'latency mean {mean_ms:.1f} ms, p50 {p50_ms:.1f} ms, '
+        'p90 {p90_ms:.1f} ms, p99 {p99_ms:.1f} ms, max {max_ms:.1f} ms'
+    ).format(
+        url=base_url,
+        mean_ms=stats['mean'] * 1000,
+        p50_ms=stats['p50'] * 1000,
+        p90_ms=stats['p90'] * 1000,
+        p99_ms=stats['p99'] * 1000,
+        max_ms=stats['max'] * 1000,
+        **stats
+    )
+
+
+def load_server(base_url, args):
+    """
+    Runs load described by command line arguments against base_url.
+    """
+    if args.log:
+        with open(args.log, 'r') as log_file:
+            paths = read_access_log(log_file)
+    elif args.synthetic:
+        paths = synthetic_paths(base_url, args.requests or 1000, args.seed)
+    else:
+        paths = args.paths or DEFAULT_PATHS
+
+    if not paths:
+        raise SystemExit('No API requests to replay')
+
+    return run_load(
+        base_url,
+        paths,
+        concurrency=args.concurrency,
+        requests=args.requests or (len(paths) if args.log else 1000),
+    )
+
+
+def main():
+    """
+    Runs the same load against every given server and prints reports.
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('urls', nargs='*', help='base URLs of servers')
+    parser.add_argument('-c', '--concurrency', type=int, default=50)
+    parser.add_argument(
+        '-n', '--requests', type=int,
+        help='number of requests (default: 1000, whole log when replaying)'
+    )
+    parser.add_argument(
+        '-p', '--path', action='append', dest='paths',
+        help='request path, may be repeated (default: API mix)'
+    )
+    parser.add_argument(
+        '-l', '--log', help='replay API requests of access log'
+    )
+    parser.add_argument(
+        '--synthetic', action='store_true',
+        help='random dashboard requests over all users and months'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0, help='seed of synthetic requests'
+    )
+    parser.add_argument(
+        '-s', '--serve', choices=sorted(SERVE_MODES),
+        help='start local server with bin/flask-ctl in given mode and load it'
+    )
+    parser.add_argument(
+        '-w', '--workers', type=int,
+        help='worker processes of async and prefork servers'
+    )
+    parser.add_argument(
+        '--ctl', help='flask-ctl script (default: bin/flask-ctl)'
+    )
+    args = parser.parse_args()
+
+    if bool(args.urls) == bool(args.serve):
+        parser.error('give either server URLs or --serve')
+
+    if args.serve:
+        base_url = 'http://127.0.0.1:{}'.format(script._server_address()[1])
+        command = serve_command(args.serve, args.workers, args.ctl)
+        with local_server(command, base_url):
+            print format_report(args.serve, load_server(base_url, args))
+        return
+
+    for base_url in args.urls:
+        print format_report(base_url, load_server(base_url, args))
@@ -0,0 +1,737 @@
+# -*- coding: utf-8 -*-
+"""
+Background data manager.
+
+Presence data and indexes derived from it are kept in an immutable snapshot.
+A background thread watches data files, builds a new snapshot off the request
+path and publishes it with a single reference assignment, so views never take
+a lock and never see a half-built structure.
+"""
+
+import Queue
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import date as date_type
+
+from presence_analyzer.main import app
+from presence_analyzer.partitions import (
+    Partitions,
+    is_partitioned,
+    source_signature
+)
+from presence_analyzer.sharding import shard_filter
+from presence_analyzer.utils import (
+    IntervalIndex,
+    PrefixSums,
+    WorktimeMatrix,
+    file_signature,
+    group_by_weekday,
+    group_by_weekday_by_start_end,
+    index_by_date,
+    index_sorted_dates,
+    merge_weekdays,
+    merge_weekdays_start_end,
+    occupancy_curves,
+    parse_data_csv,
+    parse_groups_json,
+    parse_xml_data,
+    rolling_stats,
+    start_end_sketches,
+    user_directory,
+    write_quarantine
+)
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+WARM_INDEXES = (
+    'data',
+    'by_date',
+    'months',
+    'dates',
+    'worktime_sums',
+    'worktime_matrix',
+    'intervals',
+    'sketches',
+    'rolling',
+    'by_weekday',
+    'by_weekday_start_end',
+    'directory',
+    'groups_by_weekday',
+    'groups_by_weekday_start_end',
+    'groups_by_month',
+)
+
+# Sent to subscribers instead of changes when event streams should end.
+DISCONNECT = 'disconnect'
+
+
+def data_inputs(config):
+    """
+    Returns versions of base inputs datasets are derived from: presence
+    data of node's shard ('csv'), users file ('xml') and optional user
+    groups file ('groups').
+    """
+    return {
+        'csv': (
+            source_signature(config['DATA_CSV']),
+            config.get('SHARD_NAME'),
+            tuple(config.get('SHARD_NODES') or ()),
+        ),
+        'xml': file_signature(config['DATA_XML']),
+        'groups': (
+            file_signature(config['DATA_GROUPS'])
+            if config.get('DATA_GROUPS') else None
+        ),
+    }
+
+
+def data_signature(config):
+    """
+    Returns signature of data files pointed by config and of node's shard.
+    """
+    return tuple(sorted(data_inputs(config).iteritems()))
+
+
+def month_catalogue(months):
+    """
+    Returns (year, month) pairs formatted for dropdown, newest first, eg:
+    [
+        ('2013 - September', 9, 2013),
+        ('2013 - August', 8, 2013),
+    ]
+    """
+    return [
+        (date_type(year, month, 1).strftime('%Y - %B'), month, year)
+        for year, month in sorted(months, reverse=True)
+    ]
+
+
+DATASETS = OrderedDict()
+
+
+class derived(object):  # pylint: disable=invalid-name
+    """
+    Snapshot dataset computed on first access, once per version of inputs.
+
+    Inputs are base inputs of data_inputs() or names of other datasets.
+    Every dataset is listed in DATASETS and its build time and size are
+    kept in snapshot's 'stats'.
+    """
+
+    def __init__(self, *inputs):
+        self.inputs = inputs
+        self.function = None
+        self.__name__ = self.__doc__ = None
+
+    def __call__(self, function):
+        self.function = function
+        self.__name__ = function.__name__
+        self.__doc__ = function.__doc__
+        DATASETS[self.__name__] = self
+        return self
+
+    def __get__(self, snapshot, owner):
+        if snapshot is None:
+            return self
+        with snapshot.build_lock:
+            if self.__name__ not in snapshot.__dict__:
+                started = time.time()
+                value = self.function(snapshot)
+                snapshot.__dict__[self.__name__] = value
+                snapshot.stats[self.__name__] = {
+                    'version': snapshot.version,
+                    'seconds': time.time() - started,
+                    'size': len(value) if hasattr(value, '__len__') else None,
+                }
+        return snapshot.__dict__[self.__name__]
+
+
+def input_version(snapshot, name):
+    """
+    Returns versions of base inputs dataset or base input depends on.
+    """
+    if name in snapshot.inputs:
+        return snapshot.inputs[name]
+    return tuple(
+        input_version(snapshot, source) for source in DATASETS[name].inputs
+    )
+
+
+class Snapshot(object):
+    """
+    Immutable bundle of presence data and indexes built from it.
+
+    Indexes are derived on first access or ahead of publishing by warm().
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, version, signature, users, location,
+                 quarantine=None, partitions=None, shard=None, groups=None):
+        self.version = version
+        self.signature = signature
+        self.inputs = dict(signature)
+        self.users = users
+        self.users_by_id = {user['user_id']: user for user in users}
+        self.groups = groups or {}
+        self.location = location
+        self.quarantine = quarantine
+        self.partitions = partitions
+        self.shard = shard
+        self.rejected = 0
+        self.rejected_recorded = False
+        self.stats = {}
+        self.build_lock = threading.RLock()
+        self._occupancy = {}
+
+    def warm(self):
+        """
+        Builds all indexes, except data of partitioned source which is
+        loaded only when a query needs whole history.
+        """
+        if self.partitions is not None:
+            self.record_rejected()
+            return self.months
+        for name in WARM_INDEXES:
+            getattr(self, name)
+
+    @derived('csv')
+    def data(self):
+        """
+        Whole presence history, see utils.get_data() for structure.
+
+        Malformed CSV rows are counted in 'rejected' and written to
+        quarantine file if it's configured.
+        """
+        if self.partitions is not None:
+            data = self.partitions.load_all()
+            self.record_rejected()
+            return data
+
+        rejected = []
+        data = parse_data_csv(self.location, rejected, self.shard)
+        self.rejected = len(rejected)
+        if rejected:
+            log.warning(
+                'Skipped %d malformed rows of %s', len(rejected), self.location
+            )
+        if self.quarantine:
+            write_quarantine(self.quarantine, rejected)
+
+        return data
+
+    def record_rejected(self):
+        """
+        Counts malformed rows of partitions parsed so far and rewrites
+        quarantine file when lazily loaded months added some.
+        """
+        with self.build_lock:
+            rejected = self.partitions.rejected_rows()
+            if len(rejected) == self.rejected and self.rejected_recorded:
+                return
+            self.rejected = len(rejected)
+            self.rejected_recorded = True
+            if rejected:
+                log.warning(
+                    'Skipped %d malformed rows of %s',
+                    len(rejected),
+                    self.location
+                )
+            if self.quarantine:
+                write_quarantine(self.quarantine, rejected)
+
+    def partition_month(self, year, month):
+        """
+        Returns node's part of given month's partition.
+        """
+        data = self.partitions.month(year, month)
+        self.record_rejected()
+        return data
+
+    def partition_index(self, year, month, build):
+        """
+        Returns build() of node's part of given month's partition, kept
+        with the loaded partition.
+        """
+        index = self.partitions.month_index(year, month, build)
+        self.record_rejected()
+        return index
+
+    @derived('data')
+    def by_date(self):
+        """
+        Worktime of users by date, see utils.index_by_date().
+        """
+        return index_by_date(self.data)
+
+    @derived('data')
+    def months(self):
+        """
+        Months with presence data, see month_catalogue().
+        """
+        if self.partitions is not None:
+            return month_catalogue(self.partitions.months())
+
+        months = set()
+        for values in self.data.itervalues():
+            months.update((date.year, date.month) for date in values)
+        return month_catalogue(months)
+
+    @derived('data')
+    def dates(self):
+        """
+        Sorted dates of every user, see utils.index_sorted_dates().
+        """
+        return index_sorted_dates(self.data)
+
+    @derived('data')
+    def worktime_sums(self):
+        """
+        Cumulative worktime of users by day, see utils.PrefixSums.
+        """
+        return PrefixSums(self.data)
+
+    @derived('data')
+    def worktime_matrix(self):
+        """
+        Worktime of users by month, see utils.WorktimeMatrix.
+        """
+        return WorktimeMatrix(self.data)
+
+    @derived('data')
+    def intervals(self):
+        """
+        Presence entries by date, see utils.IntervalIndex.
+        """
+        return IntervalIndex(self.data)
+
+    @derived('data')
+    def sketches(self):
+        """
+        Start and end time sketches of users by weekday.
+        """
+        return {
+            user_id: start_end_sketches(items)
+            for user_id, items in self.data.iteritems()
+        }
+
+    @derived('data')
+    def rolling(self):
+        """
+        Moving means of users' worktime and start time, see
+        utils.RollingStats.
+        """
+        return {
+            user_id: rolling_stats(items)
+            for user_id, items in self.data.iteritems()
+        }
+
+    @derived('data')
+    def by_weekday(self):
+        """
+        Worktime of users grouped by weekday, see utils.group_by_weekday().
+        """
+        return {
+            user_id: group_by_weekday(items)
+            for user_id, items in self.data.iteritems()
+        }
+
+    @derived('data')
+    def by_weekday_start_end(self):
+        """
+        Start and end times of users grouped by weekday, see
+        utils.group_by_weekday_by_start_end().
+        """
+        return {
+            user_id: group_by_weekday_by_start_end(items)
+            for user_id, items in self.data.iteritems()
+        }
+
+    @derived('groups', 'by_weekday')
+    def groups_by_weekday(self):
+        """
+        Worktime of groups' members grouped by weekday, see
+        utils.merge_weekdays().
+        """
+        return {
+            name: merge_weekdays([
+                self.by_weekday[user_id]
+                for user_id in user_ids
+                if user_id in self.by_weekday
+            ])
+            for name, user_ids in self.groups.iteritems()
+        }
+
+    @derived('groups', 'by_weekday_start_end')
+    def groups_by_weekday_start_end(self):
+        """
+        Start and end times of groups' members grouped by weekday, see
+        utils.merge_weekdays_start_end().
+        """
+        return {
+            name: merge_weekdays_start_end([
+                self.by_weekday_start_end[user_id]
+                for user_id in user_ids
+                if user_id in self.by_weekday_start_end
+            ])
+            for name, user_ids in self.groups.iteritems()
+        }
+
+    @derived('groups', 'worktime_matrix')
+    def groups_by_month(self):
+        """
+        Total worktime of groups' members by month, see
+        utils.WorktimeMatrix.totals().
+        """
+        return {
+            name: self.worktime_matrix.totals(user_ids)
+            for name, user_ids in self.groups.iteritems()
+        }
+
+    @derived('xml')
+    def directory(self):
+        """
+        Users sorted by name for dropdown, see utils.user_directory().
+        """
+        return user_directory(self.users)
+
+    def month_by_date(self, year, month):
+        """
+        Returns worktime of users by date within given month.
+        """
+        if self.partitions is not None:
+            return self.partition_index(year, month, index_by_date)
+
+        return {
+            date: values
+            for date, values in self.by_date.iteritems()
+            if date.year == year and date.month == month
+        }
+
+    def intervals_for(self, date):
+        """
+        Returns interval index covering given date.
+        """
+        if self.partitions is not None:
+            return self.partition_index(
+                date.year, date.month, IntervalIndex
+            )
+        return self.intervals
+
+    def occupancy(self, resolution):
+        """
+        Returns occupancy_curves() at given resolution, computed once.
+        """
+        curves = self._occupancy.get(resolution)
+        if curves is None:
+            curves = occupancy_curves(self.data, resolution)
+            self._occupancy[resolution] = curves
+        return curves
+
+
+def carry_rolling(previous, snapshot):
+    """
+    Returns rolling stats of snapshot, extending previous ones of users
+    whose history only gained days after the last one.
+    """
+    result = {}
+    for user_id, items in snapshot.data.iteritems():
+        stats = previous.rolling.get(user_id)
+        before = previous.data.get(user_id, {})
+        if stats is not None and all(
+                items.get(date) == values
+                for date, values in before.iteritems()
+        ) and all(
+                date > stats.dates[-1]
+                for date in items if date not in before
+        ):
+            stats = stats.copy()
+            stats.extend(items)
+        else:
+            stats = rolling_stats(items)
+        result[user_id] = stats
+    return result
+
+
+def carry_sketches(previous, snapshot):
+    """
+    Returns start and end time sketches of snapshot, adding new days to
+    previous ones of users whose earlier entries didn't change.
+    """
+    result = {}
+    for user_id, items in snapshot.data.iteritems():
+        sketches = previous.sketches.get(user_id)
+        before = previous.data.get(user_id, {})
+        if sketches is not None and all(
+                items.get(date) == values
+                for date, values in before.iteritems()
+        ):
+            sketches = start_end_sketches(
+                {
+                    date: values
+                    for date, values in items.iteritems()
+                    if date not in before
+                },
+                base=sketches
+            )
+        else:
+            sketches = start_end_sketches(items)
+        result[user_id] = sketches
+    return result
+
+
+CARRIED = (
+    ('rolling', carry_rolling),
+    ('sketches', carry_sketches),
+)
+
+
+def carry_datasets(previous, snapshot):
+    """
+    Takes over datasets of previous snapshot whose inputs didn't change.
+    """
+    for name in DATASETS:
+        if (
+                name in previous.__dict__ and
+                input_version(previous, name) == input_version(snapshot, name)
+        ):
+            snapshot.__dict__[name] = previous.__dict__[name]
+            snapshot.stats[name] = previous.stats[name]
+    if 'data' in snapshot.__dict__:
+        snapshot.rejected = previous.rejected
+
+
+def build_snapshot(config, version, previous=None):
+    """
+    Builds a new snapshot of data files pointed by config.
+
+    Datasets and loaded partitions which didn't change are taken over from
+    previous one, so are its rolling stats when data only gained later days
+    and its time sketches when data only gained days.
+    """
+    signature = data_signature(config)
+    location = config['DATA_CSV']
+    shard = shard_filter(config)
+    partitions = None
+    if is_partitioned(location):
+        partitions = Partitions(
+            location,
+            config.get('DATA_PARTITION_ROWS', 500000),
+            previous.partitions if previous is not None else None,
+            shard,
+        )
+
+    inputs = dict(signature)
+    if previous is not None and previous.inputs['xml'] == inputs['xml']:
+        users = previous.users
+    else:
+        users = parse_xml_data(config['DATA_XML'])
+
+    if previous is not None and previous.inputs['groups'] == inputs['groups']:
+        groups = previous.groups
+    elif config.get('DATA_GROUPS'):
+        groups = parse_groups_json(config['DATA_GROUPS'])
+    else:
+        groups = None
+
+    snapshot = Snapshot(
+        version,
+        signature,
+        users,
+        location,
+        config.get('DATA_QUARANTINE'),
+        partitions,
+        shard,
+        groups,
+    )
+    if previous is not None:
+        carry_datasets(previous, snapshot)
+    for name, carry in CARRIED:
+        if (
+                partitions is None and previous is not None and
+                name in previous.__dict__ and
+                name not in snapshot.__dict__
+        ):
+            # Extend previous ones before warm() rebuilds them from scratch.
+            started = time.time()
+            dataset = carry(previous, snapshot)
+            snapshot.__dict__[name] = dataset
+            snapshot.stats[name] = {
+                'version': version,
+                'seconds': time.time() - started,
+                'size': len(dataset),
+            }
+    snapshot.warm()
+    return snapshot
+
+
+def snapshot_changes(old, new):
+    """
+    Describes what changed between two snapshots, eg:
+    {
+        'version': 3,
+        'users': [10, 12],
+        'months': [[2013, 10]],
+        'catalogue': [['2013 - October', 10, 2013], ...],
+    }
+    Users and months whose entries changed are None when either snapshot
+    has no whole history loaded.
+    """
+    users = months = None
+    if 'data' in old.__dict__ and 'data' in new.__dict__:
+        users, months = set(), set()
+        for user_id in set(old.data) | set(new.data):
+            before = old.data.get(user_id, {})
+            after = new.data.get(user_id, {})
+            for date in set(before) | set(after):
+                if before.get(date) != after.get(date):
+                    users.add(user_id)
+                    months.add((date.year, date.month))
+        users, months = sorted(users), sorted(months)
+
+    return {
+        'version': new.version,
+        'users': users,
+        'months': months,
+        'catalogue': new.months,
+    }
+
+
+class DataManager(object):
+    """
+    Owns current snapshot and rebuilds it when data files change.
+    """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.snapshot = None
+        self._build_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pinned = False
+        self._subscribers = set()
+        self._subscribers_lock = threading.Lock()
+
+    @property
+    def running(self):
+        """
+        Tells whether background reloader is alive.
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def signature(self):
+        """
+        Returns current signature of watched data files.
+        """
+        return data_signature(self.app.config)
+
+    def refresh(self, force=False):
+        """
+        Rebuilds and publishes snapshot if data files changed.
+
+        Returns True when a new snapshot was published.
+        """
+        with self._build_lock:
+            current = self.snapshot
+            if (
+                    not force and current is not None and
+                    current.signature == self.signature()
+            ):
+                return False
+
+            version = current.version + 1 if current is not None else 1
+            snapshot = build_snapshot(self.app.config, version, current)
+            self.snapshot = snapshot
+            log.info('Published data snapshot version %d', version)
+            if current is not None:
+                self.broadcast(snapshot_changes(current, snapshot))
+            return True
+
+    def subscribe(self):
+        """
+        Returns queue receiving snapshot_changes() of every published
+        snapshot and DISCONNECT when streams should end.
+        """
+        queue = Queue.Queue()
+        with self._subscribers_lock:
+            self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        """
+        Stops delivering events to queue returned by subscribe().
+        """
+        with self._subscribers_lock:
+            self._subscribers.discard(queue)
+
+    def broadcast(self, event):
+        """
+        Delivers event to every subscriber.
+        """
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers)
+        for queue in subscribers:
+            queue.put(event)
+
+    def disconnect(self):
+        """
+        Tells event streams of subscribers to end, eg. before worker exits.
+        """
+        self.broadcast(DISCONNECT)
+
+    def current(self):
+        """
+        Returns latest published snapshot.
+
+        Without a running reloader (tests, shell) files are checked inline,
+        unless snapshot is pinned.
+        """
+        if not self.running and not self._pinned:
+            self.refresh()
+        return self.snapshot
+
+    def pin(self):
+        """
+        Stops checking data files, current snapshot is served until process
+        exits. Used in forked workers whose master reloads data.
+        """
+        self._pinned = True
+
+    def start(self):
+        """
+        Builds first snapshot and starts background reloader.
+        """
+        if self.running:
+            return
+        self.refresh()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._watch,
+            name='presence-data-manager'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops background reloader.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _watch(self):
+        """
+        Reloader loop, polls data files every DATA_RELOAD_INTERVAL seconds.
+        """
+        interval = self.app.config.get('DATA_RELOAD_INTERVAL', 10)
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Data reload failed, keeping previous snapshot')
+
+
+data_manager = DataManager(app)  # pylint: disable=invalid-name
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Memory introspection helpers.
+
+Python 2 has no tracemalloc, so growth is tracked by counting live objects
+by type instead. Snapshots of the counts taken on demand can be diffed to
+see which types keep growing between requests.
+"""
+
+import gc
+import itertools
+import sys
+import threading
+import time
+import types
+from collections import Counter, OrderedDict
+
+# Shared by everything, not owned by the measured structure.
+SKIPPED_TYPES = (
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    types.MethodType,
+)
+
+
+def deep_size(obj):
+    """
+    Returns approximate bytes of obj and objects reachable from it.
+
+    Types, modules and functions are not followed. Objects shared with
+    other structures are counted in each of them.
+    """
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen or isinstance(item, SKIPPED_TYPES):
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        stack.extend(gc.get_referents(item))
+    return size
+
+
+def type_counts(ignored=()):
+    """
+    Returns Counter of live objects by type name.
+
+    Objects not tracked by garbage collector, eg. dates or strings, are
+    counted through containers referring to them. Ignored containers and
+    objects only they refer to are left out.
+    """
+    counts = Counter()
+    ignored_ids = set(id(obj) for obj in ignored)
+    seen = set(ignored_ids)
+    for obj in gc.get_objects():
+        if id(obj) in ignored_ids:
+            continue
+        for item in itertools.chain((obj,), gc.get_referents(obj)):
+            if id(item) not in seen:
+                seen.add(id(item))
+                counts[type(item).__name__] += 1
+    return counts
+
+
+class TypeSnapshots(object):
+    """
+    Numbered type_counts() snapshots, oldest dropped beyond limit.
+    """
+
+    def __init__(self, limit=10):
+        self.limit = limit
+        self.snapshots = OrderedDict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Takes snapshot and returns its id.
+        """
+        with self._lock:
+            previous = [counts for _, counts in self.snapshots.itervalues()]
+        counts = type_counts(previous)
+        with self._lock:
+            snapshot_id = self._next_id
+            self._next_id += 1
+            self.snapshots[snapshot_id] = (time.time(), counts)
+            while len(self.snapshots) > self.limit:
+                self.snapshots.popitem(last=False)
+        return snapshot_id
+
+    def diff(self, first, second, limit=20):
+        """
+        Returns types whose count changed the most between two snapshots,
+        eg. [('date', 1200, 5400), ('dict', 300, 310)] as (type, before,
+        after). Raises KeyError for unknown snapshot.
+        """
+        before = self.snapshots[first][1]
+        after = self.snapshots[second][1]
+        changes = [
+            (name, before[name], after[name])
+            for name in set(before) | set(after)
+            if before[name] != after[name]
+        ]
+        changes.sort(
+            key=lambda change: abs(change[2] - change[1]),
+            reverse=True
+        )
+        return changes[:limit]
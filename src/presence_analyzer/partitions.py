@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Partitioned presence data source.
+
+DATA_CSV may point to a directory of monthly CSV files, eg.
+presence-2013-09.csv, or to a glob matching them. A directory may contain
+manifest.json listing its partitions:
+{
+    "partitions": [
+        {"month": "2013-09", "file": "presence-2013-09.csv"},
+        {"month": "2013-10", "file": "presence-2013-10.csv"}
+    ]
+}
+otherwise month of every *.csv file is taken from its name. Files and
+manifest entries without a valid month are skipped. Rows dated outside of
+their partition's month are rejected as malformed.
+
+Partitions are parsed only when a query touches their month. Least recently
+used ones are dropped, together with indexes built of them, once rows loaded
+in total exceed a budget. Malformed rows found in every parsed partition are
+kept, see rejected_rows().
+
+The budget bounds month queries only. Whole history, which user charts need,
+is read by load_all() and kept by the snapshot until the next reload.
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from presence_analyzer.utils import file_signature, parse_data_csv
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MANIFEST = 'manifest.json'
+MONTH_PATTERN = re.compile(r'(\d{4})-(\d{2})')
+
+
+def is_partitioned(location):
+    """
+    Tells whether DATA_CSV location is a directory or glob of partitions.
+    """
+    return os.path.isdir(location) or glob.has_magic(location)
+
+
+def month_key(name):
+    """
+    Returns (year, month) found in name, eg. presence-2013-09.csv, or None.
+    """
+    match = MONTH_PATTERN.search(name or '')
+    if match is None:
+        return None
+    year, month = int(match.group(1)), int(match.group(2))
+    if not (year and 1 <= month <= 12):
+        return None
+    return year, month
+
+
+def discover(location):
+    """
+    Returns {(year, month): path} of partition files at location.
+    """
+    if os.path.isdir(location):
+        manifest = os.path.join(location, MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest, 'r') as manifest_file:
+                entries = json.load(manifest_file)['partitions']
+            result = {}
+            for entry in entries:
+                key = month_key(entry.get('month'))
+                if key is None or not entry.get('file'):
+                    log.warning('Skipped manifest entry %r', entry)
+                    continue
+                result[key] = os.path.join(location, entry['file'])
+            return result
+        pattern = os.path.join(location, '*.csv')
+    else:
+        pattern = location
+
+    result = {}
+    for path in glob.glob(pattern):
+        key = month_key(os.path.basename(path))
+        if key is None:
+            log.warning('Skipped %s, no valid month in its name', path)
+            continue
+        result[key] = path
+
+    return result
+
+
+def source_signature(location):
+    """
+    Returns tuple which changes whenever any file of data source changes.
+    """
+    if not is_partitioned(location):
+        return file_signature(location)
+
+    signature = [
+        (key, file_signature(path))
+        for key, path in sorted(discover(location).iteritems())
+    ]
+    manifest = os.path.join(location, MANIFEST)
+    if os.path.exists(manifest):
+        signature.append(file_signature(manifest))
+    return tuple(signature)
+
+
+class Partitions(object):
+    """
+    Monthly partitions of presence data loaded on demand.
+
+    If keep predicate is given, only rows of users it accepts are parsed.
+    """
+
+    def __init__(self, location, budget, previous=None, keep=None):
+        self.location = location
+        self.budget = budget
+        self.keep = keep
+        self.files = discover(location)
+        self.rows = 0
+        self._signatures = {
+            key: file_signature(path) for key, path in self.files.iteritems()
+        }
+        self._loaded = OrderedDict()
+        self._rejected = {}
+        self._lock = threading.Lock()
+
+        if previous is not None:
+            # Keep partitions which didn't change since previous snapshot.
+            for key, (data, rows, indexes) in previous.loaded_items():
+                if self._signatures.get(key) == previous.signature_of(key):
+                    self._loaded[key] = (data, rows, indexes)
+                    self.rows += rows
+            for key, rejected in previous.rejected_items():
+                if self._signatures.get(key) == previous.signature_of(key):
+                    self._rejected[key] = rejected
+
+    def signature_of(self, key):
+        """
+        Returns file signature of partition when it was discovered.
+        """
+        return self._signatures.get(key)
+
+    def loaded_items(self):
+        """
+        Returns ((year, month), (data, rows, indexes)) of loaded partitions.
+        """
+        with self._lock:
+            return self._loaded.items()
+
+    def rejected_items(self):
+        """
+        Returns ((year, month), rejected rows) of parsed partitions.
+        """
+        with self._lock:
+            return self._rejected.items()
+
+    def rejected_rows(self):
+        """
+        Returns malformed rows, as collected by utils.read_rows(), of every
+        partition parsed so far in order of months.
+        """
+        return [
+            row
+            for _, rejected in sorted(self.rejected_items())
+            for row in rejected
+        ]
+
+    def months(self):
+        """
+        Returns (year, month) of every partition, newest first.
+        """
+        return sorted(self.files, reverse=True)
+
+    def month(self, year, month):
+        """
+        Returns get_data() structure of given month, empty without partition.
+        """
+        key = (year, month)
+        if key not in self.files:
+            return {}
+
+        with self._lock:
+            if key in self._loaded:
+                entry = self._loaded.pop(key)
+                self._loaded[key] = entry
+                return entry[0]
+
+            rejected = []
+            data = parse_data_csv(self.files[key], rejected, self.keep, key)
+            self._rejected[key] = rejected
+            rows = sum(len(values) for values in data.itervalues())
+            self._loaded[key] = (data, rows, {})
+            self.rows += rows
+            while self.rows > self.budget and len(self._loaded) > 1:
+                evicted, entry = self._loaded.popitem(last=False)
+                self.rows -= entry[1]
+                log.debug('Evicted partition %d-%02d', *evicted)
+
+            return data
+
+    def month_index(self, year, month, build):
+        """
+        Returns build(month(year, month)), built once while the partition
+        stays loaded.
+        """
+        data = self.month(year, month)
+        with self._lock:
+            entry = self._loaded.get((year, month))
+        if entry is None or entry[0] is not data:
+            return build(data)
+
+        indexes = entry[2]
+        if build not in indexes:
+            indexes[build] = build(data)
+        return indexes[build]
+
+    def load_all(self):
+        """
+        Parses every partition into one get_data() structure.
+
+        Partitions are read one by one and not kept in the loaded ones.
+        """
+        data = {}
+        for key in sorted(self.files):
+            rejected = []
+            for user_id, values in parse_data_csv(
+                    self.files[key], rejected, self.keep, key
+            ).iteritems():
+                data.setdefault(user_id, {}).update(values)
+            with self._lock:
+                self._rejected[key] = rejected
+
+        return data
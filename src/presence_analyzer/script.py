@@ -2,14 +2,25 @@
 """Startup utilities"""
 # pylint:skip-file
 
+import ConfigParser
+import errno
+import gc
+import gzip
+import httplib
+import itertools
+import json
 import os
+import signal
+import socket
 import sys
-import urllib
+import tempfile
+import threading
+import time
+import urllib2
+from contextlib import closing
+from cStringIO import StringIO
 from functools import partial
 
-import paste.script.command
-import werkzeug.script
-
 etc = partial(os.path.join, 'parts', 'etc')
 
 DEPLOY_INI = etc('deploy.ini')
@@ -22,6 +33,7 @@ XML_PATH = os.path.join(
     'runtime',
     'data',
 )
+USERS_XML_URL = 'http://sargo.bolt.stxnext.pl/users.xml'
 
 _buildout_path = __file__
 for i in range(2 + __name__.count('.')):
@@ -31,14 +43,24 @@ abspath = partial(os.path.join, _buildout_path)
 del _buildout_path
 
 
-# bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+def _configure_app(config=DEPLOY_CFG, debug=False):
+    from presence_analyzer import get_app
+    app = get_app()
     app.config.from_pyfile(abspath(config))
     app.debug = debug
     return app
 
 
+# bin/paster serve parts/etc/deploy.ini
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+    from presence_analyzer.manager import data_manager
+    from presence_analyzer.views import compile_pages
+    app = _configure_app(config, debug)
+    data_manager.start()
+    compile_pages()
+    return app
+
+
 # bin/paster serve parts/etc/debug.ini
 def make_debug(global_conf={}, **conf):
     from werkzeug.debug import DebuggedApplication
@@ -46,6 +68,19 @@ def make_debug(global_conf={}, **conf):
     return DebuggedApplication(app, evalex=True)
 
 
+# bin/paster serve with "use = egg:presence_analyzer#router"
+def make_router(global_conf={}, config=DEPLOY_CFG):
+    """Routing app of sharded deployment, see presence_analyzer.sharding."""
+    from flask import Config
+    from presence_analyzer.sharding import make_router
+    settings = Config(abspath())
+    settings.from_pyfile(abspath(config))
+    return make_router(
+        settings['SHARD_NODES'],
+        settings.get('SHARD_TIMEOUT', 10),
+    )
+
+
 # bin/flask-ctl shell
 def make_shell():
     """Interactive Flask Shell"""
@@ -66,7 +101,7 @@ def _serve(action, debug=False, dry_run=False):
         argv += [action, '--daemon']
     elif action in ('', 'fg', 'foreground'):
         argv += ['--reload']
-    else:
+    elif action != 'run':
         argv += [action]
     # Print the 'paster' command
     print ' '.join(argv)
@@ -80,11 +115,319 @@ def _serve(action, debug=False, dry_run=False):
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
+    import paste.script.command
     paste.script.command.run()
 
 
+def _server_address(config=DEPLOY_INI):
+    """Read host and port of the paster server from 'config'."""
+    parser = ConfigParser.RawConfigParser()
+    parser.read(abspath(config))
+    return (
+        parser.get('server:main', 'host'),
+        parser.getint('server:main', 'port'),
+    )
+
+
+def _listen(address, backlog=1024):
+    """Bind a listening socket which forked workers accept from."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+    listener.listen(backlog)
+    return listener
+
+
+def _freeze_heap():
+    """Keep shared data pages clean in forked workers.
+
+    Collects garbage once and, where the interpreter supports it (Python
+    3.7+), moves all surviving objects to the permanent generation so
+    workers' collections never write to pages holding parsed data.
+    """
+    gc.collect()
+    freeze = getattr(gc, 'freeze', None)
+    if freeze is not None:
+        freeze()
+
+
+def _protect_shared_heap():
+    """Keep a forked worker's collections off pages shared with master.
+
+    Without gc.freeze() (Python 2) data parsed before fork sits in the
+    oldest generation, which only full collections traverse, so workers
+    practically stop running them. Young generations, holding objects of
+    requests, are still collected, but cyclic garbage which survives them
+    leaks until the worker exits. Workers are recycled after data reloads
+    and after WORKER_MAX_REQUESTS requests, see _limit_requests().
+    """
+    if getattr(gc, 'freeze', None) is None:
+        threshold0, threshold1, _ = gc.get_threshold()
+        gc.set_threshold(threshold0, threshold1, 2 ** 31 - 1)
+
+
+def _limit_requests(app, limit, stop):
+    """Wrap 'app' to call 'stop' once it got 'limit' requests, 0 is none."""
+    if not limit:
+        return app
+    served = itertools.count(1)
+
+    def limited(environ, start_response):
+        if next(served) == limit:
+            stop()
+        return app(environ, start_response)
+
+    return limited
+
+
+def _serve_worker(app, listener, max_requests=0, grace=30):
+    """Serve from threaded worker until SIGTERM or 'max_requests'.
+
+    On stop the worker accepts no more connections and lets requests in
+    progress finish for up to 'grace' seconds before returning.
+    """
+    server = make_prefork_server(app, listener)
+    stopping = []
+
+    def stop():
+        if not stopping:
+            stopping.append(True)
+            # shutdown() waits for serve_forever(), so not from its thread
+            thread = threading.Thread(target=server.shutdown)
+            thread.daemon = True
+            thread.start()
+
+    server.app = _limit_requests(app, max_requests, stop)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop())
+    server.serve_forever()
+
+    deadline = time.time() + grace
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join(max(deadline - time.time(), 0))
+
+
+def _fork_workers(count, serve, refresh=None, interval=10):
+    """Run 'serve' in 'count' forked processes, respawning dead ones.
+
+    With 'refresh' given master calls it every 'interval' seconds and
+    replaces all workers with fresh forks whenever it returns True. Old
+    workers get SIGTERM and finish their requests, see _serve_worker().
+    """
+    children = set()
+    retired = set()
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                serve()
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def terminate(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def recycle():
+        old = set(children)
+        retired.update(old)
+        for _ in range(count):
+            spawn()
+        for pid in old:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    for _ in range(count):
+        spawn()
+    next_refresh = time.time() + interval
+    while children:
+        try:
+            if refresh is None:
+                pid, status = os.wait()
+            else:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid == 0:
+            if not stopping and time.time() >= next_refresh:
+                if refresh():
+                    recycle()
+                next_refresh = time.time() + interval
+            time.sleep(min(interval, 1))
+            continue
+        children.discard(pid)
+        if pid in retired:
+            retired.discard(pid)
+        elif not stopping:
+            if status:
+                print 'worker {} exited with status {}, respawning'.format(
+                    pid, status
+                )
+            spawn()
+
+
+def make_prefork_server(app, listener):
+    """Build threaded WSGI server accepting connections from 'listener'."""
+    from werkzeug.serving import make_server
+    host, port = listener.getsockname()
+    return make_server(host, port, app, threaded=True, fd=listener.fileno())
+
+
+def make_async_server(app, listener):
+    """Build gevent WSGI server accepting connections from 'listener'.
+
+    Handlers run in a pool, so stop() can wait for them to finish.
+    """
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    from gevent.socket import fromfd
+    return WSGIServer(
+        fromfd(listener.fileno(), listener.family, listener.type),
+        app,
+        log=None,
+        spawn=Pool(),
+    )
+
+
+def _serve_async_worker(app, listener, max_requests=0, grace=30):
+    """Serve from gevent worker until SIGTERM or 'max_requests'.
+
+    On stop event streams are told to end, the worker accepts no more
+    connections and lets requests in progress finish for up to 'grace'
+    seconds before returning.
+    """
+    import gevent
+    from presence_analyzer.manager import data_manager
+    server = make_async_server(app, listener)
+    stopping = []
+
+    def stop():
+        if not stopping:
+            stopping.append(True)
+            data_manager.disconnect()
+            gevent.spawn(server.stop, grace)
+
+    server.application = _limit_requests(app, max_requests, stop)
+    signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+    signal_handler(signal.SIGTERM, stop)
+    server.serve_forever()
+
+
+def _refresh_workers(data_manager):
+    """Reload data in master, tell whether workers need replacing."""
+    try:
+        if not data_manager.refresh():
+            return False
+    except Exception as e:
+        print 'data reload failed, keeping workers: {}'.format(e)
+        return False
+    _freeze_heap()
+    return True
+
+
+def _serve_async(processes=1, dry_run=False):
+    """Serve deployment app from gevent servers in forked processes.
+
+    Reloads work as in _serve_prefork(), so data is parsed by master only
+    and never on a worker's hub serving connections.
+    """
+    address = _server_address()
+    print 'gevent serve {}:{} with {} processes'.format(
+        address[0], address[1], processes
+    )
+    if dry_run:
+        return
+    # Patch before the app is imported, so its locks and queues are
+    # gevent ones which yield to other greenlets instead of blocking
+    from gevent import monkey
+    monkey.patch_all()
+    from presence_analyzer.manager import data_manager
+    app = _configure_app()
+    # Greenlets make idle dashboard event streams cheap
+    app.config.setdefault('EVENTS_STREAM', True)
+    # Parse data once, workers share its pages copy-on-write
+    data_manager.refresh()
+    _freeze_heap()
+    listener = _listen(address)
+
+    def serve():
+        # Serve the inherited snapshot, master takes care of reloads
+        data_manager.pin()
+        _protect_shared_heap()
+        _serve_async_worker(
+            app,
+            listener,
+            app.config.get('WORKER_MAX_REQUESTS', 10000),
+            app.config.get('WORKER_GRACE', 30),
+        )
+
+    _fork_workers(
+        processes,
+        serve,
+        partial(_refresh_workers, data_manager),
+        app.config.get('DATA_RELOAD_INTERVAL', 10),
+    )
+
+
+def _serve_prefork(workers=4, dry_run=False):
+    """Serve deployment app from pre-forked threaded WSGI workers.
+
+    Master process alone watches data files. After a reload it forks a new
+    set of workers sharing the new snapshot and retires the old ones once
+    they finish their requests. Workers are also replaced after serving
+    WORKER_MAX_REQUESTS requests.
+    """
+    from presence_analyzer.manager import data_manager
+    address = _server_address()
+    print 'prefork serve {}:{} with {} workers'.format(
+        address[0], address[1], workers
+    )
+    if dry_run:
+        return
+    app = _configure_app()
+    # Parse data once, workers share its pages copy-on-write
+    data_manager.refresh()
+    _freeze_heap()
+    listener = _listen(address)
+
+    def serve():
+        # Serve the inherited snapshot, master takes care of reloads
+        data_manager.pin()
+        _protect_shared_heap()
+        _serve_worker(
+            app,
+            listener,
+            app.config.get('WORKER_MAX_REQUESTS', 10000),
+            app.config.get('WORKER_GRACE', 30),
+        )
+
+    _fork_workers(
+        workers,
+        serve,
+        partial(_refresh_workers, data_manager),
+        app.config.get('DATA_RELOAD_INTERVAL', 10),
+    )
+
+
 # bin/flask-ctl ...
 def run():
+    import werkzeug.script
+
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
     # bin/flask-ctl serve [fg|start|stop|restart|status]
@@ -95,7 +438,8 @@ def run():
         configuration file for the server and application.
 
         Options:
-         - 'action' is one of [fg|start|stop|restart|status]
+         - 'action' is one of [fg|run|start|stop|restart|status], 'run'
+           serves in foreground without reloader, eg. for load tests
          - '--dry-run' print the paster command and exit
         """
         _serve(action, debug=False, dry_run=dry_run)
@@ -105,6 +449,34 @@ def run():
         """Serve the debugging application."""
         _serve(action, debug=True, dry_run=dry_run)
 
+    # bin/flask-ctl async [--processes=N]
+    def action_async(processes=('p', 4), dry_run=False):
+        """Serve the application from gevent servers.
+
+        Every process handles its connections with greenlets instead of
+        paster's thread pool and all of them read the same data snapshot,
+        so concurrent dashboards don't cost a thread each.
+
+        Options:
+         - '--processes' number of worker processes
+         - '--dry-run' print the server address and exit
+        """
+        _serve_async(processes, dry_run=dry_run)
+
+    # bin/flask-ctl prefork [--workers=N]
+    def action_prefork(workers=('w', 4), dry_run=False):
+        """Serve the application from pre-forked worker processes.
+
+        Presence data is parsed once in the master process and shared with
+        forked workers copy-on-write, so adding cores doesn't add parses.
+        Workers which die are respawned.
+
+        Options:
+         - '--workers' number of worker processes
+         - '--dry-run' print the server address and exit
+        """
+        _serve_prefork(workers, dry_run=dry_run)
+
     # bin/flask-ctl status
     def action_status(dry_run=False):
         """Status of the application."""
@@ -118,17 +490,97 @@ def run():
     werkzeug.script.run()
 
 
-def download_xml():
+def _write_atomic(path, data):
+    """Replace file at path with data so readers never see a partial file.
+
+    The file keeps mode of the replaced one, new files get the usual mode
+    instead of mkstemp's owner-only 0600.
+    """
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0o7777
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.',
+        prefix='.{}.'.format(os.path.basename(path)),
+    )
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def sync_file(url, path, timeout=30):
+    """Download url into path unless it didn't change since last sync.
+
+    ETag and Last-Modified of the last download are kept in path + '.meta'
+    and sent back as validators. Returns True when path was replaced, which
+    the data manager picks up on its next poll.
     """
-    Downloads users.xml into data directory
+    meta_path = path + '.meta'
+    meta = {}
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path, 'r') as meta_file:
+            meta = json.load(meta_file)
+
+    request = urllib2.Request(url, headers={'Accept-Encoding': 'gzip'})
+    if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as e:
+        if e.code == httplib.NOT_MODIFIED:
+            return False
+        raise
+
+    with closing(response):
+        data = response.read()
+        headers = response.info()
+    if headers.get('Content-Encoding') == 'gzip':
+        data = gzip.GzipFile(fileobj=StringIO(data)).read()
+
+    changed = True
+    if os.path.exists(path):
+        with open(path, 'rb') as current:
+            changed = current.read() != data
+    if changed:
+        _write_atomic(path, data)
+
+    _write_atomic(meta_path, json.dumps({
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+    }))
+    return changed
+
+
+def download_xml(url=USERS_XML_URL, path=None):
+    """
+    Downloads users.xml into data directory if it changed
+
+    Console script entry point, returns exit status 1 when download failed
+    and None otherwise.
     """
+    path = path or abspath(XML_PATH, 'users.xml')
     try:
-        print 'downloading with urllib'
-        urllib.urlretrieve(
-            'http://sargo.bolt.stxnext.pl/users.xml',
-            '{}/{}'.format(XML_PATH, 'users.xml')
-        )
-    except URLError as e:
-        if e.code == 404:
+        changed = sync_file(url, path)
+    except urllib2.HTTPError as e:
+        if e.code == httplib.NOT_FOUND:
             print 'file not found'
-            pass
+            return 1
+        raise
+    except urllib2.URLError as e:
+        print 'download failed: {}'.format(e.reason)
+        return 1
+
+    print 'users.xml updated' if changed else 'users.xml is up to date'
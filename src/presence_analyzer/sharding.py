@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+User-sharded deployment.
+
+Every node lists base URLs of all nodes in SHARD_NODES and its own one in
+SHARD_NAME, eg:
+    SHARD_NODES = ['http://10.0.0.1:8080', 'http://10.0.0.2:8080']
+    SHARD_NAME = 'http://10.0.0.1:8080'
+Nodes read the same DATA_CSV but keep only users which consistent hashing
+assigns to them. Router forwards per-user API requests to the owning node
+and gathers cross-user ones from all nodes, merging partial results.
+
+Router serves dashboards as well: pages, static files and the users list
+come from any node, bootstrap data is put together from all nodes and
+avatars come from owners of users. It doesn't serve group, top, present,
+occupancy, worktime_matrix, export, datasets and admin endpoints, which
+need whole data of one node, and answers them with 404. Event stream isn't
+relayed either, router answers it with 204 No Content, which tells browsers
+to stop reconnecting.
+"""
+
+import bisect
+import hashlib
+import logging
+import re
+import threading
+import urllib
+import urllib2
+from contextlib import closing
+from json import dumps, loads
+
+from flask import Flask, Response, abort, request
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+PER_USER = re.compile(
+    r'^(mean_time_weekday|presence_weekday|presence_start_end|'
+    r'presence_start_end_percentiles|presence|rolling|avatar)/(\d+)$'
+)
+ANY_NODE = ('users',)
+BOOTSTRAP = re.compile(r'^bootstrap/(\w+)$')
+AVATAR_FILE = re.compile(r'^(\d+)-')
+RELAYED_HEADERS = (
+    'Cache-Control', 'ETag', 'Expires', 'Last-Modified', 'Location',
+)
+
+
+def hash_key(value):
+    """
+    Returns position of value on hash ring.
+    """
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of user ids onto nodes.
+
+    Every node takes many points on the ring, so adding or removing a node
+    moves only users of the ring segments it takes or gives up.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        points = sorted(
+            (hash_key('{}#{}'.format(node, i)), node)
+            for node in nodes
+            for i in range(replicas)
+        )
+        self.keys = [key for key, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node_for(self, user_id):
+        """
+        Returns node owning given user.
+        """
+        index = bisect.bisect(self.keys, hash_key(str(user_id)))
+        return self.nodes[index % len(self.nodes)]
+
+
+def shard_filter(config):
+    """
+    Returns predicate telling whether user belongs to this node, None when
+    sharding is off.
+    """
+    nodes = config.get('SHARD_NODES')
+    if not nodes:
+        return None
+
+    ring = HashRing(nodes)
+    name = config['SHARD_NAME']
+    return lambda user_id: ring.node_for(user_id) == name
+
+
+def merge_top_five(results):
+    """
+    Merges top_five lists of nodes into overall top 5.
+
+    Every user is counted by one node only, so overall top 5 is among
+    nodes' ones.
+    """
+    merged = [item for result in results for item in result]
+    merged.sort(key=lambda item: item[1], reverse=True)
+    return merged[:5]
+
+
+def merge_months(results):
+    """
+    Merges years_and_months catalogues of nodes, newest first.
+    """
+    months = {}
+    for result in results:
+        for label, month, year in result:
+            months[(year, month)] = [label, month, year]
+    return [months[key] for key in sorted(months, reverse=True)]
+
+
+GATHERED = (
+    (re.compile(r'^top_five/\d+/\d+$'), merge_top_five),
+    (re.compile(r'^years_and_months/$'), merge_months),
+)
+
+
+class KeepRedirects(urllib2.HTTPRedirectHandler):
+    """
+    Leaves redirects of nodes to be relayed to the client.
+    """
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+OPENER = urllib2.build_opener(KeepRedirects)
+
+
+def fetch(url, timeout):
+    """
+    Returns (status, headers, body) of GET request to url, redirects aren't
+    followed.
+    """
+    try:
+        with closing(OPENER.open(url, timeout=timeout)) as resp:
+            return resp.getcode(), resp.info(), resp.read()
+    except urllib2.HTTPError as e:
+        return e.code, e.info(), e.read()
+
+
+def make_router(nodes, timeout=10):
+    """
+    Returns WSGI app routing dashboard and API requests to nodes.
+    """
+    # pylint: disable=too-many-locals
+    router = Flask(__name__, static_folder=None)
+    ring = HashRing(nodes)
+    ring_nodes = sorted(set(nodes))
+
+    def node_url(node, path, query_string=None):
+        """
+        Returns URL of path at node, with current query string by default.
+        """
+        if query_string is None:
+            query_string = request.query_string
+        url = '{}/{}'.format(node.rstrip('/'), path)
+        if query_string:
+            url += '?' + query_string
+        return url
+
+    def forward(node, path):
+        """
+        Relays request to single node.
+        """
+        try:
+            status, headers, body = fetch(node_url(node, path), timeout)
+        except (urllib2.URLError, IOError):
+            log.warning('Node %s unavailable', node, exc_info=True)
+            abort(502)
+
+        response = Response(
+            body, status=status, content_type=headers.get('Content-Type')
+        )
+        for name in RELAYED_HEADERS:
+            if name in headers:
+                response.headers[name] = headers[name]
+        location = response.headers.get('Location', '')
+        if location.startswith(node.rstrip('/') + '/'):
+            # Keep client on the router.
+            response.headers['Location'] = location[len(node.rstrip('/')):]
+        return response
+
+    def collect(path, query_string=None):
+        """
+        Sends API request to every node in parallel, returns their decoded
+        results.
+
+        Aborts with status of a node which refused the request or with 502
+        when some node is unavailable.
+        """
+        urls = [
+            node_url(node, 'api/v1/' + path, query_string)
+            for node in ring_nodes
+        ]
+        results = [None] * len(urls)
+        statuses = [None] * len(urls)
+
+        def call(index):
+            """
+            Stores status and decoded result of one node.
+            """
+            try:
+                status, _, body = fetch(urls[index], timeout)
+                if status == 200:
+                    results[index] = loads(body)
+                statuses[index] = status
+            except (urllib2.URLError, IOError, ValueError):
+                log.warning('Node %s unavailable', urls[index], exc_info=True)
+
+        threads = [
+            threading.Thread(target=call, args=(index,))
+            for index in range(len(urls))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for status in statuses:
+            if status is not None and 400 <= status < 500:
+                abort(status)
+        if None in results:
+            abort(502)
+        return results
+
+    def gather(path, merge):
+        """
+        Sends request to every node and merges results.
+        """
+        return Response(
+            dumps(merge(collect(path))), mimetype='application/json'
+        )
+
+    def bootstrap(page):
+        """
+        Puts together bootstrap data of dashboard page from all nodes.
+
+        Months are merged. User pages show chart of selected user made by
+        its owner, by default the first user in directory which any node
+        has data of. Top five page merges top fives of nodes for selected
+        month, by default the newest month of all nodes.
+        """
+        query = request.args.to_dict()
+        if page == 'top_five_by_month' and not (
+                'year' in query and 'month' in query
+        ):
+            months = merge_months(collect('years_and_months/', ''))
+            if months:
+                _, query['month'], query['year'] = months[0]
+        results = collect('bootstrap/' + page, urllib.urlencode(query))
+
+        # Users come from the same users file on every node.
+        merged = dict(results[0])
+        merged['version'] = max(result['version'] for result in results)
+        merged['months'] = merge_months(
+            [result['months'] for result in results]
+        )
+        if page == 'top_five_by_month':
+            if merged['selected'] is not None:
+                merged['view'] = merge_top_five(
+                    [result['view'] or [] for result in results]
+                )
+            return Response(dumps(merged), mimetype='application/json')
+
+        user_id = request.args.get('user_id', type=int)
+        if user_id is not None:
+            chosen = results[ring_nodes.index(ring.node_for(user_id))]
+        else:
+            order = {
+                user['user_id']: index
+                for index, user in enumerate(merged['users'])
+            }
+            chosen = min(
+                results,
+                key=lambda result: order.get(result['selected'], len(order))
+            )
+        merged['selected'] = chosen['selected']
+        merged['view'] = chosen['view']
+        return Response(dumps(merged), mimetype='application/json')
+
+    @router.route('/api/v1/<path:path>', methods=['GET'])
+    def route(path):  # pylint: disable=unused-variable
+        """
+        Forwards or scatters API request.
+        """
+        match = PER_USER.match(path)
+        if match is not None:
+            owner = ring.node_for(int(match.group(2)))
+            return forward(owner, 'api/v1/' + path)
+        if path in ANY_NODE:
+            return forward(ring_nodes[0], 'api/v1/' + path)
+        match = BOOTSTRAP.match(path)
+        if match is not None:
+            return bootstrap(match.group(1))
+        for pattern, merge in GATHERED:
+            if pattern.match(path):
+                return gather(path, merge)
+        if path == 'events':
+            return Response(status=204)
+        abort(404)
+
+    @router.route('/avatars/<string:name>', methods=['GET'])
+    def avatar(name):  # pylint: disable=unused-variable
+        """
+        Forwards request of cached avatar to owner of user.
+        """
+        match = AVATAR_FILE.match(name)
+        if match is None:
+            abort(404)
+        return forward(ring.node_for(int(match.group(1))), 'avatars/' + name)
+
+    @router.route('/', defaults={'path': ''}, methods=['GET'])
+    @router.route('/<path:path>', methods=['GET'])
+    def page(path):  # pylint: disable=unused-variable
+        """
+        Forwards request of page or static file to any node.
+        """
+        return forward(ring_nodes[0], path)
+
+    return router
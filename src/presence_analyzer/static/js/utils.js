@@ -4,9 +4,74 @@ function parseInterval(value) {
     return result;
 }
 
+var preloadedViews = {};
+
+function bootstrapPage(pageName, viewUrl, callback) {
+    return $.getJSON('/api/v1/bootstrap/' + pageName, function (result) {
+        if (result.selected !== null && result.view !== null) {
+            preloadedViews[viewUrl(result.selected)] = result.view;
+        }
+        callback(result);
+    });
+}
+
+function getViewJSON(url, callback) {
+    var data = preloadedViews[url],
+        deferred;
+
+    if (data === undefined) {
+        return $.getJSON(url, callback);
+    }
+
+    delete preloadedViews[url];
+    deferred = $.Deferred();
+    deferred.success = deferred.done;
+    deferred.error = deferred.fail;
+    deferred.complete = deferred.always;
+
+    return deferred.done(callback).resolve(data);
+}
+
+function avatarUrl(userId) {
+    return '/api/v1/avatar/' + userId;
+}
+
 function avatarLoad(src, $avatar) {
     src = src || '';
     $avatar = $avatar || $('#avatar');
 
     return $avatar.attr('src', src);
 }
+
+function subscribeUpdates(callback) {
+    var source,
+        version = null;
+
+    // Streams hold a server thread each unless served by gevent workers.
+    if (!window.EventSource || !window.eventsStream) {
+        return null;
+    }
+
+    source = new EventSource('/api/v1/events');
+    source.addEventListener('version', function (event) {
+        var current = JSON.parse(event.data);
+
+        // Reconnected to a worker forked after reload, changes are unknown.
+        if (version !== null && current > version) {
+            callback({version: current, users: null, months: null});
+        }
+        version = current;
+    });
+    source.addEventListener('update', function (event) {
+        var update = JSON.parse(event.data);
+
+        version = update.version;
+        callback(update);
+    });
+
+    return source;
+}
+
+function userChanged(update, userId) {
+    return update.users === null || $.inArray(parseInt(userId, 10), update.users) !== -1;
+}
@@ -4,13 +4,49 @@ Presence analyzer unit tests.
 """
 from __future__ import unicode_literals
 
+import BaseHTTPServer
 import datetime
+import gc
+import gzip
 import httplib
 import json
+import math
 import os.path
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from cStringIO import StringIO
+
+from flask import Response, abort
+from werkzeug.exceptions import NotFound
+
+from presence_analyzer import (
+    avatars,
+    loadtest,
+    main,
+    manager,
+    memory,
+    partitions,
+    script,
+    sharding,
+    utils,
+    views
+)
+
+try:
+    import gevent
+except ImportError:
+    gevent = None  # pylint: disable=invalid-name
 
-from presence_analyzer import main, utils, views
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # pylint: disable=invalid-name
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(os.path.abspath(__file__)),
@@ -21,6 +57,15 @@ TEST_DATA_CSV = os.path.join(
     'test_data.csv',
 )
 
+DIRTY_DATA_CSV = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '..',
+    '..',
+    'runtime',
+    'data',
+    'dirty_data.csv',
+)
+
 TEST_DATA_XML = os.path.join(
     os.path.dirname(os.path.abspath(__file__)),
     '..',
@@ -30,6 +75,45 @@ TEST_DATA_XML = os.path.join(
     'users.xml',
 )
 
+TEST_DATA_GROUPS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '..',
+    '..',
+    'runtime',
+    'data',
+    'groups.json',
+)
+
+HEAVY_MODULES = ('flask', 'mako', 'lxml', 'werkzeug', 'paste', 'gevent')
+
+# Seconds importing the whole app may take on top of importing Flask alone,
+# measured around 0.06 s.
+IMPORT_BUDGET = 0.15
+
+
+def import_in_subprocess(module):
+    """
+    Imports module in a fresh interpreter.
+
+    Returns import time in seconds and heavy dependencies it loaded.
+    """
+    code = (
+        'import json, sys, time\n'
+        'preloaded = set(sys.modules)\n'
+        'start = time.time()\n'
+        'import {}\n'
+        'elapsed = time.time() - start\n'
+        'print json.dumps([elapsed, sorted(set(\n'
+        '    name.split(".")[0] for name in set(sys.modules) - preloaded\n'
+        '    if name.split(".")[0] in {!r}\n'
+        '))])\n'
+    ).format(module, HEAVY_MODULES)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)
+    )))
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+    return json.loads(output)
+
 
 # pylint: disable=maybe-no-member, too-many-public-methods
 class PresenceAnalyzerViewsTestCase(unittest.TestCase):
@@ -257,6 +341,593 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(page_not_found.status_code, httplib.NOT_FOUND)
         self.assertTrue('Not Found' in page_not_found.get_data(as_text=True))
 
+    def test_static_page_cache(self):
+        """
+        Test rendered pages are cached and revalidated with ETags.
+        """
+        resp = self.client.get('/presence_weekday')
+        etag = resp.headers['ETag']
+        cached = self.client.get('/presence_weekday')
+        not_modified = self.client.get(
+            '/presence_weekday',
+            headers={'If-None-Match': etag}
+        )
+
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertIn((u'', 'presence_weekday'), views.PAGE_CACHE)
+        self.assertEqual(cached.headers['ETag'], etag)
+        self.assertEqual(cached.get_data(), resp.get_data())
+        self.assertEqual(not_modified.status_code, httplib.NOT_MODIFIED)
+        self.assertEqual(not_modified.get_data(), '')
+
+        self.client.get('/page_not_exist')
+        self.assertIn('page_not_exist', views.MISSING_PAGES)
+        render_template, views.render_template = views.render_template, None
+        try:
+            resp = self.client.get('/page_not_exist')
+        finally:
+            views.render_template = render_template
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+
+    def test_compile_pages(self):
+        """
+        Test page templates are rendered ahead of first request.
+        """
+        views.PAGE_CACHE.clear()
+        views.compile_pages()
+
+        self.assertIn(('', 'mean_time_weekday'), views.PAGE_CACHE)
+        self.assertIn(('', 'presence_start_end'), views.PAGE_CACHE)
+
+    def test_bootstrap(self):
+        """
+        Test page bootstrap with users, months and default view.
+        """
+        weekday = json.loads(
+            self.client.get('/api/v1/bootstrap/presence_weekday').data
+        )
+        start_end = json.loads(self.client.get(
+            '/api/v1/bootstrap/presence_start_end?user_id=11'
+        ).data)
+        top = json.loads(
+            self.client.get('/api/v1/bootstrap/top_five_by_month').data
+        )
+
+        self.assertEqual(len(weekday['users']), 84)
+        self.assertEqual(weekday['months'], [['2013 - September', 9, 2013]])
+        self.assertIn(weekday['selected'], [10, 11])
+        self.assertEqual(
+            weekday['view'],
+            json.loads(self.client.get(
+                '/api/v1/presence_weekday/{}'.format(weekday['selected'])
+            ).data)
+        )
+        self.assertEqual(start_end['selected'], 11)
+        self.assertEqual(
+            start_end['view'],
+            json.loads(self.client.get('/api/v1/presence_start_end/11').data)
+        )
+        self.assertEqual(top['selected'], '2013-9')
+        self.assertEqual(top['view'], [[11, 118402], [10, 78217]])
+        self.assertEqual(top['version'], weekday['version'])
+
+        missing = json.loads(self.client.get(
+            '/api/v1/bootstrap/presence_weekday?user_id=1'
+        ).data)
+        self.assertIsNone(missing['view'])
+        self.assertEqual(
+            self.client.get('/api/v1/bootstrap/page_not_exist').status_code,
+            httplib.NOT_FOUND
+        )
+
+    def test_worktime_matrix(self):
+        """
+        Test users x months worktime matrix endpoint.
+        """
+        resp = self.client.get('/api/v1/worktime_matrix')
+        sparse = self.client.get(
+            '/api/v1/worktime_matrix?users=11,12&to=2013-09&encoding=sparse'
+        )
+        not_modified = self.client.get(
+            '/api/v1/worktime_matrix',
+            headers={'If-None-Match': resp.headers['ETag']}
+        )
+
+        self.assertEqual(
+            json.loads(resp.data),
+            {
+                'users': [10, 11],
+                'months': ['2013-09'],
+                'rows': [[78217], [118402]],
+            }
+        )
+        self.assertNotIn(' ', resp.data)
+        self.assertEqual(
+            json.loads(sparse.data),
+            {'users': [11], 'months': ['2013-09'], 'rows': [[0, 118402]]}
+        )
+        self.assertNotEqual(sparse.headers['ETag'], resp.headers['ETag'])
+        self.assertEqual(not_modified.status_code, httplib.NOT_MODIFIED)
+        for query in ('users=x', 'from=2013', 'encoding=xml'):
+            self.assertEqual(
+                self.client.get(
+                    '/api/v1/worktime_matrix?' + query
+                ).status_code,
+                httplib.BAD_REQUEST
+            )
+
+    def test_rolling(self):
+        """
+        Test moving means time series.
+        """
+        resp = self.client.get('/api/v1/rolling/10?window=7&from=2013-09-11')
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(data['dates'], ['2013-09-11', '2013-09-12'])
+        self.assertEqual(data['series'].keys(), ['7'])
+        self.assertEqual(data['series']['7']['worktime'][0], 27256.0)
+        self.assertEqual(data['series']['7']['start'][0], 34168.5)
+        self.assertEqual(
+            sorted(json.loads(
+                self.client.get('/api/v1/rolling/11').data
+            )['series']),
+            ['30', '7', '90']
+        )
+        self.assertEqual(
+            self.client.get('/api/v1/rolling/10?window=14').status_code,
+            httplib.BAD_REQUEST
+        )
+        self.assertEqual(
+            self.client.get('/api/v1/rolling/1').status_code,
+            httplib.NOT_FOUND
+        )
+
+    def test_datasets(self):
+        """
+        Test report of derived datasets.
+        """
+        datasets = {
+            dataset['name']: dataset
+            for dataset in json.loads(
+                self.client.get('/api/v1/datasets').data
+            )
+        }
+
+        self.assertEqual(datasets['data']['inputs'], ['csv'])
+        self.assertEqual(datasets['directory']['inputs'], ['xml'])
+        self.assertTrue(datasets['by_date']['built'])
+        self.assertEqual(datasets['by_date']['size'], 6)
+        self.assertGreaterEqual(datasets['by_date']['seconds'], 0)
+        self.assertIn('rolling', datasets)
+
+    def test_groups(self):
+        """
+        Test group endpoints mirroring user ones over merged members.
+        """
+        resp = self.client.get('/api/v1/group/mean_time_weekday/backend')
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+
+        main.app.config['DATA_GROUPS'] = TEST_DATA_GROUPS
+        try:
+            groups = json.loads(self.client.get('/api/v1/groups').data)
+            self.assertEqual(groups, [
+                {'name': 'backend', 'user_ids': [10, 11, 12, 13]},
+                {'name': 'frontend', 'user_ids': [11, 14, 15]},
+            ])
+
+            # Only user 11 of frontend has presence data.
+            for page in ('mean_time_weekday', 'presence_start_end'):
+                self.assertEqual(
+                    self.client.get(
+                        '/api/v1/group/{}/frontend'.format(page)
+                    ).data,
+                    self.client.get('/api/v1/{}/11'.format(page)).data,
+                )
+
+            backend = json.loads(self.client.get(
+                '/api/v1/group/presence_weekday/backend'
+            ).data)
+            user_10, user_11 = [
+                json.loads(self.client.get(
+                    '/api/v1/presence_weekday/{}'.format(user_id)
+                ).data)
+                for user_id in (10, 11)
+            ]
+            self.assertEqual(backend[0], ['Weekday', 'Presence (s)'])
+            self.assertEqual(
+                backend[1:],
+                [
+                    [day, first + second]
+                    for (day, first), (_, second) in zip(
+                        user_10[1:], user_11[1:]
+                    )
+                ]
+            )
+
+            resp = self.client.get('/api/v1/group/worktime_by_month/backend')
+            self.assertEqual(json.loads(resp.data), [['2013-09', 196619]])
+
+            resp = self.client.get('/api/v1/group/presence_weekday/nobody')
+            self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+        finally:
+            del main.app.config['DATA_GROUPS']
+
+    def test_admin_memory(self):
+        """
+        Test memory report and type snapshots behind admin token.
+        """
+        main.app.config.pop('ADMIN_TOKEN', None)
+        resp = self.client.get('/api/v1/admin/memory')
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+
+        main.app.config['ADMIN_TOKEN'] = 'secret'
+        try:
+            resp = self.client.get(
+                '/api/v1/admin/memory', headers={'X-Admin-Token': 'wrong'}
+            )
+            self.assertEqual(resp.status_code, httplib.FORBIDDEN)
+            resp = self.client.get('/api/v1/admin/memory')
+            self.assertEqual(resp.status_code, httplib.FORBIDDEN)
+
+            headers = {'X-Admin-Token': 'secret'}
+            self.client.get('/api/v1/mean_time_weekday/10')
+            report = json.loads(
+                self.client.get('/api/v1/admin/memory', headers=headers).data
+            )
+            caches = {cache['name']: cache for cache in report['caches']}
+            self.assertGreater(caches['utils.cache']['bytes'], 0)
+            datasets = {
+                dataset['name']: dataset for dataset in report['datasets']
+            }
+            self.assertGreater(datasets['data']['bytes'], 0)
+            self.assertEqual(len(report['gc']), 3)
+
+            first = json.loads(self.client.post(
+                '/api/v1/admin/memory/snapshots', headers=headers
+            ).data)['id']
+            garbage = [datetime.date(2013, 9, 10) for _ in range(1000)]
+            second = json.loads(self.client.post(
+                '/api/v1/admin/memory/snapshots', headers=headers
+            ).data)['id']
+            resp = self.client.get(
+                '/api/v1/admin/memory/snapshots/{}/{}?limit=1000'.format(
+                    first, second
+                ),
+                headers=headers
+            )
+            self.assertEqual(resp.status_code, httplib.OK)
+            changes = {
+                name: after - before
+                for name, before, after in json.loads(resp.data)
+            }
+            self.assertGreaterEqual(changes['date'], 1000)
+            del garbage
+
+            resp = self.client.get(
+                '/api/v1/admin/memory/snapshots/{}/0'.format(first),
+                headers=headers
+            )
+            self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+        finally:
+            del main.app.config['ADMIN_TOKEN']
+
+    def test_export_intervals_csv(self):
+        """
+        Test streamed CSV export of presence entries.
+        """
+        resp = self.client.get('/api/v1/export/intervals.csv?user_id=10')
+
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertEqual(
+            resp.get_data(as_text=True).splitlines(),
+            [
+                'user_id,date,start,end,worktime',
+                '10,2013-09-10,09:39:05,17:59:52,30047',
+                '10,2013-09-11,09:19:52,16:07:37,24465',
+                '10,2013-09-12,10:48:46,17:23:51,23705',
+            ]
+        )
+
+    def test_export_monthly_ndjson(self):
+        """
+        Test streamed NDJSON export of monthly totals with date range.
+        """
+        resp = self.client.get(
+            '/api/v1/export/monthly.ndjson?from=2013-09-10&to=2013-09-11'
+        )
+        data = [
+            json.loads(line)
+            for line in resp.get_data(as_text=True).splitlines()
+        ]
+
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertEqual(
+            data,
+            [
+                {
+                    'user_id': 10, 'year': 2013, 'month': 9,
+                    'worktime': 54512, 'days': 2,
+                },
+                {
+                    'user_id': 11, 'year': 2013, 'month': 9,
+                    'worktime': 41885, 'days': 2,
+                },
+            ]
+        )
+
+    def test_export_wrong_parameters(self):
+        """
+        Test export with unknown format and malformed date.
+        """
+        wrong_format = self.client.get('/api/v1/export/intervals.xls')
+        wrong_date = self.client.get('/api/v1/export/intervals.csv?from=x')
+
+        self.assertEqual(wrong_format.status_code, httplib.NOT_FOUND)
+        self.assertEqual(wrong_date.status_code, httplib.BAD_REQUEST)
+
+    def test_presence_days_pages(self):
+        """
+        Test cursor pagination of user's presence entries.
+        """
+        first = self.client.get('/api/v1/presence/11?limit=4')
+        first_data = json.loads(first.data)
+
+        self.assertEqual(first.status_code, httplib.OK)
+        self.assertEqual(
+            [item['date'] for item in first_data['items']],
+            ['2013-09-05', '2013-09-09', '2013-09-10', '2013-09-11'],
+        )
+        self.assertDictEqual(
+            first_data['items'][0],
+            {
+                'date': '2013-09-05',
+                'start': '09:28:08',
+                'end': '15:51:27',
+                'worktime': 22999,
+            }
+        )
+        self.assertEqual(first_data['next'], '2013-09-11')
+
+        second = self.client.get(
+            '/api/v1/presence/11?limit=4&after=' + first_data['next']
+        )
+        second_data = json.loads(second.data)
+
+        self.assertEqual(
+            [item['date'] for item in second_data['items']],
+            ['2013-09-12', '2013-09-13'],
+        )
+        self.assertIsNone(second_data['next'])
+
+    def test_presence_days_wrong_parameters(self):
+        """
+        Test pagination of unknown user and with wrong page size.
+        """
+        not_found = self.client.get('/api/v1/presence/1')
+        wrong_limit = self.client.get('/api/v1/presence/10?limit=0')
+
+        self.assertEqual(not_found.status_code, httplib.NOT_FOUND)
+        self.assertEqual(wrong_limit.status_code, httplib.BAD_REQUEST)
+
+    def test_top_worktime_periods(self):
+        """
+        Test top k users in calendar periods and custom date range.
+        """
+        month = json.loads(self.client.get('/api/v1/top/month/2013/9').data)
+        quarter = json.loads(
+            self.client.get('/api/v1/top/quarter/2013/3?k=1').data
+        )
+        week = json.loads(self.client.get('/api/v1/top/week/2013/37').data)
+        custom = json.loads(
+            self.client.get('/api/v1/top?from=2013-09-12&to=2013-09-13').data
+        )
+        empty = json.loads(self.client.get('/api/v1/top/year/2012').data)
+
+        self.assertEqual(month, [[11, 118402], [10, 78217]])
+        self.assertEqual(quarter, [[11, 118402]])
+        self.assertEqual(week, [[11, 95403], [10, 78217]])
+        self.assertEqual(custom, [[11, 29395], [10, 23705]])
+        self.assertEqual(empty, [])
+
+    def test_top_worktime_wrong_parameters(self):
+        """
+        Test top k with unknown period, missing range and wrong k.
+        """
+        self.assertEqual(
+            self.client.get('/api/v1/top/decade/2010').status_code,
+            httplib.NOT_FOUND
+        )
+        self.assertEqual(
+            self.client.get('/api/v1/top/month/2013/13').status_code,
+            httplib.NOT_FOUND
+        )
+        self.assertEqual(
+            self.client.get('/api/v1/top?from=2013-09-12').status_code,
+            httplib.BAD_REQUEST
+        )
+        self.assertEqual(
+            self.client.get(
+                '/api/v1/top?from=2013-09-15&to=2013-09-01'
+            ).status_code,
+            httplib.BAD_REQUEST
+        )
+        resp = self.client.get('/api/v1/top?from=2013-09-01&to=9999-12-31')
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(json.loads(resp.data), [[11, 118402], [10, 78217]])
+        self.assertEqual(
+            self.client.get('/api/v1/top/year/2013?k=0').status_code,
+            httplib.BAD_REQUEST
+        )
+
+    def test_occupancy_page(self):
+        """
+        Test office occupancy page header.
+        """
+        resp = self.client.get('/occupancy')
+
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertIn('Office occupancy by weekday', resp.data)
+
+    def test_occupancy_date(self):
+        """
+        Test number of people present during given date.
+        """
+        resp = self.client.get('/api/v1/occupancy/date/2013-09-10')
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(len(data), 25)
+        self.assertEqual(data[0], ['Time', 'Present'])
+        self.assertEqual(
+            [count for label, count in data[9:20]],
+            [0, 0, 2, 2, 2, 2, 1, 1, 1, 1, 0]
+        )
+        self.assertEqual(data[10], ['09:00', 0])
+
+    def test_occupancy_weekday(self):
+        """
+        Test mean number of people present by weekday.
+        """
+        resp = self.client.get('/api/v1/occupancy/weekday?resolution=1800')
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(
+            data[0], ['Time', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+        )
+        self.assertEqual(len(data), 49)
+        self.assertEqual(data[21], ['10:00', 1, 2, 2, 0.5, 0, 0, 0])
+
+    def test_occupancy_wrong_parameters(self):
+        """
+        Test occupancy with wrong resolution and dates without data.
+        """
+        self.assertEqual(
+            self.client.get(
+                '/api/v1/occupancy/weekday?resolution=7'
+            ).status_code,
+            httplib.BAD_REQUEST
+        )
+        self.assertEqual(
+            self.client.get('/api/v1/occupancy/date/2013-09-14').status_code,
+            httplib.NOT_FOUND
+        )
+        self.assertEqual(
+            self.client.get('/api/v1/occupancy/date/today').status_code,
+            httplib.NOT_FOUND
+        )
+
+    def test_present_at(self):
+        """
+        Test users present at given moment.
+        """
+        resp = self.client.get('/api/v1/present/2013-09-10?at=10:00')
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(
+            data,
+            [
+                {
+                    'user_id': 11,
+                    'name': 'Maciej D.',
+                    'start': '09:19:50',
+                    'end': '13:55:54',
+                },
+                {
+                    'user_id': 10,
+                    'name': 'Maciej Z.',
+                    'start': '09:39:05',
+                    'end': '17:59:52',
+                },
+            ]
+        )
+
+        late = json.loads(
+            self.client.get('/api/v1/present/2013-09-10?at=15:00:00').data
+        )
+        self.assertEqual([user['user_id'] for user in late], [10])
+
+    def test_present_during(self):
+        """
+        Test users present during given window.
+        """
+        morning = json.loads(
+            self.client.get(
+                '/api/v1/present/2013-09-10?from=09:00&to=09:20'
+            ).data
+        )
+        afternoon = json.loads(
+            self.client.get(
+                '/api/v1/present/2013-09-10?from=13:56&to=14:00'
+            ).data
+        )
+        holiday = json.loads(
+            self.client.get('/api/v1/present/2013-09-14?at=10:00').data
+        )
+
+        self.assertEqual([user['user_id'] for user in morning], [11])
+        self.assertEqual([user['user_id'] for user in afternoon], [10])
+        self.assertEqual(holiday, [])
+
+    def test_present_wrong_parameters(self):
+        """
+        Test presence query without time, with malformed time and date.
+        """
+        self.assertEqual(
+            self.client.get('/api/v1/present/2013-09-10').status_code,
+            httplib.BAD_REQUEST
+        )
+        self.assertEqual(
+            self.client.get('/api/v1/present/2013-09-10?at=25:00').status_code,
+            httplib.BAD_REQUEST
+        )
+        self.assertEqual(
+            self.client.get('/api/v1/present/tomorrow?at=10:00').status_code,
+            httplib.NOT_FOUND
+        )
+
+    def test_start_end_percentiles(self):
+        """
+        Test percentiles of start and end of work by weekday.
+        """
+        resp = self.client.get('/api/v1/presence_start_end_percentiles/11')
+        data = json.loads(resp.data)
+
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(data[0], ['Mon', [33150, 33150], [57270, 57270]])
+        self.assertEqual(data[1], ['Tue', [33570, 33570], [50130, 50130]])
+        self.assertEqual(data[3], ['Thu', [34110, 37110], [57090, 60090]])
+        self.assertEqual(data[6], ['Sun', [0, 0], [0, 0]])
+
+        median = json.loads(
+            self.client.get(
+                '/api/v1/presence_start_end_percentiles/11?q=50'
+            ).data
+        )
+        self.assertEqual(median[3], ['Thu', [34110], [57090]])
+
+    def test_start_end_percentiles_wrong_parameters(self):
+        """
+        Test percentiles of unknown user and out of range percent.
+        """
+        self.assertEqual(
+            self.client.get(
+                '/api/v1/presence_start_end_percentiles/1'
+            ).status_code,
+            httplib.NOT_FOUND
+        )
+        self.assertEqual(
+            self.client.get(
+                '/api/v1/presence_start_end_percentiles/11?q=0'
+            ).status_code,
+            httplib.BAD_REQUEST
+        )
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -376,42 +1047,157 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             'https://intranet.stxnext.pl/api/images/users/49'
         )
 
-    def test_get_year_and_months(self):
+    def test_parse_data_csv_rejects(self):
         """
-        Test getting year and month from.
+        Test malformed rows are skipped and reported with reasons.
         """
-        data = utils.get_year_and_months()
+        rejected = []
+        data = utils.parse_data_csv(DIRTY_DATA_CSV, rejected)
 
-        self.assertIsInstance(data, list)
-        self.assertItemsEqual(
-            data[0], ['date', 'month', 'year']
+        self.assertEqual(
+            data,
+            {
+                10: {
+                    datetime.date(2013, 9, 10): {
+                        'start': datetime.time(9, 39, 5),
+                        'end': datetime.time(17, 59, 52),
+                    },
+                },
+                11: {
+                    datetime.date(2012, 2, 29): {
+                        'start': datetime.time(9, 13, 26),
+                        'end': datetime.time(16, 15, 27),
+                    },
+                },
+                13: {
+                    datetime.date(2013, 9, 13): {
+                        'start': datetime.time(8, 0, 0),
+                        'end': datetime.time(16, 0, 0),
+                    },
+                },
+            }
+        )
+        self.assertEqual(
+            [(line, reason) for line, reason, row in rejected],
+            [
+                (2, 'malformed user id'),
+                (3, 'malformed date'),
+                (4, 'malformed start time'),
+                (5, 'expected 4 fields, got 0'),
+                (7, 'expected 4 fields, got 3'),
+                (8, 'malformed end time'),
+            ]
         )
+        self.assertEqual(rejected[0][2], ['user_id', 'date', 'start', 'end'])
 
-    def test_get_data_by_date(self):
+    def test_parse_data_csv_keep(self):
         """
-        Test wokrtime for user_id in date.
+        Test rows of users refused by keep predicate are skipped unparsed.
         """
-        data = utils.get_data_by_date()
+        rejected = []
+        data = utils.parse_data_csv(
+            DIRTY_DATA_CSV, rejected, lambda user_id: user_id == 10
+        )
 
-        self.assertItemsEqual(
-            data[datetime.date(2013, 9, 13)], {11: 6426}
+        self.assertEqual(data.keys(), [10])
+        self.assertEqual(
+            [(line, reason) for line, reason, row in rejected],
+            [
+                (2, 'malformed user id'),
+                (3, 'malformed date'),
+                (5, 'expected 4 fields, got 0'),
+            ]
         )
 
-    def test_top_five(self):
+    def test_validate_row(self):
         """
-        Test top five work time for users.
+        Test structural checks of CSV rows.
         """
-        data = [
-            {
-                10: 29778,
-                11: 27227,
-                13: 29824,
-                14: 27296,
-                15: 27276,
-                16: 27633,
-                17: 29638,
-            },
-            {
+        self.assertEqual(
+            utils.validate_row(['7', '2013-09-10', '09:00:00', '17:00:00']),
+            (
+                (
+                    7,
+                    datetime.date(2013, 9, 10),
+                    datetime.time(9, 0, 0),
+                    datetime.time(17, 0, 0),
+                ),
+                None
+            )
+        )
+        self.assertEqual(
+            utils.validate_row(['-7', '2013-09-10', '09:00:00', '17:00:00']),
+            (None, 'malformed user id')
+        )
+        self.assertEqual(
+            utils.validate_row(['7', '2013-13-10', '09:00:00', '17:00:00']),
+            (None, 'malformed date')
+        )
+        self.assertEqual(
+            utils.validate_row(['7', '0000-01-01', '09:00:00', '17:00:00']),
+            (None, 'malformed date')
+        )
+        self.assertEqual(
+            utils.validate_row(['7', '2013-09-10', '09:60:00', '17:00:00']),
+            (None, 'malformed start time')
+        )
+        self.assertEqual(
+            utils.validate_row(['7', '2013-9-1', '9:05:3', '17:00:00', '']),
+            (
+                (
+                    7,
+                    datetime.date(2013, 9, 1),
+                    datetime.time(9, 5, 3),
+                    datetime.time(17, 0, 0),
+                ),
+                None
+            )
+        )
+        self.assertEqual(
+            utils.validate_row(['7', '2013-009-01', '09:00:00', '17:00:00']),
+            (None, 'malformed date')
+        )
+        self.assertEqual(
+            utils.validate_row(['7', '2013-09-10', '09::00', '17:00:00']),
+            (None, 'malformed start time')
+        )
+
+    def test_get_year_and_months(self):
+        """
+        Test getting year and month from.
+        """
+        data = utils.get_year_and_months()
+
+        self.assertIsInstance(data, list)
+        self.assertItemsEqual(
+            data[0], ['date', 'month', 'year']
+        )
+
+    def test_get_data_by_date(self):
+        """
+        Test wokrtime for user_id in date.
+        """
+        data = utils.get_data_by_date()
+
+        self.assertItemsEqual(
+            data[datetime.date(2013, 9, 13)], {11: 6426}
+        )
+
+    def test_top_five(self):
+        """
+        Test top five work time for users.
+        """
+        data = [
+            {
+                10: 29778,
+                11: 27227,
+                13: 29824,
+                14: 27296,
+                15: 27276,
+                16: 27633,
+                17: 29638,
+            },
+            {
                 10: 28668,
                 11: 54024,
                 13: 30566,
@@ -487,6 +1273,279 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             }
         )
 
+    def test_keyset_page(self):
+        """
+        Test keyset pagination over sorted keys.
+        """
+        keys = [1, 3, 5, 7, 9]
+
+        self.assertEqual(utils.keyset_page(keys, None, 2), ([1, 3], 3))
+        self.assertEqual(utils.keyset_page(keys, 3, 2), ([5, 7], 7))
+        self.assertEqual(utils.keyset_page(keys, 4, 2), ([5, 7], 7))
+        self.assertEqual(utils.keyset_page(keys, 7, 2), ([9], None))
+        self.assertEqual(utils.keyset_page(keys, 9, 2), ([], None))
+
+    def test_prefix_sums(self):
+        """
+        Test range totals and top k from cumulative worktime.
+        """
+        sums = utils.PrefixSums(utils.get_data())
+
+        self.assertEqual(sums.first, datetime.date(2013, 9, 5))
+        self.assertEqual(sums.days, 9)
+        self.assertEqual(
+            sums.total(
+                10, datetime.date(2013, 9, 11), datetime.date(2013, 9, 12)
+            ),
+            48170
+        )
+        self.assertEqual(
+            sums.total(
+                11, datetime.date(2013, 1, 1), datetime.date(2014, 1, 1)
+            ),
+            118402
+        )
+        self.assertEqual(
+            sums.total(11, datetime.date(2013, 1, 1), datetime.date.max),
+            118402
+        )
+        self.assertEqual(
+            sums.total(
+                11, datetime.date(2013, 9, 15), datetime.date(2013, 9, 1)
+            ),
+            0
+        )
+        self.assertEqual(
+            sums.total(
+                11, datetime.date(2013, 1, 1), datetime.date(2013, 2, 1)
+            ),
+            0
+        )
+        self.assertEqual(
+            sums.top(
+                datetime.date(2013, 9, 5), datetime.date(2013, 9, 9), 5
+            ),
+            [(11, 47122)]
+        )
+
+    def test_worktime_matrix(self):
+        """
+        Test users x months worktime matrix and its selections.
+        """
+        data = utils.get_data()
+        data[12] = {
+            datetime.date(2013, 10, 1): {
+                'start': datetime.time(9, 0, 0),
+                'end': datetime.time(10, 0, 0),
+            },
+        }
+        matrix = utils.WorktimeMatrix(data)
+
+        self.assertEqual(matrix.users, [10, 11, 12])
+        self.assertEqual(matrix.months, [(2013, 9), (2013, 10)])
+        self.assertEqual(
+            matrix.cells.tolist(), [78217, 0, 118402, 0, 0, 3600]
+        )
+        self.assertEqual(
+            matrix.select([12, 10, 99], since=(2013, 10)),
+            {'users': [10, 12], 'months': ['2013-10'], 'rows': [[0], [3600]]}
+        )
+        self.assertEqual(
+            matrix.select(until=(2013, 9), sparse=True)['rows'],
+            [[0, 78217], [0, 118402], []]
+        )
+        self.assertEqual(
+            matrix.select(since=(2014, 1))['rows'], [[], [], []]
+        )
+
+    def test_rolling_stats(self):
+        """
+        Test moving means computed day by day.
+        """
+        items = utils.get_data()[11]
+        stats = utils.rolling_stats(items)
+
+        self.assertEqual(len(stats.dates), 6)
+        self.assertEqual(
+            stats.series[7]['worktime'][3:5], [22251.75, 22244.25]
+        )
+        self.assertEqual(stats.series[30]['worktime'][4], 22395.2)
+        self.assertEqual(stats.series[90]['start'][0], 34088.0)
+        with self.assertRaises(ValueError):
+            stats.add(datetime.date(2013, 9, 1), 0, 0)
+
+        first = utils.rolling_stats(
+            {date: items[date] for date in sorted(items)[:3]}
+        )
+        extended = first.copy()
+        extended.extend(items)
+        self.assertEqual(len(first.dates), 3)
+        self.assertEqual(extended.series, stats.series)
+
+    def test_single_flight(self):
+        """
+        Test concurrent identical calls share one computation.
+        """
+        calls = []
+        release = threading.Event()
+        results = []
+
+        @utils.single_flight
+        def view(value):
+            """
+            Slow view counting its calls.
+            """
+            calls.append(value)
+            release.wait()
+            if value is None:
+                abort(404)
+            return Response('result {}'.format(value))
+
+        def request(value, query_string='a=1'):
+            """
+            Calls view within a request and stores its body or error.
+            """
+            with main.app.test_request_context('/?' + query_string):
+                try:
+                    results.append(view(value).get_data())
+                except NotFound:
+                    results.append('not found')
+
+        threads = [
+            threading.Thread(target=request, args=args)
+            for args in [(1,)] * 5 + [(1, 'a=2'), (None,), (None,)]
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(calls), [None, 1, 1])
+        self.assertEqual(
+            sorted(results),
+            ['not found'] * 2 + ['result 1'] * 6
+        )
+
+        request(1)
+        self.assertEqual(len(calls), 4)
+
+    def test_period_range(self):
+        """
+        Test calendar period boundaries.
+        """
+        self.assertEqual(
+            utils.period_range('year', 2013),
+            (datetime.date(2013, 1, 1), datetime.date(2013, 12, 31))
+        )
+        self.assertEqual(
+            utils.period_range('quarter', 2013, 4),
+            (datetime.date(2013, 10, 1), datetime.date(2013, 12, 31))
+        )
+        self.assertEqual(
+            utils.period_range('month', 2012, 2),
+            (datetime.date(2012, 2, 1), datetime.date(2012, 2, 29))
+        )
+        self.assertEqual(
+            utils.period_range('week', 2013, 1),
+            (datetime.date(2012, 12, 31), datetime.date(2013, 1, 6))
+        )
+        with self.assertRaises(ValueError):
+            utils.period_range('week', 2013, 53)
+
+    def test_occupancy_curves(self):
+        """
+        Test occupancy curves from presence intervals.
+        """
+        monday = datetime.date(2013, 9, 9)
+        next_monday = datetime.date(2013, 9, 16)
+        curves = utils.occupancy_curves(
+            {
+                1: {
+                    monday: {
+                        'start': datetime.time(5, 0, 0),
+                        'end': datetime.time(12, 0, 0),
+                    },
+                    next_monday: {
+                        'start': datetime.time(10, 0, 0),
+                        'end': datetime.time(8, 0, 0),
+                    },
+                },
+                2: {
+                    monday: {
+                        'start': datetime.time(9, 30, 0),
+                        'end': datetime.time(10, 0, 1),
+                    },
+                },
+            },
+            6 * 3600,
+        )
+
+        self.assertEqual(curves['dates'], {monday: [0, 1, 0, 0]})
+        self.assertEqual(curves['weekdays'][0], [0, 1, 0, 0])
+        self.assertEqual(curves['weekdays'][1], [0, 0, 0, 0])
+
+        hourly = utils.occupancy_curves(
+            {
+                2: {
+                    monday: {
+                        'start': datetime.time(9, 30, 0),
+                        'end': datetime.time(10, 0, 1),
+                    },
+                },
+            },
+            3600,
+        )
+        self.assertEqual(hourly['dates'][monday][9:12], [0, 1, 0])
+
+    def test_interval_index(self):
+        """
+        Test counting and listing people present at a moment.
+        """
+        index = utils.IntervalIndex(utils.get_data())
+        date = datetime.date(2013, 9, 10)
+
+        self.assertEqual(index.count(date, 34000), 1)
+        self.assertEqual(index.count(date, 36000), 2)
+        self.assertEqual(index.count(date, 50154), 1)
+        self.assertEqual(index.count(date, 64792), 0)
+        self.assertEqual(index.count(datetime.date(2013, 9, 14), 36000), 0)
+        self.assertEqual(
+            index.present(date, 36000),
+            [(33590, 50154, 11), (34745, 64792, 10)]
+        )
+        self.assertEqual(index.present(date, 0, 33590), [])
+        self.assertEqual(index.present(date, 0, 33591), [(33590, 50154, 11)])
+
+    def test_seconds_to_time(self):
+        """
+        Test formatting seconds since midnight.
+        """
+        self.assertEqual(utils.seconds_to_time(37850), '10:30:50')
+        self.assertEqual(utils.seconds_to_time(0), '00:00:00')
+
+    def test_time_sketch(self):
+        """
+        Test quantiles of merged time sketches stay within error bound.
+        """
+        first = utils.TimeSketch(resolution=60)
+        second = utils.TimeSketch(resolution=60)
+        values = range(28800, 36000, 7)
+        for value in values[::2]:
+            first.add(value)
+        for value in values[1::2]:
+            second.add(value)
+        first.merge(second)
+
+        self.assertEqual(first.count, len(values))
+        for percent in (1, 25, 50, 90, 99, 100):
+            exact = values[
+                int(math.ceil(percent / 100.0 * len(values))) - 1
+            ]
+            self.assertLessEqual(abs(first.quantile(percent) - exact), 30)
+        self.assertEqual(utils.TimeSketch().quantile(50), 0)
+
     def test_seconds_since_midnight(self):
         """
         Test seconds since midnight method.
@@ -526,6 +1585,1513 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(utils.mean([]), 0)
         self.assertEqual(utils.mean([2, 5, 10, 15]), 8)
 
+    def test_parse_groups_json(self):
+        """
+        Test reading user groups file.
+        """
+        self.assertEqual(
+            utils.parse_groups_json(TEST_DATA_GROUPS),
+            {'backend': [10, 11, 12, 13], 'frontend': [11, 14, 15]},
+        )
+
+    def test_merge_weekdays(self):
+        """
+        Test merging weekday aggregates of many users.
+        """
+        first = [[1], [], [2, 3], [], [], [], []]
+        second = [[4], [5], [], [], [], [], [6]]
+
+        self.assertEqual(
+            utils.merge_weekdays([first, second]),
+            [[1, 4], [5], [2, 3], [], [], [], [6]],
+        )
+        self.assertEqual(utils.merge_weekdays([]), [[]] * 7)
+
+        merged = utils.merge_weekdays_start_end([
+            {i: {'start': [i], 'end': [i + 10]} for i in range(7)},
+            {i: {'start': [], 'end': []} for i in range(7)},
+            {i: {'start': [i * 100], 'end': [0]} for i in range(7)},
+        ])
+        self.assertEqual(merged[0], {'start': [0, 0], 'end': [10, 0]})
+        self.assertEqual(merged[6], {'start': [6, 600], 'end': [16, 0]})
+
+    def test_worktime_matrix_totals(self):
+        """
+        Test summed worktime of many users by month.
+        """
+        data = utils.get_data()
+        data[12] = {
+            datetime.date(2013, 10, 1): {
+                'start': datetime.time(9, 0, 0),
+                'end': datetime.time(10, 0, 0),
+            },
+        }
+        matrix = utils.WorktimeMatrix(data)
+
+        self.assertEqual(
+            matrix.totals([10, 11, 12, 99]),
+            [['2013-09', 196619], ['2013-10', 3600]],
+        )
+        self.assertEqual(
+            matrix.totals([]), [['2013-09', 0], ['2013-10', 0]]
+        )
+
+    def test_deep_size(self):
+        """
+        Test approximate size of nested structures.
+        """
+        data = {1: [datetime.date(2013, 9, 10)] * 10}
+        size = memory.deep_size(data)
+
+        self.assertGreater(size, sys.getsizeof(data))
+        # Shared date is counted once.
+        self.assertLess(
+            size,
+            memory.deep_size(
+                {1: [datetime.date(2013, 9, 10) for _ in range(10)]}
+            )
+        )
+        self.assertEqual(memory.deep_size(int), 0)
+
+    def test_type_snapshots(self):
+        """
+        Test diffing and dropping of type count snapshots.
+        """
+        snapshots = memory.TypeSnapshots(limit=2)
+        first = snapshots.take()
+        garbage = [datetime.date(2013, 9, 10) for _ in range(1000)]
+        second = snapshots.take()
+        changes = {
+            name: after - before
+            for name, before, after in snapshots.diff(first, second, 1000)
+        }
+
+        self.assertGreaterEqual(changes['date'], 1000)
+        self.assertEqual(len(snapshots.diff(first, second, 1)), 1)
+        del garbage
+
+        snapshots.take()
+        with self.assertRaises(KeyError):
+            snapshots.diff(first, second)
+
+class PresenceAnalyzerManagerTestCase(unittest.TestCase):
+    """
+    Data manager tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.data_csv = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.data_csv)
+        main.app.config.update({
+            'DATA_CSV': self.data_csv,
+            'DATA_XML': TEST_DATA_XML,
+            'DATA_RELOAD_INTERVAL': 0.01,
+        })
+        self.manager = manager.DataManager(main.app)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.manager.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def append_row(self, row):
+        """
+        Appends a row to the copy of test data.
+        """
+        with open(self.data_csv, 'a') as csvfile:
+            csvfile.write('\r\n' + row)
+
+    def test_snapshot_indexes(self):
+        """
+        Test indexes built with snapshot.
+        """
+        snapshot = self.manager.current()
+
+        self.assertEqual(snapshot.version, 1)
+        self.assertItemsEqual(snapshot.data.keys(), [10, 11])
+        self.assertEqual(
+            snapshot.by_date[datetime.date(2013, 9, 13)], {11: 6426}
+        )
+        self.assertEqual(snapshot.months, [('2013 - September', 9, 2013)])
+        self.assertEqual(len(snapshot.users), 84)
+
+    def test_refresh(self):
+        """
+        Test snapshot is swapped only after data file changes.
+        """
+        first = self.manager.current()
+
+        self.assertFalse(self.manager.refresh())
+        self.assertIs(self.manager.current(), first)
+
+        self.append_row('12,2013-10-01,09:00:00,17:00:00')
+
+        self.assertTrue(self.manager.refresh())
+        second = self.manager.current()
+        self.assertEqual(second.version, 2)
+        self.assertIn(12, second.data)
+        self.assertNotIn(12, first.data)
+        self.assertEqual(second.months[0], ('2013 - October', 10, 2013))
+
+    def test_quarantine(self):
+        """
+        Test malformed rows are counted and written to quarantine file.
+        """
+        quarantine = os.path.join(self.tmpdir, 'quarantine.csv')
+        shutil.copy(DIRTY_DATA_CSV, self.data_csv)
+        main.app.config['DATA_QUARANTINE'] = quarantine
+        try:
+            snapshot = self.manager.current()
+        finally:
+            del main.app.config['DATA_QUARANTINE']
+
+        self.assertEqual(snapshot.rejected, 6)
+        with open(quarantine) as csvfile:
+            lines = csvfile.read().splitlines()
+        self.assertEqual(len(lines), 7)
+        self.assertEqual(lines[0], 'line,reason,row')
+        self.assertEqual(
+            lines[3], '4,malformed start time,11,2013-09-11,9:75:26,16:15:27'
+        )
+
+    def test_broadcast_changes(self):
+        """
+        Test subscribers receive changes of every published snapshot.
+        """
+        self.manager.current()
+        queue = self.manager.subscribe()
+
+        self.append_row('12,2013-10-01,09:00:00,17:00:00')
+        self.manager.refresh()
+        event = queue.get_nowait()
+
+        self.assertEqual(event['version'], 2)
+        self.assertEqual(event['users'], [12])
+        self.assertEqual(event['months'], [(2013, 10)])
+        self.assertEqual(event['catalogue'][0], ('2013 - October', 10, 2013))
+
+        self.manager.unsubscribe(queue)
+        self.append_row('12,2013-10-02,09:00:00,17:00:00')
+        self.manager.refresh()
+        self.assertTrue(queue.empty())
+
+    def test_datasets_carried_over(self):
+        """
+        Test datasets are rebuilt only when their inputs change.
+        """
+        users_xml = os.path.join(self.tmpdir, 'users.xml')
+        shutil.copy(TEST_DATA_XML, users_xml)
+        main.app.config['DATA_XML'] = users_xml
+        first = self.manager.current()
+        by_weekday = first.by_weekday
+
+        self.assertEqual(first.stats['by_weekday']['version'], 1)
+        self.assertEqual(first.stats['by_weekday']['size'], 2)
+        self.assertEqual(manager.DATASETS['by_weekday'].inputs, ('data',))
+
+        os.utime(users_xml, (0, 0))
+        self.manager.refresh()
+        second = self.manager.current()
+
+        self.assertEqual(second.version, 2)
+        self.assertIsNot(second.users, first.users)
+        self.assertIs(second.data, first.data)
+        self.assertIs(second.by_weekday, by_weekday)
+        self.assertEqual(second.stats['by_weekday']['version'], 1)
+
+        self.append_row('12,2013-10-01,09:00:00,17:00:00')
+        self.manager.refresh()
+        third = self.manager.current()
+
+        self.assertIs(third.users, second.users)
+        self.assertIsNot(third.by_weekday, by_weekday)
+        self.assertIn(12, third.by_weekday)
+        self.assertEqual(third.stats['by_weekday']['version'], 3)
+
+    def test_snapshot_warmed(self):
+        """
+        Test datasets views read are built before snapshot is published.
+        """
+        snapshot = self.manager.current()
+
+        for name in (
+                'by_weekday', 'by_weekday_start_end', 'directory',
+                'worktime_matrix', 'rolling'
+        ):
+            self.assertIn(name, snapshot.__dict__, name)
+
+    def test_groups_rebuilt_with_groups_file(self):
+        """
+        Test group aggregates follow groups file and members' data.
+        """
+        groups_json = os.path.join(self.tmpdir, 'groups.json')
+        with open(groups_json, 'w') as groups_file:
+            json.dump({'team': [10]}, groups_file)
+        main.app.config['DATA_GROUPS'] = groups_json
+        try:
+            first = self.manager.current()
+
+            self.assertIn('groups_by_weekday', first.__dict__)
+            self.assertEqual(
+                first.groups_by_weekday['team'], first.by_weekday[10]
+            )
+
+            with open(groups_json, 'w') as groups_file:
+                json.dump({'team': [10, 11], 'empty': []}, groups_file)
+            os.utime(groups_json, (0, 0))
+            self.manager.refresh()
+            second = self.manager.current()
+
+            self.assertEqual(second.groups['team'], [10, 11])
+            self.assertIs(second.by_weekday, first.by_weekday)
+            self.assertEqual(
+                second.groups_by_month['team'], [['2013-09', 196619]]
+            )
+            self.assertEqual(second.groups_by_weekday['empty'], [[]] * 7)
+
+            self.append_row('12,2013-10-01,09:00:00,17:00:00')
+            self.manager.refresh()
+            third = self.manager.current()
+
+            self.assertIs(third.groups, second.groups)
+            self.assertEqual(
+                third.groups_by_month['team'],
+                [['2013-09', 196619], ['2013-10', 0]],
+            )
+        finally:
+            del main.app.config['DATA_GROUPS']
+
+    def test_rolling_carried_over(self):
+        """
+        Test rolling stats are extended when only later days appear.
+        """
+        previous = self.manager.current()
+        self.assertEqual(len(previous.rolling), 2)
+        self.append_row('10,2013-09-13,09:00:00,17:00:00')
+        self.manager.refresh()
+        snapshot = self.manager.current()
+
+        self.assertIn('rolling', snapshot.__dict__)
+        self.assertEqual(len(previous.rolling[10].dates), 3)
+        self.assertEqual(
+            snapshot.rolling[10].series,
+            utils.rolling_stats(snapshot.data[10]).series
+        )
+
+        self.append_row('10,2013-09-02,09:00:00,17:00:00')
+        self.manager.refresh()
+        snapshot = self.manager.current()
+        self.assertEqual(
+            snapshot.rolling[10].dates[0], datetime.date(2013, 9, 2)
+        )
+
+    def test_sketches_carried_over(self):
+        """
+        Test time sketches are extended with new days of unchanged users.
+        """
+        previous = self.manager.current()
+        counts = [day['start'].count for day in previous.sketches[10]]
+        self.append_row('10,2013-09-02,08:00:00,17:00:00')
+        built = []
+        original = manager.start_end_sketches
+
+        def start_end_sketches(items, **kwargs):
+            """
+            Records days sketches are built of.
+            """
+            built.append((sorted(items), 'base' in kwargs))
+            return original(items, **kwargs)
+
+        manager.start_end_sketches = start_end_sketches
+        try:
+            self.manager.refresh()
+        finally:
+            manager.start_end_sketches = original
+        snapshot = self.manager.current()
+
+        def buckets(sketches):
+            """
+            Returns bucket counts of user's sketches.
+            """
+            return [
+                (dict(day['start'].buckets), dict(day['end'].buckets))
+                for day in sketches
+            ]
+
+        self.assertItemsEqual(
+            built, [([datetime.date(2013, 9, 2)], True), ([], True)]
+        )
+        self.assertEqual(
+            buckets(snapshot.sketches[10]),
+            buckets(utils.start_end_sketches(snapshot.data[10]))
+        )
+        self.assertEqual(
+            [day['start'].count for day in previous.sketches[10]], counts
+        )
+
+    def test_events_stream(self):
+        """
+        Test Server-Sent Events pushed after data reload.
+        """
+        client = main.app.test_client()
+        resp = client.get('/api/v1/events')
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+        self.assertIn(
+            'var eventsStream = false;', client.get('/presence_weekday').data
+        )
+
+        main.app.config['EVENTS_STREAM'] = True
+        try:
+            resp = client.get('/api/v1/events', buffered=False)
+            stream = iter(resp.response)
+
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            self.assertEqual(
+                next(stream),
+                'retry: 5000\nevent: version\ndata: {}\n\n'.format(
+                    manager.data_manager.current().version
+                )
+            )
+
+            self.append_row('12,2013-10-01,09:00:00,17:00:00')
+            manager.data_manager.refresh()
+            event, data = next(stream).splitlines()[:2]
+
+            self.assertEqual(event, 'event: update')
+            self.assertEqual(json.loads(data[len('data: '):])['users'], [12])
+
+            manager.data_manager.disconnect()
+            self.assertRaises(StopIteration, next, stream)
+            resp.close()
+
+            main.app.config['EVENTS_KEEPALIVE'] = 0.01
+            resp = client.get('/api/v1/events', buffered=False)
+            stream = iter(resp.response)
+            next(stream)
+            self.assertEqual(next(stream), ': keepalive\n\n')
+            resp.close()
+        finally:
+            del main.app.config['EVENTS_STREAM']
+            main.app.config.pop('EVENTS_KEEPALIVE', None)
+
+    def test_pinned_snapshot(self):
+        """
+        Test pinned manager keeps serving its snapshot.
+        """
+        snapshot = self.manager.current()
+        self.manager.pin()
+        self.append_row('12,2013-10-01,09:00:00,17:00:00')
+
+        self.assertIs(self.manager.current(), snapshot)
+
+    def test_background_reload(self):
+        """
+        Test reloader thread publishes new snapshot on its own.
+        """
+        self.manager.start()
+        first = self.manager.current()
+
+        self.assertTrue(self.manager.running)
+
+        self.append_row('12,2013-10-01,09:00:00,17:00:00')
+        for _ in range(500):
+            if self.manager.current() is not first:
+                break
+            time.sleep(0.01)
+
+        self.assertIn(12, self.manager.current().data)
+
+        self.manager.stop()
+        self.assertFalse(self.manager.running)
+
+
+class PresenceAnalyzerPartitionsTestCase(unittest.TestCase):
+    """
+    Partitioned data source tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        shutil.copy(
+            TEST_DATA_CSV, os.path.join(self.tmpdir, 'presence-2013-09.csv')
+        )
+        self.write_partition(
+            'presence-2013-10.csv', '12,2013-10-01,09:00:00,17:00:00\r\n'
+        )
+        main.app.config.update({
+            'DATA_CSV': self.tmpdir,
+            'DATA_XML': TEST_DATA_XML,
+        })
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write_partition(self, name, content):
+        """
+        Writes file of given name and content to partitions directory.
+        """
+        with open(os.path.join(self.tmpdir, name), 'w') as partition:
+            partition.write(content)
+
+    def test_discover(self):
+        """
+        Test finding partitions in directory, by glob and from manifest.
+        """
+        self.write_partition('notes.csv', '')
+        self.write_partition('backup-2013-13.csv', '')
+        september = os.path.join(self.tmpdir, 'presence-2013-09.csv')
+
+        self.assertTrue(partitions.is_partitioned(self.tmpdir))
+        self.assertFalse(partitions.is_partitioned(TEST_DATA_CSV))
+        self.assertItemsEqual(
+            partitions.discover(self.tmpdir).keys(),
+            [(2013, 9), (2013, 10)]
+        )
+        self.assertEqual(
+            partitions.discover(os.path.join(self.tmpdir, '*-09.csv')),
+            {(2013, 9): september}
+        )
+
+        self.write_partition(
+            'manifest.json',
+            json.dumps({
+                'partitions': [
+                    {'month': '2013-09', 'file': 'presence-2013-09.csv'},
+                    {'month': '2013-00', 'file': 'presence-2013-00.csv'},
+                    {'file': 'presence-2013-10.csv'},
+                ],
+            })
+        )
+        self.assertEqual(
+            partitions.discover(self.tmpdir), {(2013, 9): september}
+        )
+
+    def test_lazy_loading_and_eviction(self):
+        """
+        Test partitions load on demand and are evicted over budget.
+        """
+        parts = partitions.Partitions(self.tmpdir, budget=9)
+
+        self.assertEqual(parts.rows, 0)
+        self.assertEqual(parts.months(), [(2013, 10), (2013, 9)])
+        self.assertEqual(parts.month(2012, 1), {})
+
+        self.assertItemsEqual(parts.month(2013, 9).keys(), [10, 11])
+        self.assertEqual(parts.rows, 9)
+
+        self.assertItemsEqual(parts.month(2013, 10).keys(), [12])
+        self.assertEqual(parts.rows, 1)
+        self.assertEqual(
+            [key for key, entry in parts.loaded_items()], [(2013, 10)]
+        )
+
+        successor = partitions.Partitions(self.tmpdir, 9, previous=parts)
+        self.assertEqual(successor.rows, 1)
+
+    def test_snapshot(self):
+        """
+        Test month queries of partitioned snapshot don't load whole history.
+        """
+        snapshot = manager.DataManager(main.app).current()
+
+        self.assertNotIn('data', snapshot.__dict__)
+        self.assertEqual(
+            snapshot.months,
+            [('2013 - October', 10, 2013), ('2013 - September', 9, 2013)]
+        )
+        self.assertEqual(
+            snapshot.month_by_date(2013, 10),
+            {datetime.date(2013, 10, 1): {12: 28800}}
+        )
+        self.assertEqual(snapshot.partitions.rows, 1)
+        self.assertNotIn('data', snapshot.__dict__)
+
+        self.assertItemsEqual(snapshot.data.keys(), [10, 11, 12])
+
+    def test_rows_outside_of_month(self):
+        """
+        Test rows dated outside of their partition's month are rejected.
+        """
+        self.write_partition(
+            'presence-2013-10.csv',
+            '12,2013-10-01,09:00:00,17:00:00\r\n'
+            '12,2013-11-01,09:00:00,17:00:00\r\n'
+        )
+        snapshot = manager.DataManager(main.app).current()
+
+        self.assertEqual(snapshot.month_by_date(2013, 11), {})
+        self.assertEqual(
+            snapshot.month_by_date(2013, 10),
+            {datetime.date(2013, 10, 1): {12: 28800}}
+        )
+        self.assertEqual(snapshot.rejected, 1)
+        self.assertEqual(
+            snapshot.partitions.rejected_rows()[0][:2],
+            (2, 'outside of 2013-10')
+        )
+        self.assertNotIn(datetime.date(2013, 11, 1), snapshot.data[12])
+
+    def test_month_indexes_kept(self):
+        """
+        Test indexes of a month are built once while its partition is
+        loaded.
+        """
+        snapshot = manager.DataManager(main.app).current()
+        by_date = snapshot.month_by_date(2013, 10)
+        intervals = snapshot.intervals_for(datetime.date(2013, 10, 1))
+
+        self.assertIs(snapshot.month_by_date(2013, 10), by_date)
+        self.assertIs(
+            snapshot.intervals_for(datetime.date(2013, 10, 2)), intervals
+        )
+        self.assertEqual(snapshot.month_by_date(2012, 1), {})
+
+    def test_quarantine_of_lazy_months(self):
+        """
+        Test malformed rows of lazily loaded months are counted and written
+        to quarantine file.
+        """
+        self.write_partition(
+            'presence-2013-10.csv',
+            '12,2013-10-01,09:00:00,17:00:00\r\n'
+            '12,2013-10-02,nine,17:00:00\r\n'
+        )
+        quarantine = os.path.join(self.tmpdir, 'quarantine.txt')
+        main.app.config['DATA_QUARANTINE'] = quarantine
+        try:
+            snapshot = manager.DataManager(main.app).current()
+            self.assertEqual(snapshot.rejected, 0)
+
+            snapshot.month_by_date(2013, 10)
+            snapshot.month_by_date(2013, 10)
+            self.assertEqual(snapshot.rejected, 1)
+            with open(quarantine) as csvfile:
+                self.assertEqual(
+                    csvfile.read().splitlines(),
+                    [
+                        'line,reason,row',
+                        '2,malformed start time,12,2013-10-02,nine,17:00:00',
+                    ]
+                )
+
+            self.assertIn(12, snapshot.data)
+            self.assertEqual(snapshot.rejected, 1)
+        finally:
+            del main.app.config['DATA_QUARANTINE']
+
+    def test_views(self):
+        """
+        Test views served from partitioned source.
+        """
+        self.write_partition('backup-2013-13.csv', '')
+        top = json.loads(self.client.get('/api/v1/top_five/2013/9').data)
+        months = json.loads(self.client.get('/api/v1/years_and_months/').data)
+        present = json.loads(
+            self.client.get('/api/v1/present/2013-10-01?at=12:00').data
+        )
+
+        self.assertEqual(top, [[11, 118402], [10, 78217]])
+        self.assertEqual(
+            months,
+            [['2013 - October', 10, 2013], ['2013 - September', 9, 2013]]
+        )
+        self.assertEqual([user['user_id'] for user in present], [12])
+
+
+class PresenceAnalyzerServingTestCase(unittest.TestCase):
+    """
+    Serving modes and load test tool tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML
+        })
+        self.listener = script._listen(('127.0.0.1', 0))
+        self.base_url = 'http://127.0.0.1:{}'.format(
+            self.listener.getsockname()[1]
+        )
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.listener.close()
+
+    def serve(self, make_server):
+        """
+        Builds server with given factory and runs it in a background thread.
+        """
+        thread = threading.Thread(
+            target=lambda: make_server().serve_forever()
+        )
+        thread.daemon = True
+        thread.start()
+
+    @unittest.skipIf(gevent is None, 'gevent is not installed')
+    def test_async_server(self):
+        """
+        Test API served by gevent server under concurrent load.
+        """
+        self.serve(
+            lambda: script.make_async_server(main.app, self.listener)
+        )
+        stats = loadtest.run_load(
+            self.base_url,
+            [
+                '/api/v1/presence_weekday/10',
+                '/api/v1/years_and_months/',
+                '/api/v1/top_five/2013/9',
+            ],
+            concurrency=10,
+            requests=60,
+        )
+
+        self.assertEqual(stats['errors'], 0)
+        self.assertGreater(stats['throughput'], 0)
+        self.assertLessEqual(stats['p50'], stats['p99'])
+
+    @unittest.skipIf(gevent is None, 'gevent is not installed')
+    def test_async_patches_before_import(self):
+        """
+        Test app of gevent mode is imported with gevent locks and master
+        reloads data.
+        """
+        code = (
+            'import sys\n'
+            'sys.path.insert(0, {!r})\n'
+            'from presence_analyzer import script\n'
+            'def configure():\n'
+            '    from presence_analyzer import get_app\n'
+            '    app = get_app()\n'
+            '    app.config.update(DATA_CSV={!r}, DATA_XML={!r})\n'
+            '    return app\n'
+            'def fork_workers(count, serve, refresh=None, interval=None):\n'
+            '    from presence_analyzer.manager import data_manager\n'
+            '    print type(data_manager._build_lock).__module__\n'
+            '    print refresh()\n'
+            'script._configure_app = configure\n'
+            'script._server_address = lambda: ("127.0.0.1", 0)\n'
+            'script._fork_workers = fork_workers\n'
+            'script._serve_async(1)\n'
+        ).format(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            TEST_DATA_CSV,
+            TEST_DATA_XML,
+        )
+        output = subprocess.check_output([sys.executable, '-c', code])
+
+        lock_module, refreshed = output.splitlines()[-2:]
+        self.assertTrue(lock_module.startswith('gevent'))
+        # Master reloads data, workers don't.
+        self.assertEqual(refreshed, 'False')
+
+    def test_prefork_workers_recycled(self):
+        """
+        Test master replaces all workers after reloading data.
+        """
+        code = (
+            'import os, signal, sys, time\n'
+            'sys.path.insert(0, {!r})\n'
+            'from presence_analyzer import script\n'
+            'calls = []\n'
+            'def serve():\n'
+            '    os.write(1, "worker\\n")\n'
+            '    time.sleep(30)\n'
+            'def refresh():\n'
+            '    calls.append(1)\n'
+            '    if len(calls) > 1:\n'
+            '        os.kill(os.getpid(), signal.SIGTERM)\n'
+            '    return len(calls) == 1\n'
+            'script._fork_workers(2, serve, refresh, 0.1)\n'
+            'print "stopped"\n'
+        ).format(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        started = time.time()
+        output = subprocess.check_output([sys.executable, '-c', code])
+
+        self.assertEqual(output.split(), ['worker'] * 4 + ['stopped'])
+        self.assertLess(time.time() - started, 20)
+
+    def test_worker_graceful_stop(self):
+        """
+        Test stopped worker finishes requests in progress and one reaching
+        max requests exits by itself.
+        """
+        def slow_app(environ, start_response):
+            """
+            Answers after a while.
+            """
+            time.sleep(1)
+            start_response(b'200 OK', [(b'Content-Type', b'text/plain')])
+            return [b'done']
+
+        def fork_worker(max_requests):
+            """
+            Serves slow app from forked worker, returns its pid.
+            """
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    script._serve_worker(
+                        slow_app, self.listener, max_requests, 10
+                    )
+                finally:
+                    os._exit(0)  # pylint: disable=protected-access
+            return pid
+
+        pid = fork_worker(0)
+        responses = []
+        thread = threading.Thread(
+            target=lambda: responses.append(
+                sharding.fetch(self.base_url + '/', 10)
+            )
+        )
+        thread.start()
+        time.sleep(0.5)
+        os.kill(pid, signal.SIGTERM)
+        thread.join()
+        _, status = os.waitpid(pid, 0)
+
+        self.assertEqual(status, 0)
+        self.assertEqual(responses[0][0], httplib.OK)
+        self.assertEqual(responses[0][2], 'done')
+
+        pid = fork_worker(2)
+        for _ in range(2):
+            self.assertEqual(
+                sharding.fetch(self.base_url + '/', 10)[0], httplib.OK
+            )
+        started = time.time()
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertLess(time.time() - started, 5)
+
+    @unittest.skipIf(gevent is None, 'gevent is not installed')
+    def test_async_worker_graceful_stop(self):
+        """
+        Test stopped gevent worker finishes requests in progress.
+        """
+        def slow_app(environ, start_response):
+            """
+            Answers after a while, yielding to other greenlets.
+            """
+            gevent.sleep(1)
+            start_response(b'200 OK', [(b'Content-Type', b'text/plain')])
+            return [b'done']
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                script._serve_async_worker(slow_app, self.listener, 0, 10)
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+
+        responses = []
+        thread = threading.Thread(
+            target=lambda: responses.append(
+                sharding.fetch(self.base_url + '/', 10)
+            )
+        )
+        thread.start()
+        time.sleep(0.5)
+        os.kill(pid, signal.SIGTERM)
+        thread.join()
+        _, status = os.waitpid(pid, 0)
+
+        self.assertEqual(status, 0)
+        self.assertEqual(responses[0][0], httplib.OK)
+        self.assertEqual(responses[0][2], 'done')
+
+    def test_protect_shared_heap(self):
+        """
+        Test full collections are put off in workers without gc.freeze().
+        """
+        threshold = gc.get_threshold()
+        try:
+            script._protect_shared_heap()
+            if not hasattr(gc, 'freeze'):
+                self.assertEqual(gc.get_threshold()[:2], threshold[:2])
+                self.assertGreater(gc.get_threshold()[2], 10 ** 9)
+        finally:
+            gc.set_threshold(*threshold)
+
+    def test_prefork_server(self):
+        """
+        Test API served by pre-fork worker server under concurrent load.
+        """
+        self.serve(
+            lambda: script.make_prefork_server(main.app, self.listener)
+        )
+        stats = loadtest.run_load(
+            self.base_url,
+            ['/api/v1/mean_time_weekday/11', '/api/v1/years_and_months/'],
+            concurrency=10,
+            requests=40,
+        )
+
+        self.assertEqual(stats['errors'], 0)
+
+    def test_read_access_log(self):
+        """
+        Test API requests picked from access log.
+        """
+        lines = [
+            '127.0.0.1 - - [10/Sep/2013:10:00:00 +0200] '
+            '"GET /api/v1/presence_weekday/10 HTTP/1.1" 200 120 "-" "-"\n',
+            '127.0.0.1 - - [10/Sep/2013:10:00:01 +0200] '
+            '"GET /static/js/utils.js HTTP/1.1" 200 900\n',
+            '127.0.0.1 - - [10/Sep/2013:10:00:02 +0200] '
+            '"GET /api/v1/events HTTP/1.1" 200 0\n',
+            '127.0.0.1 - - [10/Sep/2013:10:00:03 +0200] '
+            '"POST /api/v1/admin/memory/snapshots HTTP/1.1" 200 9\n',
+            '/api/v1/top_five/2013/9\n',
+        ]
+
+        self.assertEqual(
+            loadtest.read_access_log(lines),
+            ['/api/v1/presence_weekday/10', '/api/v1/top_five/2013/9'],
+        )
+
+    def test_synthetic_load(self):
+        """
+        Test synthetic dashboard mix served without errors.
+
+        Every request of the mix is sent at least once, including users
+        and bootstrap ones which sort the directory whether or not Polish
+        collation is installed.
+        """
+        self.serve(
+            lambda: script.make_prefork_server(main.app, self.listener)
+        )
+        paths = loadtest.synthetic_paths(self.base_url, 40, seed=1)
+
+        self.assertEqual(
+            paths, loadtest.synthetic_paths(self.base_url, 40, seed=1)
+        )
+        self.assertTrue(all(path.startswith('/api/v1/') for path in paths))
+
+        paths.extend(
+            template.format(user_id=10, year=2013, month=9)
+            for template, _ in loadtest.SYNTHETIC_MIX
+        )
+        stats = loadtest.run_load(
+            self.base_url, paths, concurrency=5, requests=len(paths)
+        )
+
+        self.assertEqual(stats['errors'], 0)
+
+    def test_local_server(self):
+        """
+        Test server command started for the load and stopped after it.
+        """
+        port = self.listener.getsockname()[1]
+        self.listener.close()
+        code = (
+            'import sys\n'
+            'sys.path.insert(0, {!r})\n'
+            'from presence_analyzer import main, script, views\n'
+            'main.app.config.update(DATA_CSV={!r}, DATA_XML={!r})\n'
+            'listener = script._listen(("127.0.0.1", {}))\n'
+            'script.make_prefork_server(main.app, listener).serve_forever()\n'
+        ).format(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            TEST_DATA_CSV,
+            TEST_DATA_XML,
+            port,
+        )
+        with loadtest.local_server(
+                [sys.executable, '-c', code], self.base_url
+        ) as process:
+            stats = loadtest.run_load(
+                self.base_url, ['/api/v1/years_and_months/'], 2, 4
+            )
+
+        self.assertEqual(stats['errors'], 0)
+        self.assertIsNotNone(process.poll())
+        self.assertEqual(
+            loadtest.serve_command('prefork', 8, 'flask-ctl'),
+            ['flask-ctl', 'prefork', '--workers=8'],
+        )
+        self.assertEqual(
+            loadtest.serve_command('paster', 8, 'flask-ctl'),
+            ['flask-ctl', 'serve', 'run'],
+        )
+
+    def test_percentile(self):
+        """
+        Test nearest rank percentile.
+        """
+        values = range(1, 101)
+
+        self.assertEqual(loadtest.percentile([], 50), 0)
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertEqual(loadtest.percentile(values, 100), 100)
+
+    def test_cli_imports_are_light(self):
+        """
+        Test command line entry points don't import the web stack.
+        """
+        for module in ('presence_analyzer', 'presence_analyzer.script'):
+            _, loaded = import_in_subprocess(module)
+            self.assertEqual(loaded, [], module)
+
+        _, loaded = import_in_subprocess('presence_analyzer.utils')
+        self.assertNotIn('lxml', loaded)
+
+    def test_import_time_budget(self):
+        """
+        Test importing the whole app stays within startup budget.
+        """
+        # Best of few runs, single imports are noisy.
+        baseline = min(import_in_subprocess('flask')[0] for _ in range(3))
+        elapsed = min(
+            import_in_subprocess('presence_analyzer.views')[0]
+            for _ in range(3)
+        )
+
+        self.assertLess(elapsed - baseline, IMPORT_BUDGET)
+
+    def test_import_stages(self):
+        """
+        Test heavy dependencies every import stage loads.
+        """
+        stages = [
+            ('presence_analyzer.main', ['flask', 'mako', 'werkzeug']),
+            ('presence_analyzer.views', ['flask', 'mako', 'werkzeug']),
+            ('presence_analyzer.sharding', ['flask', 'werkzeug']),
+        ]
+        for module, expected in stages:
+            _, loaded = import_in_subprocess(module)
+            self.assertEqual(loaded, expected, module)
+
+
+class UsersXmlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for users.xml server, answers conditional and gzip requests.
+    """
+    body = b'<intranet></intranet>'
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serves body or 304 when client's ETag matches, 404 for other files.
+        """
+        self.requests.append(dict(self.headers))
+        if self.path != '/users.xml':
+            self.send_response(httplib.NOT_FOUND)
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(httplib.NOT_MODIFIED)
+            self.end_headers()
+            return
+
+        body = self.body
+        self.send_response(httplib.OK)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_file:
+                gzip_file.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('ETag', self.etag)
+        self.send_header('Last-Modified', 'Mon, 16 Sep 2013 10:00:00 GMT')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """
+        Keeps test output quiet.
+        """
+        pass
+
+
+class PresenceAnalyzerDownloadTestCase(unittest.TestCase):
+    """
+    users.xml sync tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start stand-in server and make data directory.
+        """
+        UsersXmlHandler.body = b'<intranet></intranet>'
+        UsersXmlHandler.etag = '"v1"'
+        UsersXmlHandler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), UsersXmlHandler
+        )
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{}/users.xml'.format(
+            self.server.server_address[1]
+        )
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'users.xml')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_sync_file(self):
+        """
+        Test conditional download of users.xml.
+        """
+        self.assertTrue(script.sync_file(self.url, self.path))
+        with open(self.path, 'rb') as xml_file:
+            self.assertEqual(xml_file.read(), UsersXmlHandler.body)
+        self.assertEqual(
+            UsersXmlHandler.requests[0]['accept-encoding'], 'gzip'
+        )
+        self.assertNotIn('if-none-match', UsersXmlHandler.requests[0])
+
+        signature = utils.file_signature(self.path)
+        self.assertFalse(script.sync_file(self.url, self.path))
+        self.assertEqual(UsersXmlHandler.requests[1]['if-none-match'], '"v1"')
+        self.assertEqual(
+            UsersXmlHandler.requests[1]['if-modified-since'],
+            'Mon, 16 Sep 2013 10:00:00 GMT'
+        )
+        self.assertEqual(utils.file_signature(self.path), signature)
+
+        UsersXmlHandler.etag = '"v2"'
+        self.assertFalse(script.sync_file(self.url, self.path))
+        self.assertEqual(utils.file_signature(self.path), signature)
+
+        UsersXmlHandler.body = b'<intranet><users/></intranet>'
+        UsersXmlHandler.etag = '"v3"'
+        self.assertTrue(script.sync_file(self.url, self.path))
+        with open(self.path, 'rb') as xml_file:
+            self.assertEqual(xml_file.read(), UsersXmlHandler.body)
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir)), ['users.xml', 'users.xml.meta']
+        )
+
+    def test_sync_file_mode(self):
+        """
+        Test synced file keeps its mode and new one isn't owner-only.
+        """
+        umask = os.umask(0o022)
+        try:
+            script.sync_file(self.url, self.path)
+            self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+
+            os.chmod(self.path, 0o664)
+            UsersXmlHandler.body = b'<intranet><users/></intranet>'
+            UsersXmlHandler.etag = '"v2"'
+            self.assertTrue(script.sync_file(self.url, self.path))
+            self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o664)
+        finally:
+            os.umask(umask)
+
+    def test_download_xml(self):
+        """
+        Test download_xml exit status of updates and missing file.
+        """
+        self.assertIsNone(script.download_xml(self.url, self.path))
+        self.assertTrue(os.path.exists(self.path))
+        self.assertIsNone(script.download_xml(self.url, self.path))
+        self.assertEqual(
+            script.download_xml(self.url.replace('users', 'none'), self.path),
+            1
+        )
+
+
+class ImageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for intranet avatar images.
+    """
+    body = b'\x89PNG fake image'
+    requests = []
+    modified = True
+    conditional = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serves same image at every path, 304 to conditional request unless
+        image is modified.
+        """
+        self.requests.append(self.path)
+        if self.headers.get('If-Modified-Since'):
+            self.conditional.append(self.path)
+            if not self.modified:
+                self.send_response(httplib.NOT_MODIFIED)
+                self.end_headers()
+                return
+        self.send_response(httplib.OK)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        """
+        Keeps test output quiet.
+        """
+        pass
+
+
+class PresenceAnalyzerAvatarsTestCase(unittest.TestCase):
+    """
+    Avatar cache tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start stand-in image server.
+        """
+        ImageHandler.requests = []
+        ImageHandler.conditional = []
+        ImageHandler.modified = True
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), ImageHandler
+        )
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.tmpdir = tempfile.mkdtemp()
+        users_xml = os.path.join(self.tmpdir, 'users.xml')
+        with open(users_xml, 'w') as xml_file:
+            xml_file.write(
+                '<intranet><server><host>127.0.0.1:{}</host>'
+                '<protocol>http</protocol></server><users>'
+                '<user id="10"><avatar>/images/10</avatar>'
+                '<name>Maciej Z.</name></user>'
+                '</users></intranet>'.format(self.server.server_address[1])
+            )
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': users_xml,
+            'AVATAR_CACHE': os.path.join(self.tmpdir, 'avatars'),
+        })
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('AVATAR_CACHE')
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_avatar_view(self):
+        """
+        Test avatar is fetched once and served with long caching.
+        """
+        resp = self.client.get('/api/v1/avatar/10')
+        again = self.client.get('/api/v1/avatar/10')
+
+        self.assertEqual(resp.status_code, httplib.FOUND)
+        self.assertEqual(again.headers['Location'], resp.headers['Location'])
+        self.assertEqual(ImageHandler.requests, ['/images/10'])
+        self.assertIn('/avatars/10-', resp.headers['Location'])
+
+        image = self.client.get(resp.headers['Location'])
+        self.assertEqual(image.status_code, httplib.OK)
+        self.assertEqual(image.mimetype, 'image/png')
+        self.assertEqual(image.get_data(), ImageHandler.body)
+        self.assertEqual(image.cache_control.max_age, views.AVATAR_MAX_AGE)
+        image.close()
+
+        missing = self.client.get('/api/v1/avatar/1000')
+        self.assertEqual(missing.status_code, httplib.NOT_FOUND)
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_make_thumbnail(self):
+        """
+        Test fetched image is resized to fit thumbnail size.
+        """
+        original = StringIO()
+        Image.new('RGB', (400, 300), (200, 0, 0)).save(original, 'JPEG')
+
+        data, extension = avatars.make_thumbnail(original.getvalue(), 128)
+        thumbnail = Image.open(StringIO(data))
+
+        self.assertEqual(extension, '.png')
+        self.assertEqual(thumbnail.format, 'PNG')
+        self.assertEqual(thumbnail.size, (128, 96))
+        self.assertEqual(
+            avatars.make_thumbnail(ImageHandler.body, 128),
+            (ImageHandler.body, None)
+        )
+
+    def test_avatar_cache(self):
+        """
+        Test stored avatars survive restart and change with source.
+        """
+        url = 'http://127.0.0.1:{}/images/10'.format(
+            self.server.server_address[1]
+        )
+        directory = main.app.config['AVATAR_CACHE']
+        name = avatars.AvatarCache(directory).name(10, url)
+
+        self.assertEqual(avatars.AvatarCache(directory).name(10, url), name)
+        self.assertEqual(len(ImageHandler.requests), 1)
+
+        ImageHandler.body = b'GIF89a other'
+        try:
+            other = avatars.AvatarCache(directory).name(10, url + '?v=2')
+        finally:
+            ImageHandler.body = b'\x89PNG fake image'
+        self.assertNotEqual(other, name)
+        self.assertEqual(os.listdir(directory), [other])
+
+        self.assertIsNone(
+            avatars.AvatarCache(directory).name(11, 'http://127.0.0.1:1/')
+        )
+
+    def test_avatar_revalidation(self):
+        """
+        Test stale avatar is revalidated and replaced when image changed.
+        """
+        url = 'http://127.0.0.1:{}/images/10'.format(
+            self.server.server_address[1]
+        )
+        directory = main.app.config['AVATAR_CACHE']
+        cache = avatars.AvatarCache(directory, max_age=3600)
+        name = cache.name(10, url)
+        self.assertEqual(cache.name(10, url), name)
+        self.assertEqual(len(ImageHandler.requests), 1)
+
+        cache.max_age = 0
+        ImageHandler.modified = False
+        self.assertEqual(cache.name(10, url), name)
+        self.assertEqual(ImageHandler.conditional, ['/images/10'])
+
+        ImageHandler.modified = True
+        ImageHandler.body = b'GIF89a other'
+        try:
+            other = cache.name(10, url)
+        finally:
+            ImageHandler.body = b'\x89PNG fake image'
+        self.assertNotEqual(other, name)
+        self.assertEqual(os.listdir(directory), [other])
+
+        # Stopped server doesn't answer, stale avatar is kept.
+        self.server.shutdown()
+        self.assertEqual(
+            avatars.AvatarCache(directory, timeout=1, max_age=0).name(10, url),
+            other
+        )
+
+
+class PresenceAnalyzerShardingTestCase(unittest.TestCase):
+    """
+    Sharded deployment tests, nodes run in forked processes.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start two nodes sharing test data.
+        """
+        self.listeners = [script._listen(('127.0.0.1', 0)) for _ in range(2)]
+        self.nodes = [
+            'http://127.0.0.1:{}'.format(listener.getsockname()[1])
+            for listener in self.listeners
+        ]
+        self.pids = []
+        for node, listener in zip(self.nodes, self.listeners):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    main.app.config.update({
+                        'DATA_CSV': TEST_DATA_CSV,
+                        'DATA_XML': TEST_DATA_XML,
+                        'SHARD_NODES': self.nodes,
+                        'SHARD_NAME': node,
+                    })
+                    script.make_prefork_server(
+                        main.app, listener
+                    ).serve_forever()
+                finally:
+                    os._exit(0)  # pylint: disable=protected-access
+            self.pids.append(pid)
+        self.client = sharding.make_router(self.nodes).test_client()
+
+    def tearDown(self):
+        """
+        Stop nodes.
+        """
+        for pid in self.pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        for listener in self.listeners:
+            listener.close()
+
+    def test_hash_ring(self):
+        """
+        Test users spread over nodes and move little when node is added.
+        """
+        ring = sharding.HashRing(['a', 'b', 'c'])
+        owners = {user_id: ring.node_for(user_id) for user_id in range(300)}
+        grown = sharding.HashRing(['a', 'b', 'c', 'd'])
+        moved = [
+            user_id for user_id, node in owners.iteritems()
+            if grown.node_for(user_id) != node
+        ]
+
+        self.assertEqual(set(owners.values()), {'a', 'b', 'c'})
+        self.assertTrue(
+            all(grown.node_for(user_id) == 'd' for user_id in moved)
+        )
+        self.assertLess(len(moved), 150)
+
+    def test_merge(self):
+        """
+        Test merging partial results of nodes.
+        """
+        self.assertEqual(
+            sharding.merge_top_five([
+                [[1, 50], [2, 40], [3, 10]],
+                [[4, 45], [5, 30], [6, 20], [7, 5]],
+            ]),
+            [[1, 50], [4, 45], [2, 40], [5, 30], [6, 20]]
+        )
+        self.assertEqual(
+            sharding.merge_months([
+                [['2013 - September', 9, 2013]],
+                [['2013 - October', 10, 2013], ['2013 - September', 9, 2013]],
+            ]),
+            [['2013 - October', 10, 2013], ['2013 - September', 9, 2013]]
+        )
+
+    def test_router(self):
+        """
+        Test per-user requests reach owners and cross-user ones are merged.
+        """
+        ring = sharding.HashRing(self.nodes)
+        for user_id in (10, 11):
+            owner = ring.node_for(user_id)
+            for node in self.nodes:
+                status, _, _ = sharding.fetch(
+                    '{}/api/v1/presence_weekday/{}'.format(node, user_id), 10
+                )
+                self.assertEqual(
+                    status,
+                    httplib.OK if node == owner else httplib.NOT_FOUND
+                )
+
+        resp = self.client.get('/api/v1/mean_time_weekday/11')
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(len(json.loads(resp.data)), 7)
+        self.assertEqual(
+            json.loads(self.client.get('/api/v1/top_five/2013/9').data),
+            [[11, 118402], [10, 78217]]
+        )
+        self.assertEqual(
+            json.loads(self.client.get('/api/v1/years_and_months/').data),
+            [['2013 - September', 9, 2013]]
+        )
+        self.assertEqual(
+            self.client.get('/api/v1/presence_weekday/1').status_code,
+            httplib.NOT_FOUND
+        )
+        self.assertEqual(
+            self.client.get('/api/v1/occupancy/weekday').status_code,
+            httplib.NOT_FOUND
+        )
+
+    def test_router_dashboards(self):
+        """
+        Test bootstrap, avatars, pages and event stream behind router.
+        """
+        resp = self.client.get('/api/v1/bootstrap/presence_weekday')
+        self.assertEqual(resp.status_code, httplib.OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['months'], [['2013 - September', 9, 2013]])
+        self.assertIn(data['selected'], [10, 11])
+        self.assertEqual(
+            data['selected'],
+            next(
+                user['user_id'] for user in data['users']
+                if user['user_id'] in (10, 11)
+            )
+        )
+        self.assertEqual(
+            data['view'],
+            json.loads(
+                self.client.get(
+                    '/api/v1/presence_weekday/{}'.format(data['selected'])
+                ).data
+            )
+        )
+
+        for user_id in (10, 11):
+            data = json.loads(
+                self.client.get(
+                    '/api/v1/bootstrap/mean_time_weekday?user_id={}'.format(
+                        user_id
+                    )
+                ).data
+            )
+            self.assertEqual(data['selected'], user_id)
+            self.assertEqual(len(data['view']), 7)
+
+        data = json.loads(
+            self.client.get('/api/v1/bootstrap/top_five_by_month').data
+        )
+        self.assertEqual(data['selected'], '2013-9')
+        self.assertEqual(data['view'], [[11, 118402], [10, 78217]])
+        self.assertEqual(
+            self.client.get('/api/v1/bootstrap/nope').status_code,
+            httplib.NOT_FOUND
+        )
+
+        resp = self.client.get('/api/v1/avatar/10')
+        self.assertEqual(resp.status_code, httplib.FOUND)
+        self.assertEqual(
+            resp.headers['Location'],
+            'https://intranet.stxnext.pl/api/images/users/10'
+        )
+        self.assertEqual(
+            self.client.get('/avatars/10-abc.png').status_code,
+            httplib.NOT_FOUND
+        )
+        self.assertEqual(
+            self.client.get('/avatars/abc.png').status_code,
+            httplib.NOT_FOUND
+        )
+
+        resp = self.client.get('/')
+        self.assertEqual(resp.status_code, httplib.FOUND)
+        self.assertTrue(resp.headers['Location'].endswith('/presence_weekday'))
+        self.assertNotIn(self.nodes[0], resp.headers['Location'])
+        resp = self.client.get('/presence_weekday')
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertIn('text/html', resp.content_type)
+        self.assertEqual(
+            self.client.get('/api/v1/events').status_code,
+            httplib.NO_CONTENT
+        )
+
+
 def suite():
     """
     Default test suite.
@@ -533,6 +3099,12 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerManagerTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerPartitionsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerServingTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerDownloadTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerAvatarsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerShardingTestCase))
     return base_suite
 
 
@@ -3,20 +3,29 @@
 Helper functions used in views.
 """
 
+import bisect
+import calendar
 import csv
+import heapq
+import hmac
+import locale
 import logging
+import math
+import os
 import pickle
 import threading
 import time
 
-from collections import Counter, defaultdict
-from datetime import datetime
+from array import array
+from collections import Counter, defaultdict, deque
+from cStringIO import StringIO
+from datetime import date as date_type, time as time_type, timedelta
 from functools import wraps
-from json import dumps
+from itertools import chain, groupby
+from json import dumps, load
 from operator import itemgetter
 
-from flask import Response
-from lxml import etree
+from flask import Response, abort, request
 
 from presence_analyzer.main import app
 
@@ -25,6 +34,9 @@ LOCK = threading.Lock()
 
 cache = {}
 
+DAYS_IN_MONTH = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+ROLLING_WINDOWS = (7, 30, 90)
+
 def memoize(expire_time=60):
     """
     Cache decorator. Return cached data if it's not expired.
@@ -57,6 +69,14 @@ def memoize(expire_time=60):
     return decorator_wrapper
 
 
+def file_signature(path):
+    """
+    Returns tuple which changes whenever file at given path is replaced.
+    """
+    stat = os.stat(path)
+    return (path, stat.st_mtime, stat.st_size, stat.st_ino)
+
+
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
@@ -73,6 +93,87 @@ def jsonify(function):
     return inner
 
 
+def single_flight(function):
+    """
+    Coalesces concurrent identical calls of a view returning Response.
+
+    Requests with the same view arguments and query string which arrive
+    while one of them is computed wait for it and get a copy of its body.
+    Nothing is kept after the call finishes.
+    """
+    calls = {}
+    lock = threading.Lock()
+
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        key = pickle.dumps(
+            (args, sorted(kwargs.items()), request.query_string)
+        )
+        with lock:
+            call = calls.get(key)
+            leader = call is None
+            if leader:
+                call = calls[key] = {'done': threading.Event()}
+
+        if leader:
+            try:
+                response = function(*args, **kwargs)
+                call['result'] = (
+                    response.get_data(),
+                    response.status_code,
+                    response.mimetype,
+                )
+                return response
+            except Exception as error:
+                call['error'] = error
+                raise
+            finally:
+                with lock:
+                    del calls[key]
+                call['done'].set()
+
+        call['done'].wait()
+        if 'error' in call:
+            raise call['error']
+        body, status, mimetype = call['result']
+        return Response(body, status=status, mimetype=mimetype)
+    return inner
+
+
+def as_bytes(value):
+    """
+    Returns value encoded to UTF-8 unless it's a byte string already.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def admin_only(function):
+    """
+    Lets through requests carrying ADMIN_TOKEN in X-Admin-Token header.
+
+    Without ADMIN_TOKEN configured admin views don't exist.
+    """
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        token = app.config.get('ADMIN_TOKEN')
+        if not token:
+            abort(404)
+        sent = request.headers.get('X-Admin-Token', '')
+        # Constant time comparison doesn't tell how much of token matched.
+        if not hmac.compare_digest(as_bytes(sent), as_bytes(token)):
+            abort(403)
+        return function(*args, **kwargs)
+    return inner
+
+
 @memoize(600)
 def get_data():
     """
@@ -92,19 +193,131 @@ def get_data():
         }
     }
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
+    return parse_data_csv(app.config['DATA_CSV'])
+
+
+def parse_date_field(value):
+    """
+    Returns date from YYYY-MM-DD string or None if it's malformed.
+
+    Like strptime('%Y-%m-%d') month and day may have one or two digits.
+    """
+    fields = value.split('-')
+    if len(fields) != 3:
+        return None
+    year, month, day = fields
+    if not (
+            len(year) == 4 and 0 < len(month) < 3 and 0 < len(day) < 3 and
+            year.isdigit() and month.isdigit() and day.isdigit()
+    ):
+        return None
+    year, month, day = int(year), int(month), int(day)
+    if not (year and 1 <= month <= 12):
+        return None
+    if not 1 <= day <= DAYS_IN_MONTH[month] + (
+            month == 2 and calendar.isleap(year)
+    ):
+        return None
+    return date_type(year, month, day)
+
+
+def parse_time_field(value):
+    """
+    Returns time from HH:MM:SS string or None if it's malformed.
+
+    Like strptime('%H:%M:%S') every field may have one or two digits.
+    """
+    fields = value.split(':')
+    if len(fields) != 3:
+        return None
+    hour, minute, second = fields
+    if not (
+            0 < len(hour) < 3 and 0 < len(minute) < 3 and
+            0 < len(second) < 3 and
+            hour.isdigit() and minute.isdigit() and second.isdigit()
+    ):
+        return None
+    hour, minute, second = int(hour), int(minute), int(second)
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    return time_type(hour, minute, second)
+
+
+def validate_row(row):
+    """
+    Checks structure of presence CSV row without raising exceptions.
+
+    Returns tuple of (user_id, date, start, end) and None for valid row
+    or None and reason of rejection. Fields after the fourth are ignored.
+    """
+    if len(row) < 4:
+        return None, 'expected 4 fields, got {}'.format(len(row))
+    if not row[0].isdigit():
+        return None, 'malformed user id'
+    date = parse_date_field(row[1])
+    if date is None:
+        return None, 'malformed date'
+    start = parse_time_field(row[2])
+    if start is None:
+        return None, 'malformed start time'
+    end = parse_time_field(row[3])
+    if end is None:
+        return None, 'malformed end time'
+    return (int(row[0]), date, start, end), None
+
+
+def read_rows(path, rejected=None, keep=None, month=None):
+    """
+    Yields valid rows of presence CSV file as returned by validate_row().
+
+    Malformed rows are skipped. If rejected list is given, (line number,
+    reason, row) of every skipped row is appended to it. If keep predicate
+    is given, rows of users it refuses are skipped before being parsed.
+    If (year, month) is given, rows of other months are malformed too.
+    """
+    kept = {}
+    with open(path, 'r') as csvfile:
         presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            try:
+        for row in presence_reader:
+            if keep is not None and row and row[0].isdigit():
                 user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
+                if user_id not in kept:
+                    kept[user_id] = keep(user_id)
+                if not kept[user_id]:
+                    continue
+            values, reason = validate_row(row)
+            if values is not None and month is not None and (
+                    (values[1].year, values[1].month) != month
+            ):
+                values, reason = None, 'outside of {}-{:02d}'.format(*month)
+            if values is not None:
+                yield values
+            elif rejected is not None:
+                rejected.append((presence_reader.line_num, reason, row))
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+
+def write_quarantine(path, rejected):
+    """
+    Writes rejected rows with their line numbers and reasons to CSV file.
+    """
+    with open(path, 'wb') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['line', 'reason', 'row'])
+        for line, reason, row in rejected:
+            writer.writerow([line, reason] + row)
+
+
+def parse_data_csv(path, rejected=None, keep=None, month=None):
+    """
+    Reads presence CSV file from given path, see get_data() for structure.
+
+    Malformed rows, rows of users refused by keep predicate and of other
+    than given month are skipped as in read_rows().
+    """
+    data = {}
+    rows = read_rows(path, rejected, keep, month)
+    for user_id, date, start, end in rows:
+        data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
 
     return data
 
@@ -127,22 +340,21 @@ def get_year_and_months():
         }
     ]
     """
-    data = []
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            try:
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
+    return parse_year_and_months(app.config['DATA_CSV'])
 
-            data.append({
-                'year': date.year,
-                'month': date.month,
-                'date': date.strftime('%Y - %B')
-            })
 
-    return data
+def parse_year_and_months(path):
+    """
+    Reads unique years and months from CSV file at given path.
+    """
+    return [
+        {
+            'year': date.year,
+            'month': date.month,
+            'date': date.strftime('%Y - %B')
+        }
+        for user_id, date, start, end in read_rows(path)
+    ]
 
 
 def get_data_by_date():
@@ -158,7 +370,13 @@ def get_data_by_date():
         (...)
     }
     """
-    data = get_data()
+    return index_by_date(get_data())
+
+
+def index_by_date(data):
+    """
+    Builds date -> {user_id: worktime} index from get_data() structure.
+    """
     result = {}
 
     for user_id, values in data.iteritems():
@@ -175,6 +393,472 @@ def get_data_by_date():
     return result
 
 
+def index_sorted_dates(data):
+    """
+    Builds user_id -> ascending list of dates index from get_data() structure.
+    """
+    return {user_id: sorted(values) for user_id, values in data.iteritems()}
+
+
+def keyset_page(keys, after, limit):
+    """
+    Returns up to limit sorted keys greater than after (None for first page)
+    and cursor for the next page, which is None on the last page.
+    """
+    first = 0 if after is None else bisect.bisect_right(keys, after)
+    page = keys[first:first + limit]
+    has_more = first + limit < len(keys)
+    return page, page[-1] if has_more else None
+
+
+class PrefixSums(object):
+    """
+    Per-user cumulative worktime indexed by day.
+
+    sums[user_id][i] holds worktime of days before first + i days, so total
+    worktime over any date range is a difference of two items.
+    """
+
+    def __init__(self, data):
+        dates = [date for values in data.itervalues() for date in values]
+        self.first = min(dates) if dates else date_type.today()
+        self.days = (max(dates) - self.first).days + 1 if dates else 0
+        self.sums = {}
+        for user_id, values in data.iteritems():
+            daily = array('l', [0]) * self.days
+            for date, worktime in values.iteritems():
+                daily[(date - self.first).days] = interval(
+                    worktime['start'], worktime['end']
+                )
+            sums = array('l', [0]) * (self.days + 1)
+            for i, value in enumerate(daily):
+                sums[i + 1] = sums[i] + value
+            self.sums[user_id] = sums
+
+    def __len__(self):
+        """
+        Returns number of indexed users.
+        """
+        return len(self.sums)
+
+    def offset(self, date):
+        """
+        Returns prefix index of date clamped to indexed days.
+        """
+        return min(max((date - self.first).days, 0), self.days)
+
+    def total(self, user_id, since, until):
+        """
+        Returns user's worktime between since and until inclusive, 0 for
+        reversed range.
+        """
+        sums = self.sums[user_id]
+        # Day after until could overflow date, eg. for date.max.
+        end = 0
+        if until >= self.first:
+            end = min(self.offset(until) + 1, self.days)
+        return max(sums[end] - sums[self.offset(since)], 0)
+
+    def top(self, since, until, k):
+        """
+        Returns k users with the longest worktime in date range, eg:
+        [(11, 118402), (10, 78217)]
+        """
+        totals = (
+            (self.total(user_id, since, until), user_id)
+            for user_id in self.sums
+        )
+        return [
+            (user_id, total)
+            for total, user_id in heapq.nlargest(k, totals)
+            if total
+        ]
+
+
+class WorktimeMatrix(object):
+    """
+    Total worktime of every user in every month kept in one dense array.
+
+    cells[row * len(months) + column] holds worktime of users[row] in
+    months[column], both sorted ascending.
+    """
+
+    def __init__(self, data):
+        self.users = sorted(data)
+        self.months = sorted({
+            (date.year, date.month)
+            for values in data.itervalues()
+            for date in values
+        })
+        columns = {month: i for i, month in enumerate(self.months)}
+        width = len(self.months)
+        self.cells = array('l', [0]) * (len(self.users) * width)
+        for row, user_id in enumerate(self.users):
+            start = row * width
+            for date, worktime in data[user_id].iteritems():
+                self.cells[start + columns[(date.year, date.month)]] += (
+                    interval(worktime['start'], worktime['end'])
+                )
+
+    def __len__(self):
+        """
+        Returns number of cells.
+        """
+        return len(self.cells)
+
+    def totals(self, user_ids):
+        """
+        Returns summed worktime of given users in every month, eg:
+        [['2013-09', 196619], ['2013-10', 3600]]
+        Unknown users are skipped.
+        """
+        width = len(self.months)
+        totals = [0] * width
+        for user_id in set(user_ids):
+            row = bisect.bisect_left(self.users, user_id)
+            if row < len(self.users) and self.users[row] == user_id:
+                for column in range(width):
+                    totals[column] += self.cells[row * width + column]
+
+        return [
+            ['{:04d}-{:02d}'.format(year, month), total]
+            for (year, month), total in zip(self.months, totals)
+        ]
+
+    def select(self, user_ids=None, since=None, until=None, sparse=False):
+        """
+        Returns matrix of given users and (year, month) range inclusive, eg:
+        {
+            'users': [10, 11],
+            'months': ['2013-09', '2013-10'],
+            'rows': [[78217, 0], [118402, 3600]],
+        }
+        Unknown users are skipped. Sparse rows list only non-zero cells as
+        flat [column, worktime, ...] pairs, eg. [[0, 78217], [0, 118402, 1,
+        3600]].
+        """
+        width = len(self.months)
+        first = 0 if since is None else bisect.bisect_left(self.months, since)
+        last = width if until is None else bisect.bisect_right(
+            self.months, until
+        )
+        last = max(first, last)
+
+        if user_ids is None:
+            rows = range(len(self.users))
+        else:
+            rows = []
+            for user_id in sorted(set(user_ids)):
+                row = bisect.bisect_left(self.users, user_id)
+                if row < len(self.users) and self.users[row] == user_id:
+                    rows.append(row)
+
+        result = []
+        for row in rows:
+            cells = self.cells[row * width + first:row * width + last]
+            if sparse:
+                result.append([
+                    item
+                    for column, worktime in enumerate(cells)
+                    if worktime
+                    for item in (column, worktime)
+                ])
+            else:
+                result.append(cells.tolist())
+
+        return {
+            'users': [self.users[row] for row in rows],
+            'months': [
+                '{:04d}-{:02d}'.format(year, month)
+                for year, month in self.months[first:last]
+            ],
+            'rows': result,
+        }
+
+
+class IntervalIndex(object):
+    """
+    Presence entries of every date sorted by start, with sorted end times.
+
+    Counting people present at a moment takes two bisections, listing them
+    one bisection plus a scan of entries which started before it.
+    """
+
+    def __init__(self, data):
+        entries = defaultdict(list)
+        for user_id, values in data.iteritems():
+            for date, worktime in values.iteritems():
+                entries[date].append((
+                    seconds_since_midnight(worktime['start']),
+                    seconds_since_midnight(worktime['end']),
+                    user_id,
+                ))
+
+        self.entries = {}
+        self.starts = {}
+        self.ends = {}
+        for date, items in entries.iteritems():
+            items.sort()
+            self.entries[date] = items
+            self.starts[date] = [start for start, end, user_id in items]
+            self.ends[date] = sorted(end for start, end, user_id in items)
+
+    def __len__(self):
+        """
+        Returns number of indexed dates.
+        """
+        return len(self.entries)
+
+    def count(self, date, moment):
+        """
+        Returns number of people present at given second of date.
+        """
+        if date not in self.entries:
+            return 0
+        return (
+            bisect.bisect_right(self.starts[date], moment) -
+            bisect.bisect_right(self.ends[date], moment)
+        )
+
+    def present(self, date, since, until=None):
+        """
+        Returns (start, end, user_id) of entries overlapping given second
+        of date or, when until is given, half-open window [since, until).
+        """
+        if date not in self.entries:
+            return []
+        if until is None:
+            started = bisect.bisect_right(self.starts[date], since)
+        else:
+            started = bisect.bisect_left(self.starts[date], until)
+        return [
+            entry for entry in self.entries[date][:started]
+            if entry[1] > since
+        ]
+
+
+class TimeSketch(object):
+    """
+    Mergeable quantile sketch of times of day.
+
+    Times are counted in buckets of resolution seconds, so memory and query
+    cost are bounded by the number of buckets in a day regardless of how
+    many values were added. Quantiles have exact rank; returned value is the
+    middle of the bucket holding the exact nearest-rank quantile, so it is
+    off by at most resolution / 2 seconds.
+    """
+
+    def __init__(self, resolution=60):
+        self.resolution = resolution
+        self.count = 0
+        self.buckets = defaultdict(int)
+
+    def add(self, seconds):
+        """
+        Adds time given as seconds since midnight.
+        """
+        self.buckets[seconds // self.resolution] += 1
+        self.count += 1
+
+    def merge(self, other):
+        """
+        Adds all values counted by other sketch of the same resolution.
+        """
+        for bucket, count in other.buckets.iteritems():
+            self.buckets[bucket] += count
+        self.count += other.count
+
+    def quantile(self, percent):
+        """
+        Returns percent quantile in seconds since midnight, 0 when empty.
+        """
+        if not self.count:
+            return 0
+        rank = max(int(math.ceil(percent / 100.0 * self.count)), 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                break
+        return bucket * self.resolution + self.resolution // 2
+
+
+def start_end_sketches(items, resolution=60, base=None):
+    """
+    Builds start and end time sketches of presence entries by weekday.
+
+    If base sketches are given, result counts their values too; base ones
+    are left intact.
+    """
+    result = [
+        {'start': TimeSketch(resolution), 'end': TimeSketch(resolution)}
+        for i in range(7)
+    ]
+    if base is not None:
+        for sketches, previous in zip(result, base):
+            sketches['start'].merge(previous['start'])
+            sketches['end'].merge(previous['end'])
+    for date in items:
+        sketches = result[date.weekday()]
+        sketches['start'].add(seconds_since_midnight(items[date]['start']))
+        sketches['end'].add(seconds_since_midnight(items[date]['end']))
+
+    return result
+
+
+class RollingStats(object):
+    """
+    Moving means of daily worktime and start time of one user.
+
+    Means cover days with presence within last `window` calendar days. Days
+    are added in ascending order, every window keeps its days in a deque
+    with running sums, so adding a day costs O(1) per window.
+    """
+
+    def __init__(self, windows=ROLLING_WINDOWS):
+        self.windows = windows
+        self.dates = []
+        self.series = {
+            window: {'worktime': [], 'start': []} for window in windows
+        }
+        self._days = {window: deque() for window in windows}
+        self._sums = {window: [0, 0] for window in windows}
+
+    def add(self, date, worktime, start):
+        """
+        Appends day later than every added one and its means.
+        """
+        if self.dates and date <= self.dates[-1]:
+            raise ValueError('Days must be added in ascending order')
+
+        self.dates.append(date)
+        day = date.toordinal()
+        for window in self.windows:
+            days, sums = self._days[window], self._sums[window]
+            days.append((day, worktime, start))
+            sums[0] += worktime
+            sums[1] += start
+            while days[0][0] <= day - window:
+                _, old_worktime, old_start = days.popleft()
+                sums[0] -= old_worktime
+                sums[1] -= old_start
+
+            series = self.series[window]
+            series['worktime'].append(float(sums[0]) / len(days))
+            series['start'].append(float(sums[1]) / len(days))
+
+    def extend(self, items):
+        """
+        Adds presence entries of days after the last added one.
+        """
+        for date in sorted(items):
+            if not self.dates or date > self.dates[-1]:
+                self.add(
+                    date,
+                    interval(items[date]['start'], items[date]['end']),
+                    seconds_since_midnight(items[date]['start']),
+                )
+
+    def copy(self):
+        """
+        Returns independent copy which can be extended further.
+        """
+        result = RollingStats(self.windows)
+        result.dates = list(self.dates)
+        for window in self.windows:
+            result.series[window] = {
+                name: list(values)
+                for name, values in self.series[window].iteritems()
+            }
+            result._days[window] = deque(self._days[window])
+            result._sums[window] = list(self._sums[window])
+        return result
+
+
+def rolling_stats(items, windows=ROLLING_WINDOWS):
+    """
+    Builds RollingStats of user's presence entries.
+    """
+    stats = RollingStats(windows)
+    stats.extend(items)
+    return stats
+
+
+def period_range(period, year, number=None):
+    """
+    Returns first and last date of given week (ISO), month, quarter or year.
+
+    Raises ValueError for unknown period or number out of range.
+    """
+    if period == 'year' and number is None:
+        return date_type(year, 1, 1), date_type(year, 12, 31)
+    if period == 'quarter' and 1 <= number <= 4:
+        since = date_type(year, 3 * number - 2, 1)
+        until = date_type(year + number // 4, 3 * number % 12 + 1, 1)
+        return since, until - timedelta(days=1)
+    if period == 'month' and 1 <= number <= 12:
+        since = date_type(year, number, 1)
+        until = date_type(year + number // 12, number % 12 + 1, 1)
+        return since, until - timedelta(days=1)
+    if period == 'week' and 1 <= number <= 53:
+        january_4th = date_type(year, 1, 4)
+        since = january_4th + timedelta(
+            days=-january_4th.weekday(), weeks=number - 1
+        )
+        if since.isocalendar()[0] != year:
+            raise ValueError('Year {} has no week {}'.format(year, number))
+        return since, since + timedelta(days=6)
+    raise ValueError('Unknown period {} {} {}'.format(period, year, number))
+
+
+def occupancy_curves(data, resolution):
+    """
+    Counts users present at every resolution seconds of the day.
+
+    Each entry adds +1 at its first sample and -1 after its last one, so a
+    day's curve is a running sum over these events. Returns dict eg:
+    {
+        'dates': {datetime.date(2013, 9, 10): [0, ..., 2, 2, 1, ..., 0]},
+        'weekdays': [[0.0, ..., 1.5, ..., 0.0], ...],  # mean for Mon..Sun
+    }
+    """
+    samples = 24 * 3600 // resolution
+    events = {}
+    for values in data.itervalues():
+        for date, worktime in values.iteritems():
+            start = seconds_since_midnight(worktime['start'])
+            end = seconds_since_midnight(worktime['end'])
+            if end <= start:
+                continue
+            diff = events.setdefault(date, [0] * (samples + 1))
+            # Sample t counts entries with start <= t < end.
+            diff[min(-(-start // resolution), samples)] += 1
+            diff[min(-(-end // resolution), samples)] -= 1
+
+    dates = {}
+    weekdays = [[0] * samples for i in range(7)]
+    days = [0] * 7
+    for date, diff in events.iteritems():
+        curve = []
+        present = 0
+        for change in diff[:samples]:
+            present += change
+            curve.append(present)
+        dates[date] = curve
+        days[date.weekday()] += 1
+        totals = weekdays[date.weekday()]
+        for i, present in enumerate(curve):
+            totals[i] += present
+
+    return {
+        'dates': dates,
+        'weekdays': [
+            [float(total) / count if count else 0 for total in totals]
+            for totals, count in zip(weekdays, days)
+        ],
+    }
+
+
 def get_xml_data():
     """
     Extracts presence data from XML file and groups it by user_id.
@@ -193,7 +877,16 @@ def get_xml_data():
         },
     ]
     """
-    with open(app.config['DATA_XML'], 'r') as xmlfile:
+    return parse_xml_data(app.config['DATA_XML'])
+
+
+def parse_xml_data(path):
+    """
+    Reads users from XML file at given path, see get_xml_data() for structure.
+    """
+    from lxml import etree
+
+    with open(path, 'r') as xmlfile:
         xml_data = etree.parse(xmlfile)
         server = xml_data.find('server')
         link = '{}://{}'.format(
@@ -219,6 +912,49 @@ def get_xml_data():
     return data
 
 
+def user_directory(users):
+    """
+    Returns users sorted by name for dropdown.
+
+    Without Polish collation installed names are sorted by code points, so
+    snapshots, which build the directory ahead, can still be published.
+    """
+    try:
+        locale.setlocale(locale.LC_COLLATE, 'pl_PL.UTF-8')
+    except locale.Error:
+        log.warning('No pl_PL.UTF-8 locale, users sorted by code points')
+
+    return sorted(
+        [
+            {
+                'user_id': value['user_id'],
+                'name': value['name'],
+                'avatar': value['avatar']
+            }
+            for value in users
+        ],
+        key=itemgetter('name'), cmp=locale.strcoll
+    )
+
+
+def parse_groups_json(path):
+    """
+    Reads user groups from JSON file mapping group name to user ids, eg:
+    {
+        "backend": [10, 11],
+        "frontend": [12]
+    }
+    Returns {name: sorted user ids}.
+    """
+    with open(path, 'r') as groups_file:
+        groups = load(groups_file)
+
+    return {
+        name: sorted(set(int(user_id) for user_id in user_ids))
+        for name, user_ids in groups.iteritems()
+    }
+
+
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
@@ -264,6 +1000,94 @@ def group_by_weekday_by_start_end(items):
 
     return result
 
+
+def merge_weekdays(aggregates):
+    """
+    Merges group_by_weekday() results of many users into one.
+    """
+    return [
+        list(chain.from_iterable(weekdays[weekday] for weekdays in aggregates))
+        for weekday in range(7)
+    ]
+
+
+def merge_weekdays_start_end(aggregates):
+    """
+    Merges group_by_weekday_by_start_end() results of many users into one.
+    """
+    return {
+        weekday: {
+            key: list(chain.from_iterable(
+                weekdays[weekday][key] for weekdays in aggregates
+            ))
+            for key in ('start', 'end')
+        }
+        for weekday in range(7)
+    }
+
+
+def iter_intervals(data, user_ids=None, since=None, until=None):
+    """
+    Yields presence entries ordered by user and date, eg:
+    (10, '2013-09-10', '09:39:05', '17:59:52', 30047)
+
+    Entries can be limited to given users and inclusive date range.
+    """
+    for user_id in sorted(data if user_ids is None else user_ids):
+        items = data.get(user_id, {})
+        for date in sorted(items):
+            if since is not None and date < since:
+                continue
+            if until is not None and date > until:
+                break
+            start = items[date]['start']
+            end = items[date]['end']
+            yield (
+                user_id,
+                date.isoformat(),
+                start.isoformat(),
+                end.isoformat(),
+                interval(start, end),
+            )
+
+
+def iter_monthly(data, user_ids=None, since=None, until=None):
+    """
+    Yields total worktime and number of days per user and month, eg:
+    (10, 2013, 9, 78217, 3)
+
+    Accepts the same filters as iter_intervals().
+    """
+    entries = iter_intervals(data, user_ids, since, until)
+    for (user_id, year_month), rows in groupby(
+            entries, key=lambda row: (row[0], row[1][:7])
+    ):
+        worktimes = [row[4] for row in rows]
+        year, month = year_month.split('-')
+        yield user_id, int(year), int(month), sum(worktimes), len(worktimes)
+
+
+def csv_lines(header, rows):
+    """
+    Formats header and rows as CSV lines, one at a time.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in chain([header], rows):
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def ndjson_lines(header, rows):
+    """
+    Formats rows as newline delimited JSON objects keyed by header.
+    """
+    for row in rows:
+        yield dumps(dict(zip(header, row))) + '\n'
+
+
 def seconds_since_midnight(time):
     """
     Calculates amount of seconds since midnight.
@@ -271,6 +1095,15 @@ def seconds_since_midnight(time):
     return time.hour * 3600 + time.minute * 60 + time.second
 
 
+def seconds_to_time(seconds):
+    """
+    Formats amount of seconds since midnight as HH:MM:SS.
+    """
+    return '{:02d}:{:02d}:{:02d}'.format(
+        seconds // 3600, seconds % 3600 // 60, seconds % 60
+    )
+
+
 def interval(start, end):
     """
     Calculates inverval in seconds between two datetime.time objects.
@@ -3,31 +3,110 @@
 Defines views.
 """
 
+import Queue
 import calendar
-import locale
+import gc
 import logging
+import os
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from hashlib import md5
+from json import dumps
 from operator import itemgetter
 
-from flask import abort, redirect
+from flask import (
+    Response,
+    abort,
+    redirect,
+    request,
+    send_from_directory,
+    stream_with_context,
+    url_for
+)
 from flask_mako import render_template
 from jinja2 import TemplateNotFound
 from mako.exceptions import TopLevelLookupException
 
+from presence_analyzer.avatars import AvatarCache
 from presence_analyzer.main import app
+from presence_analyzer.manager import DATASETS, DISCONNECT, data_manager
+from presence_analyzer.memory import TypeSnapshots, deep_size
 from presence_analyzer.utils import (
-    get_data,
-    get_data_by_date,
-    get_xml_data,
-    get_year_and_months,
-    group_by_weekday,
-    group_by_weekday_by_start_end,
+    admin_only,
+    cache,
+    csv_lines,
+    interval,
+    iter_intervals,
+    iter_monthly,
     jsonify,
+    keyset_page,
     mean,
+    ndjson_lines,
+    period_range,
+    seconds_since_midnight,
+    seconds_to_time,
+    single_flight,
     top_five
 )
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+PAGE_CACHE = {}
+MISSING_PAGES = set()
+MISSING_PAGES_LIMIT = 1000
+
+AVATAR_CACHES = {}
+TYPE_SNAPSHOTS = TypeSnapshots()
+# Thumbnail names change with content, redirects may point to a new one.
+AVATAR_MAX_AGE = 365 * 24 * 3600
+AVATAR_REDIRECT_MAX_AGE = 3600
+
+EXPORTS = {
+    'intervals': (
+        ('user_id', 'date', 'start', 'end', 'worktime'),
+        iter_intervals,
+    ),
+    'monthly': (
+        ('user_id', 'year', 'month', 'worktime', 'days'),
+        iter_monthly,
+    ),
+}
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', csv_lines),
+    'ndjson': ('application/x-ndjson', ndjson_lines),
+}
+
+
+def date_arg(name):
+    """
+    Reads optional YYYY-MM-DD query parameter, aborts with 400 if malformed.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        log.debug('Wrong date in %s parameter: %s', name, value)
+        abort(400)
+
+
+def month_arg(name):
+    """
+    Reads optional YYYY-MM query parameter as (year, month), aborts with 400
+    if malformed.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        month = datetime.strptime(value, '%Y-%m')
+    except ValueError:
+        log.debug('Wrong month in %s parameter: %s', name, value)
+        abort(400)
+    return month.year, month.month
+
 
 @app.route('/')
 def index():
@@ -41,77 +120,176 @@ def index():
 def static_page(page_name):
     """
     Template generator.
+
+    Pages take no arguments, so rendered ones are cached with their ETags
+    and unknown names are remembered; repeated requests skip Mako.
     """
-    try:
-        return render_template('{}.html'.format(page_name))
-    except (TemplateNotFound, TopLevelLookupException):
+    if page_name in MISSING_PAGES:
         abort(404)
 
+    key = (request.script_root, page_name)
+    page = PAGE_CACHE.get(key)
+    if page is None:
+        try:
+            body = render_template(
+                '{}.html'.format(page_name),
+                events_stream=app.config.get('EVENTS_STREAM', False),
+            )
+        except (TemplateNotFound, TopLevelLookupException):
+            if not app.debug and len(MISSING_PAGES) < MISSING_PAGES_LIMIT:
+                MISSING_PAGES.add(page_name)
+            abort(404)
+        page = (body, md5(body).hexdigest())
+        if not app.debug:
+            PAGE_CACHE[key] = page
+
+    response = Response(page[0], mimetype='text/html')
+    response.set_etag(page[1])
+    return response.make_conditional(request)
+
+
+def compile_pages():
+    """
+    Renders every page template ahead of first request.
+
+    With MAKO_MODULE_DIRECTORY configured Mako also stores compiled
+    template modules there, so restarted workers skip compilation.
+    """
+    folder = os.path.join(app.root_path, app.template_folder)
+    for name in sorted(os.listdir(folder)):
+        page_name, extension = os.path.splitext(name)
+        if extension == '.html':
+            with app.test_request_context('/' + page_name):
+                static_page(page_name)
+
 
 @app.route('/api/v1/users', methods=['GET'])
+@single_flight
 @jsonify
 def users_view():
     """
     Users listing for dropdown.
     """
-    locale.setlocale(locale.LC_COLLATE, 'pl_PL.UTF-8')
-    data = get_xml_data()
+    return data_manager.current().directory
 
-    return sorted(
-        [
-            {
-                'user_id': value['user_id'],
-                'name': value['name'],
-                'avatar': value['avatar']
-            }
-            for value in data
-        ],
-        key=itemgetter('name'), cmp=locale.strcoll
-    )
 
+def avatar_cache():
+    """
+    Returns AvatarCache of AVATAR_CACHE directory.
+    """
+    directory = app.config['AVATAR_CACHE']
+    if directory not in AVATAR_CACHES:
+        AVATAR_CACHES[directory] = AvatarCache(
+            directory,
+            app.config.get('AVATAR_SIZE', 128),
+            max_age=app.config.get('AVATAR_REVALIDATE', 24 * 3600),
+        )
+    return AVATAR_CACHES[directory]
 
-@app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
-@jsonify
-def mean_time_weekday_view(user_id):
+
+@app.route('/api/v1/avatar/<int:user_id>', methods=['GET'])
+def avatar_view(user_id):
     """
-    Returns mean presence time of given user grouped by weekday.
+    Redirects to locally cached thumbnail of user's avatar.
+
+    Falls back to intranet image when cache is off or fetch fails.
     """
-    data = get_data()
-    if user_id not in data:
+    user = data_manager.current().users_by_id.get(user_id)
+    if user is None:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
+    name = None
+    if app.config.get('AVATAR_CACHE'):
+        name = avatar_cache().name(user_id, user['avatar'])
+    if name is None:
+        return redirect(user['avatar'])
+
+    response = redirect(url_for('avatar_file', name=name))
+    response.cache_control.max_age = AVATAR_REDIRECT_MAX_AGE
+    return response
+
+
+@app.route('/avatars/<string:name>', methods=['GET'])
+def avatar_file(name):
+    """
+    Serves cached thumbnail, its name changes with content.
+    """
+    if not app.config.get('AVATAR_CACHE'):
+        abort(404)
+    return send_from_directory(
+        app.config['AVATAR_CACHE'],
+        name,
+        cache_timeout=AVATAR_MAX_AGE,
+    )
+
+
+def mean_time_weekday(weekdays):
+    """
+    Returns mean presence time of utils.group_by_weekday() result.
+    """
+    return [
         (calendar.day_abbr[weekday], mean(intervals))
         for weekday, intervals in enumerate(weekdays)
     ]
 
+
+def presence_weekday(weekdays):
+    """
+    Returns total presence time of utils.group_by_weekday() result.
+    """
+    result = [
+        (calendar.day_abbr[weekday], sum(intervals))
+        for weekday, intervals in enumerate(weekdays)
+    ]
+
+    result.insert(0, ('Weekday', 'Presence (s)'))
     return result
 
 
+def presence_start_end(weekdays):
+    """
+    Returns mean time of start and end of work of
+    utils.group_by_weekday_by_start_end() result.
+    """
+    return [
+        (calendar.day_abbr[weekday], mean(values['start']), mean(values['end']))
+        for weekday, values in weekdays.iteritems()
+    ]
+
+
+@app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@single_flight
+@jsonify
+def mean_time_weekday_view(user_id):
+    """
+    Returns mean presence time of given user grouped by weekday.
+    """
+    weekdays = data_manager.current().by_weekday
+    if user_id not in weekdays:
+        log.debug('User %s not found!', user_id)
+        abort(404)
+
+    return mean_time_weekday(weekdays[user_id])
+
+
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
+@single_flight
 @jsonify
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    weekdays = data_manager.current().by_weekday
+    if user_id not in weekdays:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return presence_weekday(weekdays[user_id])
 
 
 @app.route('/api/v1/years_and_months/', methods=['GET'])
+@single_flight
 @jsonify
 def presence_years_and_months():
     """
@@ -123,49 +301,652 @@ def presence_years_and_months():
         [...],
     ]
     """
-    data = get_year_and_months()
-    result = sorted(
-        [
-            date for date in
-            set(tuple(date.values()) for date in data)
-        ],
-        key=itemgetter(2, 1), reverse=True
-    )
-
-    return result
+    return data_manager.current().months
 
 
 @app.route('/api/v1/top_five/<int:year>/<int:month>', methods=['GET'])
+@single_flight
 @jsonify
 def top_five_worktime(year, month):
     """
     Returns top 5 work time for users grouped by date.
     """
-    worktime = get_data_by_date()
-    result = [
-        (values)
-        for date, values in worktime.iteritems()
-        if date.year == year and date.month == month
-    ]
+    worktime = data_manager.current().month_by_date(year, month)
 
-    return top_five(result)
+    return top_five(worktime.values())
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
+@single_flight
 @jsonify
 def mean_time_of_start_and_end_work(user_id):
     """
     Returns mean time of start and end of work.
     """
-    data = get_data()
-    if user_id not in data:
+    weekdays = data_manager.current().by_weekday_start_end
+    if user_id not in weekdays:
+        log.debug('User %s not found!', user_id)
+        abort(404)
+
+    return presence_start_end(weekdays[user_id])
+
+
+def group_aggregate(dataset, group):
+    """
+    Returns group's entry of given snapshot dataset, 404 for unknown group.
+    """
+    aggregates = getattr(data_manager.current(), dataset)
+    if group not in aggregates:
+        log.debug('Group %s not found!', group)
+        abort(404)
+
+    return aggregates[group]
+
+
+@app.route('/api/v1/groups', methods=['GET'])
+@jsonify
+def groups_view():
+    """
+    Returns user groups sorted by name, eg:
+    [
+        {'name': 'backend', 'user_ids': [10, 11]},
+        {'name': 'frontend', 'user_ids': [12]},
+    ]
+    """
+    return [
+        {'name': name, 'user_ids': user_ids}
+        for name, user_ids in sorted(data_manager.current().groups.items())
+    ]
+
+
+@app.route('/api/v1/group/mean_time_weekday/<string:group>', methods=['GET'])
+@single_flight
+@jsonify
+def group_mean_time_weekday_view(group):
+    """
+    Returns mean presence time of given group's members grouped by weekday.
+    """
+    return mean_time_weekday(group_aggregate('groups_by_weekday', group))
+
+
+@app.route('/api/v1/group/presence_weekday/<string:group>', methods=['GET'])
+@single_flight
+@jsonify
+def group_presence_weekday_view(group):
+    """
+    Returns total presence time of given group's members grouped by weekday.
+    """
+    return presence_weekday(group_aggregate('groups_by_weekday', group))
+
+
+@app.route(
+    '/api/v1/group/presence_start_end/<string:group>',
+    methods=['GET']
+)
+@single_flight
+@jsonify
+def group_presence_start_end_view(group):
+    """
+    Returns mean time of start and end of work of given group's members.
+    """
+    return presence_start_end(
+        group_aggregate('groups_by_weekday_start_end', group)
+    )
+
+
+@app.route('/api/v1/group/worktime_by_month/<string:group>', methods=['GET'])
+@single_flight
+@jsonify
+def group_worktime_by_month_view(group):
+    """
+    Returns total worktime of given group's members by month, eg:
+    [['2013-09', 196619], ['2013-10', 3600]]
+    """
+    return group_aggregate('groups_by_month', group)
+
+
+USER_PAGES = {
+    'mean_time_weekday': ('by_weekday', mean_time_weekday),
+    'presence_weekday': ('by_weekday', presence_weekday),
+    'presence_start_end': ('by_weekday_start_end', presence_start_end),
+}
+
+
+@app.route('/api/v1/bootstrap/<string:page_name>', methods=['GET'])
+@single_flight
+@jsonify
+def bootstrap_view(page_name):
+    """
+    Returns everything page needs to draw its first chart, eg:
+    {
+        'version': 3,
+        'users': [{'user_id': 10, 'name': 'Maciej Z.', 'avatar': ...}],
+        'months': [['2013 - September', 9, 2013]],
+        'selected': 10,
+        'view': [['Weekday', 'Presence (s)'], ['Mon', 0], ...],
+    }
+    All parts come from one snapshot. Weekday pages select user_id argument
+    or first user with presence data, top_five_by_month selects year and
+    month arguments or the newest month.
+    """
+    if page_name not in USER_PAGES and page_name != 'top_five_by_month':
+        abort(404)
+
+    snapshot = data_manager.current()
+    users = snapshot.directory
+    selected = view = None
+
+    if page_name in USER_PAGES:
+        dataset, chart = USER_PAGES[page_name]
+        data = getattr(snapshot, dataset)
+        selected = request.args.get('user_id', type=int)
+        if selected is None:
+            selected = next(
+                (user['user_id'] for user in users if user['user_id'] in data),
+                None
+            )
+        if selected in data:
+            view = chart(data[selected])
+    else:
+        year = request.args.get('year', type=int)
+        month = request.args.get('month', type=int)
+        if (year is None or month is None) and snapshot.months:
+            _, month, year = snapshot.months[0]
+        if year is not None and month is not None:
+            selected = '{}-{}'.format(year, month)
+            view = top_five(snapshot.month_by_date(year, month).values())
+
+    return {
+        'version': snapshot.version,
+        'users': users,
+        'months': snapshot.months,
+        'selected': selected,
+        'view': view,
+    }
+
+
+@app.route('/api/v1/datasets', methods=['GET'])
+@jsonify
+def datasets_view():
+    """
+    Returns derived datasets of current snapshot, eg:
+    [
+        {
+            'name': 'by_date',
+            'inputs': ['data'],
+            'built': True,
+            'version': 2,
+            'seconds': 0.012,
+            'size': 248,
+        },
+    ]
+    Version is the data version dataset was built for, carried over to
+    later ones as long as its inputs don't change.
+    """
+    snapshot = data_manager.current()
+    result = []
+    for name, dataset in DATASETS.iteritems():
+        stats = snapshot.stats.get(name, {})
+        result.append({
+            'name': name,
+            'inputs': list(dataset.inputs),
+            'built': name in snapshot.__dict__,
+            'version': stats.get('version'),
+            'seconds': stats.get('seconds'),
+            'size': stats.get('size'),
+        })
+    return result
+
+
+@app.route('/api/v1/admin/memory', methods=['GET'])
+@admin_only
+@jsonify
+def memory_view():
+    """
+    Returns entries and approximate bytes of caches and built datasets, eg:
+    {
+        'caches': [{'name': 'utils.cache', 'entries': 2, 'bytes': 5120}],
+        'datasets': [{'name': 'data', 'size': 84, 'bytes': 4194304}],
+        'gc': [512, 3, 1],
+    }
+    """
+    snapshot = data_manager.current()
+    caches = [
+        ('utils.cache', cache),
+        ('views.PAGE_CACHE', PAGE_CACHE),
+        ('views.MISSING_PAGES', MISSING_PAGES),
+        ('views.AVATAR_CACHES', AVATAR_CACHES),
+    ]
+    if snapshot.partitions is not None:
+        caches.append(
+            ('partitions', dict(snapshot.partitions.loaded_items()))
+        )
+
+    return {
+        'caches': [
+            {'name': name, 'entries': len(value), 'bytes': deep_size(value)}
+            for name, value in caches
+        ],
+        'datasets': [
+            {
+                'name': name,
+                'size': snapshot.stats.get(name, {}).get('size'),
+                'bytes': deep_size(snapshot.__dict__[name]),
+            }
+            for name in DATASETS
+            if name in snapshot.__dict__
+        ],
+        'gc': gc.get_count(),
+    }
+
+
+@app.route('/api/v1/admin/memory/snapshots', methods=['POST'])
+@admin_only
+@jsonify
+def take_memory_snapshot():
+    """
+    Takes snapshot of live objects counted by type, returns its id.
+    """
+    return {'id': TYPE_SNAPSHOTS.take()}
+
+
+@app.route(
+    '/api/v1/admin/memory/snapshots/<int:first>/<int:second>',
+    methods=['GET']
+)
+@admin_only
+@jsonify
+def memory_snapshots_diff(first, second):
+    """
+    Returns types whose count changed the most between two snapshots as
+    [type, count before, count after], limit argument (20) long.
+    """
+    try:
+        return TYPE_SNAPSHOTS.diff(
+            first, second, request.args.get('limit', 20, type=int)
+        )
+    except KeyError:
+        abort(404)
+
+
+@app.route('/api/v1/export/<string:kind>.<string:fmt>', methods=['GET'])
+def export_view(kind, fmt):
+    """
+    Streams presence entries or monthly totals as CSV or NDJSON.
+
+    Optional query parameters: user_id (repeatable), from and to dates.
+    """
+    if kind not in EXPORTS or fmt not in EXPORT_FORMATS:
+        abort(404)
+
+    header, rows = EXPORTS[kind]
+    mimetype, lines = EXPORT_FORMATS[fmt]
+    user_ids = request.args.getlist('user_id', type=int) or None
+    since = date_arg('from')
+    until = date_arg('to')
+    data = data_manager.current().data
+
+    return Response(
+        stream_with_context(
+            lines(header, rows(data, user_ids, since, until))
+        ),
+        mimetype=mimetype,
+    )
+
+
+@app.route('/api/v1/presence/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_days_view(user_id):
+    """
+    Returns one page of given user's presence entries ordered by date.
+
+    Pages are addressed by cursor: pass 'next' of previous page as 'after'.
+    Page size is set by 'limit', at most PRESENCE_PAGE_LIMIT entries.
+    """
+    snapshot = data_manager.current()
+    if user_id not in snapshot.data:
+        log.debug('User %s not found!', user_id)
+        abort(404)
+
+    limit = request.args.get(
+        'limit', app.config.get('PRESENCE_PAGE_SIZE', 31), type=int
+    )
+    if not 0 < limit <= app.config.get('PRESENCE_PAGE_LIMIT', 1000):
+        abort(400)
+
+    dates, cursor = keyset_page(
+        snapshot.dates[user_id], date_arg('after'), limit
+    )
+    items = snapshot.data[user_id]
+    return {
+        'items': [
+            {
+                'date': date.isoformat(),
+                'start': items[date]['start'].isoformat(),
+                'end': items[date]['end'].isoformat(),
+                'worktime': interval(items[date]['start'], items[date]['end']),
+            }
+            for date in dates
+        ],
+        'next': cursor.isoformat() if cursor is not None else None,
+    }
+
+
+@app.route('/api/v1/top', methods=['GET'])
+@app.route('/api/v1/top/<string:period>/<int:year>', methods=['GET'])
+@app.route(
+    '/api/v1/top/<string:period>/<int:year>/<int:number>', methods=['GET']
+)
+@single_flight
+@jsonify
+def top_worktime_view(period=None, year=None, number=None):
+    """
+    Returns k users with the longest worktime in given period, eg:
+    /api/v1/top/year/2013, /api/v1/top/quarter/2013/3,
+    /api/v1/top/month/2013/9, /api/v1/top/week/2013/37,
+    /api/v1/top?from=2013-09-01&to=2013-09-15&k=10
+    """
+    if period is None:
+        since, until = date_arg('from'), date_arg('to')
+        if since is None or until is None or since > until:
+            abort(400)
+    else:
+        try:
+            since, until = period_range(period, year, number)
+        except ValueError:
+            log.debug('Wrong period %s/%s/%s', period, year, number)
+            abort(404)
+
+    k = request.args.get('k', 5, type=int)
+    if not 0 < k <= app.config.get('TOP_LIMIT', 100):
+        abort(400)
+
+    return data_manager.current().worktime_sums.top(since, until, k)
+
+
+@app.route('/api/v1/worktime_matrix', methods=['GET'])
+def worktime_matrix_view():
+    """
+    Returns users x months worktime matrix, see utils.WorktimeMatrix.
+
+    Optional arguments: users=10,11, from=2013-09, to=2013-12 and
+    encoding=sparse. Matrix is built once per snapshot and responses carry
+    ETag of data and arguments.
+    """
+    user_ids = None
+    if request.args.get('users'):
+        try:
+            user_ids = [
+                int(user_id) for user_id in request.args['users'].split(',')
+            ]
+        except ValueError:
+            log.debug('Wrong users parameter: %s', request.args['users'])
+            abort(400)
+
+    encoding = request.args.get('encoding', 'dense')
+    if encoding not in ('dense', 'sparse'):
+        abort(400)
+
+    snapshot = data_manager.current()
+    result = snapshot.worktime_matrix.select(
+        user_ids,
+        month_arg('from'),
+        month_arg('to'),
+        sparse=encoding == 'sparse',
+    )
+
+    response = Response(
+        dumps(result, separators=(',', ':')),
+        mimetype='application/json',
+    )
+    response.set_etag(
+        md5(repr((snapshot.signature, request.query_string))).hexdigest()
+    )
+    return response.make_conditional(request)
+
+
+@app.route('/api/v1/rolling/<int:user_id>', methods=['GET'])
+@jsonify
+def rolling_view(user_id):
+    """
+    Returns 7, 30 and 90 days moving means of user's daily worktime and
+    start time (seconds since midnight), eg:
+    {
+        'dates': ['2013-09-10', '2013-09-11'],
+        'series': {
+            '7': {'worktime': [30047.0, 24123.5], 'start': [34745.0, ...]},
+            ...
+        }
+    }
+    Optional arguments: window=7,30 and from/to dates.
+    """
+    stats = data_manager.current().rolling.get(user_id)
+    if stats is None:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday_by_start_end(data[user_id])
+    try:
+        windows = [
+            int(window)
+            for window in request.args.get('window', '').split(',')
+            if window
+        ] or list(stats.windows)
+    except ValueError:
+        abort(400)
+    if not set(windows) <= set(stats.windows):
+        abort(400)
+
+    since, until = date_arg('from'), date_arg('to')
+    first = 0 if since is None else bisect_left(stats.dates, since)
+    last = len(stats.dates) if until is None else bisect_right(
+        stats.dates, until
+    )
+
+    return {
+        'dates': [date.isoformat() for date in stats.dates[first:last]],
+        'series': {
+            str(window): {
+                name: values[first:last]
+                for name, values in stats.series[window].iteritems()
+            }
+            for window in windows
+        },
+    }
+
+
+def time_arg(name):
+    """
+    Reads optional HH:MM[:SS] query parameter as seconds since midnight,
+    aborts with 400 if malformed.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    for time_format in ('%H:%M:%S', '%H:%M'):
+        try:
+            return seconds_since_midnight(
+                datetime.strptime(value, time_format).time()
+            )
+        except ValueError:
+            pass
+    log.debug('Wrong time in %s parameter: %s', name, value)
+    abort(400)
+
+
+@app.route('/api/v1/present/<string:day>', methods=['GET'])
+@jsonify
+def present_view(day):
+    """
+    Returns users present on YYYY-MM-DD date at moment given by 'at' or
+    during window given by 'from' and 'to' (HH:MM[:SS]), eg:
+    [
+        {
+            'user_id': 10,
+            'name': 'Maciej Z.',
+            'start': '09:39:05',
+            'end': '17:59:52',
+        },
+    ]
+    """
+    try:
+        date = datetime.strptime(day, '%Y-%m-%d').date()
+    except ValueError:
+        abort(404)
+
+    moment, since, until = time_arg('at'), time_arg('from'), time_arg('to')
+    if moment is not None:
+        since, until = moment, None
+    elif since is None or until is None or since >= until:
+        abort(400)
+
+    snapshot = data_manager.current()
+    result = []
+    intervals = snapshot.intervals_for(date)
+    for start, end, user_id in intervals.present(date, since, until):
+        user = snapshot.users_by_id.get(user_id, {})
+        result.append({
+            'user_id': user_id,
+            'name': user.get('name'),
+            'start': seconds_to_time(start),
+            'end': seconds_to_time(end),
+        })
+
+    return sorted(result, key=itemgetter('start'))
+
+
+def resolution_arg():
+    """
+    Reads sampling resolution in seconds, one which divides a day evenly.
+    """
+    resolution = request.args.get('resolution', 3600, type=int)
+    if not 60 <= resolution <= 24 * 3600 or 24 * 3600 % resolution:
+        abort(400)
+    return resolution
+
+
+def time_labels(resolution):
+    """
+    Returns HH:MM label of every sample taken at given resolution.
+    """
+    return [
+        '{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60)
+        for seconds in range(0, 24 * 3600, resolution)
+    ]
+
+
+@app.route('/api/v1/occupancy/weekday', methods=['GET'])
+@jsonify
+def occupancy_weekday_view():
+    """
+    Returns mean number of people present at each time of every weekday.
+    """
+    resolution = resolution_arg()
+    curves = data_manager.current().occupancy(resolution)['weekdays']
     result = [
-        (calendar.day_abbr[weekday], mean(values['start']), mean(values['end']))
-        for weekday, values in weekdays.iteritems()
+        [label] + [curve[i] for curve in curves]
+        for i, label in enumerate(time_labels(resolution))
     ]
 
+    result.insert(0, ['Time'] + list(calendar.day_abbr))
+    return result
+
+
+@app.route('/api/v1/occupancy/date/<string:day>', methods=['GET'])
+@jsonify
+def occupancy_date_view(day):
+    """
+    Returns number of people present at each time of given YYYY-MM-DD date.
+    """
+    resolution = resolution_arg()
+    try:
+        date = datetime.strptime(day, '%Y-%m-%d').date()
+    except ValueError:
+        abort(404)
+
+    curves = data_manager.current().occupancy(resolution)['dates']
+    if date not in curves:
+        log.debug('No presence on %s!', date)
+        abort(404)
+
+    result = zip(time_labels(resolution), curves[date])
+    result.insert(0, ('Time', 'Present'))
     return result
+
+
+@app.route(
+    '/api/v1/presence_start_end_percentiles/<int:user_id>', methods=['GET']
+)
+@jsonify
+def start_end_percentiles_view(user_id):
+    """
+    Returns percentiles of start and end of work by weekday, eg. for
+    default ?q=50&q=90:
+    [
+        ['Mon', [33570, 36030], [58050, 64230]],
+        (...)
+    ]
+    Values are accurate to half a minute.
+    """
+    sketches = data_manager.current().sketches
+    if user_id not in sketches:
+        log.debug('User %s not found!', user_id)
+        abort(404)
+
+    percents = request.args.getlist('q', type=float) or [50, 90]
+    if not all(0 < percent <= 100 for percent in percents):
+        abort(400)
+
+    return [
+        (
+            calendar.day_abbr[weekday],
+            [values['start'].quantile(percent) for percent in percents],
+            [values['end'].quantile(percent) for percent in percents],
+        )
+        for weekday, values in enumerate(sketches[user_id])
+    ]
+
+
+@app.route('/api/v1/events', methods=['GET'])
+def events_view():
+    """
+    Pushes data changes as Server-Sent Events.
+
+    Sends 'version' event with current data version on connect and 'update'
+    event with manager.snapshot_changes() after every data reload. Stream
+    ends when worker is retired, clients reconnect to a fresh one.
+
+    Every open stream holds a worker, which only gevent workers can afford,
+    so the stream exists only when EVENTS_STREAM is on (flask-ctl async).
+    """
+    if not app.config.get('EVENTS_STREAM', False):
+        abort(404)
+
+    queue = data_manager.subscribe()
+    version = data_manager.current().version
+    keepalive = app.config.get('EVENTS_KEEPALIVE', 30)
+
+    def stream():
+        """
+        Yields events until client or data manager disconnects.
+        """
+        try:
+            yield 'retry: 5000\nevent: version\ndata: {}\n\n'.format(version)
+            while True:
+                try:
+                    event = queue.get(timeout=keepalive)
+                except Queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if event == DISCONNECT:
+                    return
+                if event['version'] > version:
+                    # Reloads before connecting are covered by 'version'.
+                    yield 'event: update\ndata: {}\n\n'.format(dumps(event))
+        finally:
+            data_manager.unsubscribe(queue)
+
+    return Response(
+        stream(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )